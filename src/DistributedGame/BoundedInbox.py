@@ -0,0 +1,157 @@
+"""BoundedInbox is a module with a bounded queue for received messages, so that
+a slow consumer (e.g. a game thread that is blocked on GUI callbacks) can't
+make memory grow without limit while the network keeps delivering.
+
+When the inbox is full, one of these policies applies:
+- BLOCK: the producer (i.e. the thread that routes received messages) blocks
+  until there is room again. This pushes back on the network: datagrams pile
+  up in the kernel's socket buffer, and are dropped there once it's full.
+- DROP_OLDEST: the oldest message is dropped to make room.
+- DROP_BY_CLASS: every message is classified (e.g. chat, keep-alive, move) and
+  the oldest message of the lowest class is dropped to make room. When the
+  new message is of a lower class than all others, it is dropped instead.
+
+Messages can be put in priority lanes (see LaneQueue), so that e.g.
+keep-alive messages are taken before the game messages that arrived earlier.
+Messages are dropped from the least urgent lanes first.
+"""
+
+
+import Queue
+import time
+
+from LaneQueue import LaneQueue
+
+
+class BoundedInbox(LaneQueue):
+
+    BLOCK, DROP_OLDEST, DROP_BY_CLASS = range(3)
+
+    def __init__(self, maxsize=0, policy=BLOCK, classify=None, lane=None):
+        """classify(message) returns the class of a message: messages of
+        lower classes are dropped first. Only DROP_BY_CLASS requires it.
+        lane(message) returns the lane of a message; by default, there's a
+        single lane.
+        A maxsize of zero or less means the inbox is unbounded."""
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.DROP_BY_CLASS):
+            raise ValueError, "Unknown policy: %s" % (policy)
+        if policy == self.DROP_BY_CLASS and not callable(classify):
+            raise ValueError, "The DROP_BY_CLASS policy requires a classify function."
+        LaneQueue.__init__(self, maxsize, lane)
+        self.policy   = policy
+        self.classify = classify
+
+        # Statistics.
+        self.dropped       = {} # Class (None when not classified) -> number of dropped messages.
+        self.blocked       = 0
+        self.timeBlocked   = 0.0
+        self.highWatermark = 0
+
+
+    def put(self, message, block=True, timeout=None):
+        # A single critical section per message, whatever the policy.
+        with self.not_full:
+            cls = self.classify(message) if self.classify is not None else None
+            if self.policy == self.BLOCK or self.maxsize <= 0:
+                if 0 < self.maxsize <= self._qsize():
+                    if not block:
+                        raise Queue.Full
+                    self._waitForRoom(timeout)
+            elif self._qsize() >= self.maxsize and not self._makeRoom(cls):
+                return
+            self._append(cls, message)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+    def offer(self, message):
+        """Put a message only when there is room for it, whatever the policy:
+        it never blocks and never drops another message. Returns whether the
+        message was put."""
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                return False
+            self._put(message)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+
+    def _waitForRoom(self, timeout):
+        """Block until there is room, or raise Queue.Full once the timeout
+        has passed. The mutex must be acquired before calling this method."""
+        start = time.time()
+        try:
+            while self.maxsize <= self._qsize():
+                if timeout is None:
+                    self.not_full.wait()
+                else:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0.0:
+                        raise Queue.Full
+                    self.not_full.wait(remaining)
+        finally:
+            self.blocked += 1
+            self.timeBlocked += time.time() - start
+
+
+    def _makeRoom(self, cls):
+        """Drop a message according to the policy, to make room for a new
+        message of class cls. Returns False when the new message itself
+        should be dropped. The mutex must be acquired before calling this
+        method."""
+        # Drop from the least urgent lane that isn't empty.
+        lanes = [lane for lane in reversed(self.lanes) if lane]
+        if self.policy == self.DROP_OLDEST:
+            dropped, message = lanes[0].popleft()
+        else:
+            lowest = min(c for lane in lanes for (c, m) in lane)
+            if cls < lowest:
+                self._countDrop(cls)
+                return False
+            lane = next(lane for lane in lanes if any(c == lowest for (c, m) in lane))
+            for i, (dropped, message) in enumerate(lane):
+                if dropped == lowest:
+                    del lane[i]
+                    break
+        self.size -= 1
+        self.unfinished_tasks -= 1
+        self._countDrop(dropped)
+        return True
+
+
+    def _countDrop(self, cls):
+        self.dropped[cls] = self.dropped.get(cls, 0) + 1
+
+
+    def _put(self, message):
+        self._append(self.classify(message) if self.classify is not None else None, message)
+
+
+    def _append(self, cls, message):
+        # The lanes hold (class, message) tuples.
+        LaneQueue._put(self, (cls, message))
+        self.highWatermark = max(self.highWatermark, self.size)
+
+
+    def _getLane(self, item):
+        return LaneQueue._getLane(self, item[1])
+
+
+    def _get(self):
+        return LaneQueue._get(self)[1]
+
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'size'              : self._qsize(),
+                'max size'          : self.maxsize,
+                'high watermark'    : self.highWatermark,
+                'messages dropped'  : sum(self.dropped.values()),
+                'dropped per class' : dict(self.dropped),
+                'puts blocked'      : self.blocked,
+                'time blocked'      : self.timeBlocked,
+                'size per lane'     : [len(lane) for lane in self.lanes],
+                'puts per lane'     : list(self.putsPerLane),
+            }
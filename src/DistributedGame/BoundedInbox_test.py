@@ -0,0 +1,86 @@
+from BoundedInbox import *
+from LaneQueue import LaneQueue
+import threading
+import time
+import unittest
+
+
+class TestBoundedInbox(unittest.TestCase):
+
+    def testUnbounded(self):
+        inbox = BoundedInbox()
+        for i in xrange(100):
+            inbox.put(i)
+        self.assertEqual([inbox.get() for i in xrange(100)], range(100))
+        stats = inbox.stats()
+        self.assertEqual(stats['high watermark'], 100)
+        self.assertEqual(stats['messages dropped'], 0)
+
+
+    def testBlock(self):
+        inbox = BoundedInbox(2)
+        inbox.put(0)
+        inbox.put(1)
+        consumer = threading.Timer(0.1, inbox.get)
+        consumer.start()
+        # Blocks until the consumer has made room.
+        inbox.put(2)
+        consumer.join()
+        self.assertEqual([inbox.get(), inbox.get()], [1, 2])
+        stats = inbox.stats()
+        self.assertEqual(stats['puts blocked'], 1)
+        self.assertTrue(stats['time blocked'] > 0.05)
+        self.assertEqual(stats['messages dropped'], 0)
+
+
+    def testDropOldest(self):
+        inbox = BoundedInbox(3, BoundedInbox.DROP_OLDEST)
+        for i in xrange(5):
+            inbox.put(i)
+        self.assertEqual([inbox.get() for i in xrange(3)], [2, 3, 4])
+        self.assertEqual(inbox.stats()['messages dropped'], 2)
+        self.assertEqual(inbox.stats()['dropped per class'], {None : 2})
+
+
+    def testDropByClass(self):
+        CHAT, MOVE = range(2)
+        classify = lambda message: CHAT if message.startswith('chat') else MOVE
+        inbox = BoundedInbox(3, BoundedInbox.DROP_BY_CLASS, classify)
+        for message in ['chat 1', 'move 1', 'chat 2', 'move 2', 'move 3']:
+            inbox.put(message)
+        # Chat messages are dropped before moves, oldest first.
+        self.assertEqual(inbox.stats()['dropped per class'], {CHAT : 2})
+        # A chat message doesn't push out a move: it is dropped itself.
+        inbox.put('chat 3')
+        self.assertEqual([inbox.get() for i in xrange(3)], ['move 1', 'move 2', 'move 3'])
+        self.assertEqual(inbox.stats()['dropped per class'], {CHAT : 3})
+
+
+    def testLanes(self):
+        CONTROL, NORMAL, BULK = LaneQueue.CONTROL, LaneQueue.NORMAL, LaneQueue.BULK
+        lanes = {'keep-alive' : CONTROL, 'move' : NORMAL, 'history' : BULK}
+        inbox = BoundedInbox(3, BoundedInbox.DROP_OLDEST, lane=lambda message: lanes[message.split()[0]])
+        for message in ['history 1', 'move 1', 'history 2', 'keep-alive 1']:
+            inbox.put(message)
+        # The oldest message in the least urgent lane is dropped.
+        self.assertEqual(inbox.stats()['size per lane'], [1, 1, 1])
+        self.assertEqual([inbox.get() for i in xrange(3)], ['keep-alive 1', 'move 1', 'history 2'])
+
+
+    def testOffer(self):
+        inbox = BoundedInbox(2, BoundedInbox.DROP_OLDEST)
+        self.assertTrue(inbox.offer(0))
+        inbox.put(1)
+        # A full inbox doesn't make room for an offered message.
+        self.assertFalse(inbox.offer(2))
+        self.assertEqual([inbox.get(), inbox.get()], [0, 1])
+        self.assertEqual(inbox.stats()['messages dropped'], 0)
+
+
+    def testInvalidPolicy(self):
+        self.assertRaises(ValueError, BoundedInbox, 3, BoundedInbox.DROP_BY_CLASS)
+        self.assertRaises(ValueError, BoundedInbox, 3, 42)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,429 @@
+"""Codec is a module to serialize messages for sending them over the network.
+
+EnvelopeCodec handles the packets that OneToManyService sends: a single
+destination mapped to an envelope as built by MessageProcessor._wrapMessage().
+The envelope's route is packed into a binary header (UUIDs as 16 bytes instead
+of 36 characters, no key names) and its timestamp and message are marshalled.
+MarshalCodec handles any other value that consists of plain Python types.
+PickleCodec is the fallback for all other values (e.g. Player objects).
+CompactCodec handles the same values as MarshalCodec, but encodes them more
+densely, at the cost of speed. It's meant for small values in which every byte
+counts, such as zeroconf TXT records.
+
+Codec combines them: it uses the first codec that can encode a value and
+prefixes the encoded data with that codec's ID, so the receiver knows how to
+decode it.
+"""
+
+
+import cPickle
+import cStringIO
+import marshal
+import struct
+
+
+# Define exceptions.
+class CodecError(Exception): pass
+class UnsupportedValueError(CodecError): pass
+class DecodeError(CodecError): pass
+
+
+def packUUID(value):
+    """Pack a UUID in its canonical text form (as generated by str(uuid)) into
+    16 bytes. Returns None for any other value."""
+    if type(value) is not str or len(value) != 36 \
+       or not (value[8] == value[13] == value[18] == value[23] == '-'):
+        return None
+    hexadecimal = value[0:8] + value[9:13] + value[14:18] + value[19:23] + value[24:36]
+    # Upper case UUIDs wouldn't survive unpacking unchanged.
+    if hexadecimal != hexadecimal.lower():
+        return None
+    try:
+        return hexadecimal.decode('hex')
+    except TypeError:
+        return None
+
+
+def unpackUUID(packed):
+    """Unpack 16 bytes into a UUID in its canonical text form."""
+    h = packed.encode('hex')
+    return '%s-%s-%s-%s-%s' % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+
+
+
+class PickleCodec(object):
+    """Encodes any value that can be pickled.
+    WARNING: insecure! Global variables might be unpickled!"""
+
+    ID = '\x02'
+
+    def encode(self, value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+
+    def decode(self, data):
+        # Read directly from the buffer, without copying it into a string.
+        try:
+            return cPickle.load(cStringIO.StringIO(data))
+        except Exception, e:
+            raise DecodeError, "invalid pickle: %s" % (e)
+
+
+
+
+class MarshalCodec(object):
+    """Encodes values that consist of plain Python types only (None, bool,
+    int, long, float, str, unicode, list, tuple, dict, set).
+    Note that marshal doesn't detect all truncated data. UDP checksums each
+    datagram and IPMulticastMessaging only decodes complete packets, so this
+    never happens in practice."""
+
+    ID = '\x03'
+    VERSION = 2
+
+    def encode(self, value):
+        try:
+            return marshal.dumps(value, self.VERSION)
+        except ValueError, e:
+            raise UnsupportedValueError, e
+
+
+    def decode(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError), e:
+            raise DecodeError, "invalid marshal data: %s" % (e)
+
+
+
+
+class CompactCodec(object):
+    """Encodes values that consist of plain Python types only (None, bool,
+    int, long, float, str, unicode, list, tuple, dict, set, frozenset), with
+    type tags of a single byte and variable-length integers for both numbers
+    and lengths. Strings that are UUIDs are packed into 16 bytes. Small
+    values end up smaller than with pickle or marshal, but encoding and
+    decoding happen in Python, which is slower."""
+
+    ID = '\x04'
+
+    # Type tags.
+    NONE, TRUE, FALSE, INT, LONG, FLOAT, STR, UUID, UNICODE, LIST, TUPLE, DICT, SET, FROZENSET = 'NTFiLfsUultdSz'
+    SEQUENCE_TAGS  = {list : LIST, tuple : TUPLE, set : SET, frozenset : FROZENSET}
+    SEQUENCE_TYPES = dict((tag, t) for t, tag in SEQUENCE_TAGS.items())
+
+    DOUBLE = struct.Struct('!d')
+
+    def encode(self, value):
+        parts = []
+        self._encode(value, parts)
+        return ''.join(parts)
+
+
+    def _encode(self, value, parts):
+        t = type(value)
+        if value is None:
+            parts.append(self.NONE)
+        elif t is bool:
+            parts.append(self.TRUE if value else self.FALSE)
+        elif t is int or t is long:
+            parts.append(self.INT if t is int else self.LONG)
+            # Zigzag encoding, so small negative numbers are small as well.
+            parts.append(self._encodeVarint(value * 2 if value >= 0 else -value * 2 - 1))
+        elif t is float:
+            parts.append(self.FLOAT)
+            parts.append(self.DOUBLE.pack(value))
+        elif t is str and packUUID(value) is not None:
+            parts.append(self.UUID)
+            parts.append(packUUID(value))
+        elif t is str or t is unicode:
+            if t is unicode:
+                value = value.encode('utf-8')
+            parts.append(self.STR if t is str else self.UNICODE)
+            parts.append(self._encodeVarint(len(value)))
+            parts.append(value)
+        elif t is dict:
+            parts.append(self.DICT)
+            parts.append(self._encodeVarint(len(value)))
+            for k, v in value.iteritems():
+                self._encode(k, parts)
+                self._encode(v, parts)
+        elif t in self.SEQUENCE_TAGS:
+            parts.append(self.SEQUENCE_TAGS[t])
+            parts.append(self._encodeVarint(len(value)))
+            for item in value:
+                self._encode(item, parts)
+        else:
+            raise UnsupportedValueError, "unsupported type: %s" % (t)
+
+
+    def _encodeVarint(self, n):
+        """Encode a non-negative integer in 7-bit groups, least significant
+        first; the high bit marks that more groups follow."""
+        bytes = []
+        while n > 0x7F:
+            bytes.append(chr(0x80 | (n & 0x7F)))
+            n >>= 7
+        bytes.append(chr(n))
+        return ''.join(bytes)
+
+
+    def decode(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        try:
+            value, offset = self._decode(data, 0)
+        except (IndexError, struct.error, UnicodeDecodeError), e:
+            raise DecodeError, "truncated or invalid compact data: %s" % (e)
+        if offset != len(data):
+            raise DecodeError, "%d bytes of trailing data" % (len(data) - offset)
+        return value
+
+
+    def _decode(self, data, offset):
+        tag = data[offset]
+        offset += 1
+        if tag == self.NONE:
+            return None, offset
+        elif tag == self.TRUE:
+            return True, offset
+        elif tag == self.FALSE:
+            return False, offset
+        elif tag == self.INT or tag == self.LONG:
+            n, offset = self._decodeVarint(data, offset)
+            value = n / 2 if n % 2 == 0 else -(n + 1) / 2
+            return (int(value) if tag == self.INT else long(value)), offset
+        elif tag == self.FLOAT:
+            return self.DOUBLE.unpack_from(data, offset)[0], offset + self.DOUBLE.size
+        elif tag == self.UUID:
+            if offset + 16 > len(data):
+                raise IndexError, "truncated UUID"
+            return unpackUUID(data[offset:offset + 16]), offset + 16
+        elif tag == self.STR or tag == self.UNICODE:
+            length, offset = self._decodeVarint(data, offset)
+            if offset + length > len(data):
+                raise IndexError, "truncated string"
+            value = data[offset:offset + length]
+            return (value if tag == self.STR else value.decode('utf-8')), offset + length
+        elif tag == self.DICT:
+            length, offset = self._decodeVarint(data, offset)
+            value = {}
+            for i in xrange(length):
+                k, offset = self._decode(data, offset)
+                v, offset = self._decode(data, offset)
+                value[k] = v
+            return value, offset
+        elif tag in self.SEQUENCE_TYPES:
+            length, offset = self._decodeVarint(data, offset)
+            items = []
+            for i in xrange(length):
+                item, offset = self._decode(data, offset)
+                items.append(item)
+            return self.SEQUENCE_TYPES[tag](items), offset
+        else:
+            raise DecodeError, "unknown type tag 0x%02X" % (ord(tag))
+
+
+    def _decodeVarint(self, data, offset):
+        n = 0
+        shift = 0
+        while True:
+            byte = ord(data[offset])
+            offset += 1
+            n |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return n, offset
+
+
+
+
+class EnvelopeCodec(object):
+    """Encodes packets of the form {destination : envelope}, in which the
+    envelope has exactly the keys 'timestamp', 'senderUUID', 'originUUID' and
+    'message'. The message is marshalled when possible, pickled otherwise.
+
+    A packet starts with its route: flags, the sender UUID, the origin UUID
+    (unless it's the sender) and the destination. The timestamp and the
+    message follow, marshalled (or pickled) together. Only a handful of distinct
+    routes are ever sent, so the encoded form of each route and the decoded
+    form of each encoded route are cached: packing and unpacking the UUIDs
+    every time would take longer than pickling the entire packet."""
+
+    ID = '\x01'
+
+    # Flags.
+    ORIGIN_IS_SENDER    = 0x01 # The origin UUID is omitted.
+    DESTINATION_IS_UUID = 0x02 # The destination is 16 bytes instead of a string.
+    MESSAGE_IS_PICKLED  = 0x04
+
+    # Flags & 0x03 -> the end of the route if the destination is a UUID, or
+    # the end of the destination's length byte otherwise.
+    ROUTE_ENDS = (1 + 16 + 16 + 1, 1 + 16 + 1, 1 + 16 + 16 + 16, 1 + 16 + 16)
+
+    # Number of routes after which the caches are cleared.
+    MAX_CACHED_ROUTES = 1024
+
+
+    def __init__(self):
+        self.pickleCodec   = PickleCodec()
+        self.encodedRoutes = {} # (destination, sender, origin) -> encoded route
+        self.decodedRoutes = {} # Encoded route -> (destination, sender, origin)
+
+
+    def encode(self, packet):
+        if type(packet) is not dict or len(packet) != 1:
+            raise UnsupportedValueError, "not a packet"
+        (destination, envelope), = packet.items()
+        if type(envelope) is not dict or len(envelope) != 4:
+            raise UnsupportedValueError, "not an envelope"
+        try:
+            timestamp = envelope['timestamp']
+            message   = envelope['message']
+            route     = (destination, envelope['senderUUID'], envelope['originUUID'])
+        except KeyError:
+            raise UnsupportedValueError, "not an envelope"
+        if type(timestamp) is not float:
+            raise UnsupportedValueError, "not an envelope"
+        try:
+            encodedRoute = self.encodedRoutes[route]
+        except (KeyError, TypeError):
+            encodedRoute = self._encodeRoute(*route)
+
+        try:
+            return encodedRoute + marshal.dumps((timestamp, message), MarshalCodec.VERSION)
+        except ValueError:
+            encodedRoute = chr(ord(encodedRoute[0]) | self.MESSAGE_IS_PICKLED) + encodedRoute[1:]
+            return encodedRoute + self.pickleCodec.encode((timestamp, message))
+
+
+    def _encodeRoute(self, destination, senderUUID, originUUID):
+        """Encodes a route and caches it."""
+        if type(destination) is not str or type(senderUUID) is not str or type(originUUID) is not str:
+            raise UnsupportedValueError, "not an envelope"
+        sender = packUUID(senderUUID)
+        if sender is None:
+            raise UnsupportedValueError, "not an envelope"
+
+        flags = 0
+        parts = [sender]
+        # Origin UUID.
+        if originUUID == senderUUID:
+            flags |= self.ORIGIN_IS_SENDER
+        else:
+            origin = packUUID(originUUID)
+            if origin is None:
+                raise UnsupportedValueError, "not an envelope"
+            parts.append(origin)
+        # Destination.
+        packedDestination = packUUID(destination)
+        if packedDestination is not None:
+            flags |= self.DESTINATION_IS_UUID
+            parts.append(packedDestination)
+        else:
+            if len(destination) > 255:
+                raise UnsupportedValueError, "destination too long"
+            parts.append(chr(len(destination)))
+            parts.append(destination)
+
+        if len(self.encodedRoutes) >= self.MAX_CACHED_ROUTES:
+            self.encodedRoutes.clear()
+        encodedRoute = self.encodedRoutes[(destination, senderUUID, originUUID)] = chr(flags) + ''.join(parts)
+        return encodedRoute
+
+
+    def decode(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        try:
+            flags = ord(data[0])
+            end = self.ROUTE_ENDS[flags & 0x03]
+            if not flags & self.DESTINATION_IS_UUID:
+                end += ord(data[end - 1])
+        except IndexError:
+            raise DecodeError, "truncated route"
+        if end > len(data):
+            raise DecodeError, "truncated route"
+        encodedRoute = data[:end]
+        try:
+            destination, senderUUID, originUUID = self.decodedRoutes[encodedRoute]
+        except KeyError:
+            destination, senderUUID, originUUID = self._decodeRoute(encodedRoute)
+
+        if flags & self.MESSAGE_IS_PICKLED:
+            timestampAndMessage = self.pickleCodec.decode(data[end:])
+        else:
+            try:
+                timestampAndMessage = marshal.loads(data[end:])
+            except (EOFError, ValueError, TypeError), e:
+                raise DecodeError, "invalid marshal data: %s" % (e)
+        try:
+            timestamp, message = timestampAndMessage
+        except (TypeError, ValueError):
+            raise DecodeError, "not a timestamp and a message"
+
+        return {destination : {
+            'timestamp'  : timestamp,
+            'senderUUID' : senderUUID,
+            'originUUID' : originUUID,
+            'message'    : message,
+        }}
+
+
+    def _decodeRoute(self, encodedRoute):
+        """Decodes a route (of which the length was checked already) and
+        caches it."""
+        flags = ord(encodedRoute[0])
+        senderUUID = unpackUUID(encodedRoute[1:17])
+        offset = 17
+        # Origin UUID.
+        if flags & self.ORIGIN_IS_SENDER:
+            originUUID = senderUUID
+        else:
+            originUUID = unpackUUID(encodedRoute[offset:offset + 16])
+            offset += 16
+        # Destination.
+        if flags & self.DESTINATION_IS_UUID:
+            destination = unpackUUID(encodedRoute[offset:])
+        else:
+            destination = encodedRoute[offset + 1:]
+
+        if len(self.decodedRoutes) >= self.MAX_CACHED_ROUTES:
+            self.decodedRoutes.clear()
+        decodedRoute = self.decodedRoutes[encodedRoute] = (destination, senderUUID, originUUID)
+        return decodedRoute
+
+
+
+
+class Codec(object):
+    """Encodes values with the first codec that supports them, and prefixes
+    the result with that codec's ID."""
+
+    def __init__(self, codecs=None):
+        if codecs is None:
+            codecs = [EnvelopeCodec(), MarshalCodec(), PickleCodec()]
+        self.codecs = codecs
+        self.codecsByID = dict((codec.ID, codec) for codec in codecs)
+
+
+    def encode(self, value):
+        for codec in self.codecs:
+            try:
+                return codec.ID + codec.encode(value)
+            except UnsupportedValueError:
+                continue
+        raise UnsupportedValueError, "no codec can encode values of %s" % (type(value))
+
+
+    def decode(self, data):
+        try:
+            codec = self.codecsByID[data[0]]
+        except IndexError:
+            raise DecodeError, "no data"
+        except KeyError:
+            raise DecodeError, "unknown codec 0x%02X" % (ord(data[0]))
+        return codec.decode(data[1:])
@@ -0,0 +1,98 @@
+"""Benchmarks for Codec: encoding and decoding time and encoded size of the
+packets that OneToManyService sends for typical messages, compared to cPickle.
+"""
+
+
+import cPickle
+import time
+import uuid
+from optparse import OptionParser
+
+from Codec import Codec, PickleCodec
+from Player import Player
+
+
+# Message types, as defined by MessageProcessor (which can't be imported
+# without pybonjour).
+MOVE                 = 0
+KEEP_ALIVE_TYPE      = 'KEEP-ALIVE'
+HISTORY_MESSAGE_TYPE = 'HISTORY_MESSAGE'
+
+
+
+def buildPacket(sender, message):
+    """Build a packet like OneToManyService.sendMessage() does, containing
+    an envelope like MessageProcessor._wrapMessage() builds."""
+    envelope = {
+        'timestamp'  : time.time(),
+        'senderUUID' : sender.UUID,
+        'originUUID' : sender.UUID,
+        'message'    : message,
+    }
+    return {str(uuid.uuid1()) : envelope}
+
+
+def buildPackets(historySize):
+    """Build a MOVE, KEEP-ALIVE and HISTORY packet."""
+    players = [Player('Player %d' % (i)) for i in xrange(4)]
+    sender = players[0]
+
+    move = {'type' : MOVE, 'row' : 5, 'col' : 3, 'player' : players[1].UUID}
+    keepAlive = {'type' : KEEP_ALIVE_TYPE, 'originUUID' : sender.UUID, 'timestamp' : time.time()}
+    history = {
+        'type'    : HISTORY_MESSAGE_TYPE,
+        'players' : dict((player.UUID, player) for player in players[1:]),
+        'history' : [{'type' : MOVE, 'row' : i % 20, 'col' : i % 30, 'player' : players[i % 4].UUID} for i in xrange(historySize)],
+        'target'  : players[1].UUID,
+    }
+    history['players']['host'] = sender
+
+    return [
+        ('MOVE',       buildPacket(sender, move)),
+        ('KEEP-ALIVE', buildPacket(sender, keepAlive)),
+        ('HISTORY',    buildPacket(sender, history)),
+    ]
+
+
+def benchmark(encode, decode, packet, repeat, rounds):
+    """Returns the encoded size, and the encoding and decoding time (in
+    seconds) per packet, of the fastest of a number of rounds (so that other
+    processes disturb the results less)."""
+    encodeTime = decodeTime = float('inf')
+    for round in xrange(rounds):
+        start = time.time()
+        for i in xrange(repeat):
+            data = encode(packet)
+        encodeTime = min(encodeTime, (time.time() - start) / repeat)
+
+        start = time.time()
+        for i in xrange(repeat):
+            decode(data)
+        decodeTime = min(decodeTime, (time.time() - start) / repeat)
+
+    return len(data), encodeTime, decodeTime
+
+
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--repeat", type="int", dest="repeat", default=2000,
+                      help="number of times each packet is encoded and decoded per round")
+    parser.add_option("-r", "--rounds", type="int", dest="rounds", default=5,
+                      help="number of rounds, of which the fastest is reported")
+    parser.add_option("-s", "--history-size", type="int", dest="historySize", default=200,
+                      help="number of moves in the HISTORY message")
+    (options, args) = parser.parse_args()
+
+    codecs = [
+        ('cPickle (protocol 0)', cPickle.dumps, cPickle.loads),
+        ('cPickle (protocol 2)', PickleCodec().encode, PickleCodec().decode),
+        ('Codec',                Codec().encode, Codec().decode),
+    ]
+
+    print "%-12s %-22s %10s %14s %14s" % ('message', 'codec', 'bytes', 'encode (us)', 'decode (us)')
+    for messageName, packet in buildPackets(options.historySize):
+        for codecName, encode, decode in codecs:
+            size, encodeTime, decodeTime = benchmark(encode, decode, packet, options.repeat, options.rounds)
+            print "%-12s %-22s %10d %14.1f %14.1f" % (messageName, codecName, size, encodeTime * 1000000, decodeTime * 1000000)
@@ -0,0 +1,113 @@
+import time
+import uuid
+import unittest
+
+from Codec import *
+from Player import Player
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = Codec()
+
+
+    def assertRoundTrip(self, value, codecID):
+        encoded = self.codec.encode(value)
+        self.assertEqual(encoded[0], codecID)
+        decoded = self.codec.decode(memoryview(encoded))
+        self.assertEqual(decoded, value)
+        self.assertEqual(type(decoded), type(value))
+
+
+    def buildPacket(self, destination, message, sender=None, origin=None):
+        sender = sender or str(uuid.uuid1())
+        return {
+            destination : {
+                'timestamp'  : time.time(),
+                'senderUUID' : sender,
+                'originUUID' : origin or sender,
+                'message'    : message,
+            }
+        }
+
+
+    def testUUIDs(self):
+        """Test packing and unpacking of UUIDs."""
+        u = str(uuid.uuid1())
+        self.assertEqual(len(packUUID(u)), 16)
+        self.assertEqual(unpackUUID(packUUID(u)), u)
+        for value in [u.upper(), 'g' * 8 + u[8:], u[:8] + 'a' + u[9:], u + '0', 42]:
+            self.assertEqual(packUUID(value), None)
+
+
+    def testEnvelopes(self):
+        """Test packets as sent by OneToManyService."""
+        message = {'type' : 0, 'row' : 5, 'col' : 3, 'player' : str(uuid.uuid1())}
+        packet = self.buildPacket(str(uuid.uuid1()), message)
+        self.assertRoundTrip(packet, EnvelopeCodec.ID)
+        self.assertTrue(len(self.codec.encode(packet)) < len(PickleCodec().encode(packet)))
+
+        # A different origin, and a destination that isn't a UUID.
+        packet = self.buildPacket('service-to-service', message, origin=str(uuid.uuid1()))
+        self.assertRoundTrip(packet, EnvelopeCodec.ID)
+
+        # A message that can't be marshalled.
+        packet = self.buildPacket(str(uuid.uuid1()), {'type' : 2, 'player' : Player('Wim')})
+        self.assertRoundTrip(packet, EnvelopeCodec.ID)
+
+
+    def testRouteCache(self):
+        """Test that packets with cached routes, and with more routes than
+        are cached, still round trip."""
+        envelopeCodec = self.codec.codecs[0]
+        envelopeCodec.MAX_CACHED_ROUTES = 4
+        senders = [str(uuid.uuid1()) for i in xrange(3)]
+        destinations = [str(uuid.uuid1()) for i in xrange(3)] + ['service-to-service']
+        for i in xrange(3):
+            for sender in senders:
+                for destination in destinations:
+                    self.assertRoundTrip(self.buildPacket(destination, i, sender=sender), EnvelopeCodec.ID)
+                    self.assertRoundTrip(self.buildPacket(destination, i, sender=sender, origin=senders[0]), EnvelopeCodec.ID)
+                    self.assertRoundTrip(self.buildPacket(destination, Player('Wim'), sender=sender), EnvelopeCodec.ID)
+        self.assertTrue(len(envelopeCodec.encodedRoutes) <= 4)
+        self.assertTrue(len(envelopeCodec.decodedRoutes) <= 4)
+
+
+    def testOtherValues(self):
+        """Test that values other than envelopes are marshalled when possible,
+        pickled otherwise."""
+        for value in [None, 42, 'abc', u'\xe9', [1, (2, 3)], {'a' : {'b' : 1.5}}]:
+            self.assertRoundTrip(value, MarshalCodec.ID)
+        self.assertRoundTrip(self.buildPacket(str(uuid.uuid1()), 'test', sender='not a UUID'), MarshalCodec.ID)
+        self.assertRoundTrip({'player' : Player('Wim')}, PickleCodec.ID)
+
+
+    def testCompactCodec(self):
+        """Test that CompactCodec preserves values and their types, and is
+        denser than pickle for a service description."""
+        codec = CompactCodec()
+        for value in [None, True, False, 0, -1, 300, -2**70, 1L, 1.5, 'abc', u'\xe9', str(uuid.uuid1()),
+                      [1, (2, 3)], set([1]), frozenset(['a']), {'a' : {'b' : [None]}}]:
+            decoded = codec.decode(memoryview(codec.encode(value)))
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded), type(value))
+        game = {'name' : "Wim's game", 'description' : 'Four in a row', 'numRows' : 6, 'numCols' : 7,
+                'waitTime' : 5, 'starttime' : time.time(), 'participating' : True}
+        player = {'UUID' : str(uuid.uuid1()), 'name' : 'Wim', 'color' : (255, 0, 0)}
+        for value in [game, player]:
+            self.assertTrue(len(codec.encode(value)) < len(PickleCodec().encode(value)))
+        self.assertRaises(UnsupportedValueError, codec.encode, Player('Wim'))
+        for data in ['', 'i', 's\x05ab', 'x', 'NN', 'U\x00']:
+            self.assertRaises(DecodeError, codec.decode, data)
+
+
+    def testInvalidData(self):
+        """Test that invalid data raises DecodeError."""
+        encoded = self.codec.encode(self.buildPacket('service-to-service', [1, 2, 3]))
+        for data in ['', '\xff', encoded[:20], encoded[:26], MarshalCodec.ID + '\xff', PickleCodec.ID + 'garbage']:
+            self.assertRaises(DecodeError, self.codec.decode, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
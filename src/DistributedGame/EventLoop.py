@@ -0,0 +1,206 @@
+"""EventLoop is a module to run many messaging sessions in a single thread.
+
+Instead of one thread per layer per session, each polling its own sockets and
+queues, a single thread waits for input on all sockets with one select() call
+and runs the callbacks of the sockets that are ready, plus callbacks that are
+scheduled to run soon (from any thread) or after a delay. Nothing is polled,
+so nothing sleeps.
+"""
+
+
+import heapq
+import itertools
+import select
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class Timer(object):
+    """A callback that is scheduled to run at a deadline. Can be cancelled."""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline  = deadline
+        self.callback  = callback
+        self.args      = args
+        self.cancelled = False
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+
+
+class EventLoop(threading.Thread):
+
+    # The maximum time (in seconds) that select() blocks when there is
+    # nothing scheduled.
+    SELECT_TIMEOUT = 1.0
+
+    def __init__(self):
+        super(EventLoop, self).__init__(name="EventLoop-Thread")
+
+        # Sockets to wait for: socket -> callback.
+        self.readers = {}
+
+        # Callbacks to run as soon as possible, and scheduled callbacks (a
+        # heap of (deadline, number, timer) tuples).
+        self.ready   = deque()
+        self.timers  = []
+        self.counter = itertools.count()
+
+        # Mutual exclusion, for callSoon() from other threads.
+        self.lock = threading.Lock()
+
+        # Self-pipe to wake up the thread while it's blocked in select(). A
+        # UDP socket that sends to itself is used instead of os.pipe(),
+        # because select() only accepts sockets on Windows.
+        self.wakeupSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.wakeupSocket.setblocking(0)
+        self.wakeupSocket.bind(('127.0.0.1', 0))
+        self.wakeupAddress = self.wakeupSocket.getsockname()
+
+        # Statistics.
+        self.iterations       = 0
+        self.callbacksRun     = 0
+
+        # General state variables.
+        self.alive = True
+        self.die   = False
+
+
+    def addReader(self, sock, callback):
+        """Call callback whenever there's input on sock. Only call this from
+        the loop's thread (e.g. from a callback), or before it is started."""
+        self.readers[sock] = callback
+
+
+    def removeReader(self, sock):
+        if sock in self.readers:
+            del self.readers[sock]
+
+
+    def callSoon(self, callback, *args):
+        """Run callback(*args) in the loop's thread, as soon as possible. May
+        be called from any thread."""
+        with self.lock:
+            self.ready.append((callback, args))
+        self._wakeup()
+
+
+    def callLater(self, delay, callback, *args):
+        """Run callback(*args) in the loop's thread after delay seconds.
+        Returns a Timer, which can be cancelled. Only call this from the
+        loop's thread, or before it is started."""
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.deadline, next(self.counter), timer))
+        return timer
+
+
+    def run(self):
+        while self.alive:
+            self.runOnce(self._getTimeout())
+
+            if self.die:
+                self._commitSuicide()
+
+
+    def kill(self):
+        # Let the thread know it should commit suicide.
+        self.die = True
+        self._wakeup()
+
+
+    def runOnce(self, timeout=0):
+        """Wait at most timeout seconds for input, then run the callbacks of
+        the sockets that are ready, the timers that are due, and the
+        callbacks that were scheduled to run soon."""
+        self.iterations += 1
+        try:
+            inputReady, outputReady, exceptReady = select.select(self.readers.keys() + [self.wakeupSocket], [], [], timeout)
+        except select.error:
+            # Interrupted by a signal.
+            inputReady = []
+
+        for sock in inputReady:
+            if sock is self.wakeupSocket:
+                self._drainWakeups()
+            elif sock in self.readers:
+                self._runCallback(self.readers[sock], ())
+
+        now = time.time()
+        while len(self.timers) and self.timers[0][0] <= now:
+            deadline, number, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self._runCallback(timer.callback, timer.args)
+
+        # Only run the callbacks that were scheduled before this point;
+        # callbacks scheduled by these callbacks run in the next iteration.
+        with self.lock:
+            ready = self.ready
+            self.ready = deque()
+        for callback, args in ready:
+            self._runCallback(callback, args)
+
+
+    def _runCallback(self, callback, args):
+        """Run a callback. An exception in one callback must not stop the
+        loop (and thereby all other sessions)."""
+        self.callbacksRun += 1
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+
+    def _getTimeout(self):
+        """The time to wait for input: until the next timer is due."""
+        with self.lock:
+            if len(self.ready):
+                return 0
+        # Drop cancelled timers, so they don't cause needless wakeups.
+        while len(self.timers) and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if len(self.timers):
+            return max(0, min(self.SELECT_TIMEOUT, self.timers[0][0] - time.time()))
+        return self.SELECT_TIMEOUT
+
+
+    def _wakeup(self):
+        """Wake up the thread if it's blocked in select()."""
+        try:
+            self.wakeupSocket.sendto('\x00', self.wakeupAddress)
+        except socket.error:
+            # The socket buffer is full (so the thread will wake up anyway)
+            # or the socket has already been closed (so there's no thread to
+            # wake up).
+            pass
+
+
+    def _drainWakeups(self):
+        """Consume all pending wakeups."""
+        while True:
+            try:
+                self.wakeupSocket.recv(1)
+            except socket.error:
+                break
+
+
+    def stats(self):
+        return {
+            'iterations'    : self.iterations,
+            'callbacks run' : self.callbacksRun,
+            'readers'       : len(self.readers),
+            'timers'        : len(self.timers),
+        }
+
+
+    def _commitSuicide(self):
+        """Commit suicide when asked to."""
+        self.wakeupSocket.close()
+
+        # Stop us from running any further.
+        self.alive = False
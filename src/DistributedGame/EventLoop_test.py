@@ -0,0 +1,63 @@
+import threading
+import time
+import socket
+import unittest
+
+from EventLoop import *
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+
+
+    def tearDown(self):
+        if self.loop.isAlive():
+            self.loop.kill()
+            self.loop.join(5)
+        else:
+            self.loop._commitSuicide()
+
+
+    def testTimers(self):
+        calls = []
+        self.loop.callLater(0.02, calls.append, 2)
+        self.loop.callLater(0.01, calls.append, 1)
+        self.loop.callLater(0.01, calls.append, 'cancelled').cancel()
+        self.loop.callSoon(calls.append, 0)
+        endTime = time.time() + 1
+        while len(calls) < 3 and time.time() < endTime:
+            self.loop.runOnce(self.loop._getTimeout())
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(self.loop._getTimeout(), self.loop.SELECT_TIMEOUT)
+
+
+    def testReaders(self):
+        received = []
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(('127.0.0.1', 0))
+        self.loop.addReader(s, lambda: received.append(s.recv(100)))
+        s.sendto('hello', s.getsockname())
+        self.loop.runOnce(1)
+        self.assertEqual(received, ['hello'])
+        self.loop.removeReader(s)
+        s.close()
+
+
+    def testCallSoonFromOtherThread(self):
+        """Test that callSoon() wakes up the loop's thread right away, and
+        that an exception in a callback doesn't stop the loop."""
+        done = threading.Event()
+        self.loop.start()
+        time.sleep(0.05)
+        start = time.time()
+        self.loop.callSoon(lambda: 1 / 0)
+        self.loop.callSoon(done.set)
+        done.wait(5)
+        self.assertTrue(done.is_set())
+        self.assertTrue(time.time() - start < self.loop.SELECT_TIMEOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+"""FragmentBuffer stores the fragments of packets that are being reassembled.
+
+A missing fragment is reconstructed from a parity fragment (the XOR of a group
+of fragments) when the sender sends those. Packets whose fragments stop
+arriving are reported as stalled, so that the missing fragments can be
+requested again. Packets whose fragments don't all arrive in time (because
+some were lost) are expired, and when the buffer grows beyond its maximum
+size, the least recently updated packets are evicted. Memory usage is thus
+bounded, even on a lossy network.
+"""
+
+
+import binascii
+import time
+from collections import OrderedDict
+
+
+class FragmentBuffer(object):
+
+    def __init__(self, timeout=10.0, maxBytes=32 * 1024 * 1024):
+        # Settings.
+        self.timeout  = timeout
+        self.maxBytes = maxBytes
+
+        # Packets being reassembled, from least to most recently updated.
+        self.packets = OrderedDict()
+        self.bytes   = 0
+
+        # Recently completed packets, from least to most recently completed,
+        # so that fragments that arrive again (e.g. because they were
+        # retransmitted for another host) don't start a new packet.
+        self.completedPackets = OrderedDict()
+
+        # Statistics.
+        self.completed     = 0
+        self.expired       = 0
+        self.evicted       = 0
+        self.ignored       = 0
+        self.recovered     = 0 # Completed after they stalled.
+        self.reconstructed = 0 # Fragments reconstructed from parity.
+
+
+    def __len__(self):
+        return len(self.packets)
+
+
+    def __contains__(self, packetID):
+        return packetID in self.packets
+
+
+    def add(self, packetID, fragmentIndex, numFragments, data, now=None):
+        """Add a fragment of a packet. Returns the reassembled packet (a
+        memoryview) when this was the last missing fragment, None otherwise.
+        All fragments but the last one must have the same size, which is
+        chosen by the sender.
+        """
+        if now is None:
+            now = time.time()
+
+        if packetID in self.completedPackets:
+            return None
+        packet = self._getPacket(packetID, numFragments)
+
+        isLast = fragmentIndex == numFragments - 1
+        if packet['data'] is None and not isLast:
+            # The first fragment that isn't the last one tells us the size of
+            # the fragments.
+            if not self._allocate(packet, len(data)):
+                return None
+
+        if fragmentIndex not in packet['fragments']:
+            if packet['data'] is not None:
+                if len(data) > packet['fragmentSize'] or (not isLast and len(data) != packet['fragmentSize']):
+                    self.ignored += 1
+                else:
+                    self._copy(packet, fragmentIndex, data)
+                    if packet['groupSize'] is not None:
+                        self._reconstruct(packet, fragmentIndex / packet['groupSize'])
+            else:
+                # The last fragment arrived first: keep a copy until we know
+                # where it belongs.
+                self._evict(len(data))
+                self.bytes += len(data)
+                packet['last']   = bytearray(data)
+                packet['bytes'] += len(data)
+                packet['fragments'].add(fragmentIndex)
+                packet['size'] += len(data)
+
+        return self._update(packetID, packet, now)
+
+
+    def addParity(self, packetID, groupIndex, groupSize, numFragments, lengths, parity, now=None):
+        """Add a parity fragment of a packet: the XOR of the fragments in
+        group groupIndex (of groupSize fragments), each padded to the size of
+        the fragments. lengths is the XOR of the lengths of these fragments.
+        When a single fragment of the group is missing, it is reconstructed.
+        Returns the reassembled packet (a memoryview) when it is complete,
+        None otherwise.
+        """
+        if now is None:
+            now = time.time()
+
+        if packetID in self.completedPackets:
+            return None
+        packet = self._getPacket(packetID, numFragments)
+
+        if packet['data'] is None:
+            # The parity fragment has the size of the fragments.
+            if not self._allocate(packet, len(parity)):
+                return None
+        if len(parity) != packet['fragmentSize'] or groupSize < 1 \
+           or (packet['groupSize'] is not None and groupSize != packet['groupSize']):
+            self.ignored += 1
+        elif groupIndex not in packet['parity']:
+            self._evict(len(parity))
+            self.bytes += len(parity)
+            packet['bytes'] += len(parity)
+            packet['groupSize'] = groupSize
+            packet['parity'][groupIndex] = (lengths, bytearray(parity))
+            self._reconstruct(packet, groupIndex)
+
+        return self._update(packetID, packet, now)
+
+
+    def _getPacket(self, packetID, numFragments):
+        """Helper method for add() and addParity(). Remove the packet from the
+        buffer (it is reinserted by _update()), or create it."""
+        packet = self.packets.pop(packetID, None)
+        if packet is None:
+            packet = {
+                'data'         : None,
+                'fragmentSize' : None,
+                'last'         : None,
+                'fragments'    : set(),
+                'numFragments' : numFragments,
+                'size'         : 0,
+                'bytes'        : 0,    # Bytes allocated for this packet.
+                'groupSize'    : None, # Number of fragments per parity fragment.
+                'parity'       : {},   # Group index -> (XOR of lengths, parity).
+                'stalls'       : 0,    # Number of times the packet was reported as stalled.
+                'reported'     : 0,    # When the packet was last reported as stalled.
+            }
+        return packet
+
+
+    def _allocate(self, packet, fragmentSize):
+        """Helper method for add() and addParity(). The buffer for the packet
+        is allocated once, at the maximum size for its number of fragments,
+        and each fragment is copied directly into its place. Returns False
+        when the packet would never fit."""
+        size = packet['numFragments'] * fragmentSize
+        if size > self.maxBytes:
+            self.bytes -= packet['bytes']
+            self.evicted += 1
+            return False
+        self._evict(size)
+        self.bytes += size
+        packet['data']         = bytearray(size)
+        packet['fragmentSize'] = fragmentSize
+        packet['bytes']       += size
+        if packet['last'] is not None:
+            self.bytes -= len(packet['last'])
+            packet['bytes'] -= len(packet['last'])
+            if len(packet['last']) <= fragmentSize:
+                packet['data'][size - fragmentSize:size - fragmentSize + len(packet['last'])] = packet['last']
+            else:
+                # It doesn't fit: ignore it.
+                packet['fragments'].discard(packet['numFragments'] - 1)
+                packet['size'] -= len(packet['last'])
+                self.ignored += 1
+            packet['last'] = None
+        return True
+
+
+    def _copy(self, packet, fragmentIndex, data):
+        """Copy a fragment into its place in the packet's buffer."""
+        offset = fragmentIndex * packet['fragmentSize']
+        packet['data'][offset:offset + len(data)] = data
+        packet['fragments'].add(fragmentIndex)
+        packet['size'] += len(data)
+
+
+    def _reconstruct(self, packet, groupIndex):
+        """Reconstruct the missing fragment of a group from its parity
+        fragment, if exactly one fragment is missing."""
+        if groupIndex not in packet['parity']:
+            return
+        groupSize    = packet['groupSize']
+        fragmentSize = packet['fragmentSize']
+        first = groupIndex * groupSize
+        group = xrange(first, min(first + groupSize, packet['numFragments']))
+        missing = [f for f in group if f not in packet['fragments']]
+        if len(missing) > 1:
+            return
+        lengths, parity = packet['parity'].pop(groupIndex)
+        self.bytes -= len(parity)
+        packet['bytes'] -= len(parity)
+        if len(missing) == 0:
+            return
+
+        # XOR the parity with all other fragments of the group (which are
+        # zero-padded in the buffer), as long integers.
+        value = int(binascii.hexlify(parity), 16)
+        for f in group:
+            if f != missing[0]:
+                value ^= int(binascii.hexlify(packet['data'][f * fragmentSize:(f + 1) * fragmentSize]), 16)
+        data = binascii.unhexlify('%0*x' % (2 * fragmentSize, value))
+        # All fragments but the last one have the full size.
+        if missing[0] == packet['numFragments'] - 1:
+            length = lengths ^ (fragmentSize if (len(group) - 1) % 2 else 0)
+            if length > fragmentSize:
+                self.ignored += 1
+                return
+            data = data[:length]
+        self._copy(packet, missing[0], data)
+        self.reconstructed += 1
+
+
+    def _update(self, packetID, packet, now):
+        """Helper method for add() and addParity(). Returns the reassembled
+        packet when it is complete, otherwise reinserts it."""
+
+        # When we have all fragments of a packet, return it.
+        if len(packet['fragments']) == packet['numFragments']:
+            self.bytes -= packet['bytes']
+            self.completed += 1
+            if packet['stalls'] > 0:
+                self.recovered += 1
+            self.completedPackets[packetID] = now + self.timeout
+            if packet['data'] is None:
+                return memoryview(packet['last'])
+            return memoryview(packet['data'])[:packet['size']]
+
+        # Otherwise (re)insert it as the most recently updated packet, with a
+        # new deadline.
+        packet['updated']  = now
+        packet['deadline'] = now + self.timeout
+        self.packets[packetID] = packet
+        return None
+
+
+    def expire(self, now=None):
+        """Remove all packets whose deadline has passed."""
+        if now is None:
+            now = time.time()
+
+        # Deadlines increase from the least to the most recently updated
+        # packet, so we can stop at the first packet that hasn't expired.
+        while len(self.packets):
+            packetID = next(iter(self.packets))
+            if self.packets[packetID]['deadline'] > now:
+                break
+            packet = self.packets.pop(packetID)
+            self.bytes -= packet['bytes']
+            self.expired += 1
+
+        while len(self.completedPackets):
+            packetID = next(iter(self.completedPackets))
+            if self.completedPackets[packetID] > now:
+                break
+            del self.completedPackets[packetID]
+
+
+    def stalled(self, delay, maxStalls, now=None):
+        """Returns a list of (packetID, missing fragment indices) tuples for
+        the packets that haven't been updated in the last delay seconds, and
+        that haven't been reported as stalled more than maxStalls times. Each
+        packet is reported at most once every delay seconds."""
+        if now is None:
+            now = time.time()
+
+        stalled = []
+        # Packets are ordered by their last update, so we can stop at the
+        # first packet that has been updated recently.
+        for packetID, packet in self.packets.iteritems():
+            if packet['updated'] > now - delay:
+                break
+            if packet['stalls'] >= maxStalls or packet['reported'] > now - delay:
+                continue
+            packet['stalls'] += 1
+            packet['reported'] = now
+            missing = [f for f in xrange(packet['numFragments']) if f not in packet['fragments']]
+            stalled.append((packetID, missing))
+        return stalled
+
+
+    def _evict(self, size):
+        """Evict the least recently updated packets until size more bytes fit
+        in the buffer."""
+        while len(self.packets) and self.bytes + size > self.maxBytes:
+            packetID, packet = self.packets.popitem(last=False)
+            self.bytes -= packet['bytes']
+            self.evicted += 1
+
+
+    def stats(self):
+        return {
+            'packets buffered'        : len(self.packets),
+            'bytes buffered'          : self.bytes,
+            'packets completed'       : self.completed,
+            'packets expired'         : self.expired,
+            'packets evicted'         : self.evicted,
+            'fragments ignored'       : self.ignored, # Fragments of an unexpected size.
+            'packets recovered'       : self.recovered,
+            'fragments reconstructed' : self.reconstructed,
+        }
@@ -0,0 +1,95 @@
+from FragmentBuffer import *
+import unittest
+
+
+class TestFragmentBuffer(unittest.TestCase):
+
+    def testReassembly(self):
+        """Test reassembly of fragments that arrive out of order."""
+        b = FragmentBuffer()
+        self.assertEqual(b.add('p', 2, 3, 'ij', now=0), None)
+        self.assertEqual(b.add('p', 0, 3, 'abcd', now=0), None)
+        self.assertEqual(b.add('p', 0, 3, 'abcd', now=0), None) # Duplicate.
+        self.assertEqual(b.add('p', 1, 3, 'efgh', now=0).tobytes(), 'abcdefghij')
+        self.assertEqual(len(b), 0)
+        self.assertEqual(b.stats()['bytes buffered'], 0)
+        self.assertEqual(b.stats()['packets completed'], 1)
+
+
+    def testFragmentSize(self):
+        """Test that the fragment size is taken from the fragments."""
+        b = FragmentBuffer()
+        self.assertEqual(b.add('p', 1, 2, 'xyz', now=0), None)
+        self.assertEqual(b.stats()['bytes buffered'], 3)
+        self.assertEqual(b.add('p', 0, 2, 'abcdef', now=0).tobytes(), 'abcdefxyz')
+
+        # Fragments of an unexpected size are ignored.
+        self.assertEqual(b.add('q', 0, 3, 'abcd', now=0), None)
+        self.assertEqual(b.add('q', 1, 3, 'efg', now=0), None)
+        self.assertEqual(b.add('q', 2, 3, 'ijklm', now=0), None)
+        self.assertEqual(b.stats()['fragments ignored'], 2)
+        self.assertEqual(b.add('q', 1, 3, 'efgh', now=0), None)
+        self.assertEqual(b.add('q', 2, 3, 'ij', now=0).tobytes(), 'abcdefghij')
+        self.assertEqual(b.stats()['bytes buffered'], 0)
+
+
+    def testStalled(self):
+        """Test that packets that stopped receiving fragments are reported."""
+        b = FragmentBuffer()
+        b.add('a', 0, 4, 'abcd', now=0)
+        b.add('a', 2, 4, 'ijkl', now=1)
+        b.add('b', 0, 2, 'abcd', now=2)
+        self.assertEqual(b.stalled(1, 2, now=2.5), [('a', [1, 3])])
+        # Reported at most once per delay, and at most maxStalls times.
+        self.assertEqual(b.stalled(1, 2, now=3), [('b', [1])])
+        self.assertEqual(b.stalled(1, 2, now=3.5), [('a', [1, 3])])
+        self.assertEqual(b.stalled(1, 2, now=4.5), [('b', [1])])
+
+        b.add('a', 1, 4, 'efgh', now=5)
+        self.assertEqual(b.add('a', 3, 4, 'mn', now=5).tobytes(), 'abcdefghijklmn')
+        self.assertEqual(b.stats()['packets recovered'], 1)
+        # Fragments of a completed packet that arrive again are ignored.
+        self.assertEqual(b.add('a', 3, 4, 'mn', now=6), None)
+        self.assertFalse('a' in b)
+
+
+    def testExpiry(self):
+        """Test that incomplete packets expire after the timeout."""
+        b = FragmentBuffer(timeout=10)
+        b.add('a', 0, 2, 'abcd', now=0)
+        b.add('b', 0, 2, 'abcd', now=5)
+        b.expire(now=9)
+        self.assertEqual(len(b), 2)
+
+        # Each new fragment postpones the deadline.
+        b.add('a', 0, 2, 'abcd', now=9)
+        b.expire(now=16)
+        self.assertFalse('b' in b)
+        self.assertTrue('a' in b)
+        b.expire(now=19)
+        self.assertEqual(len(b), 0)
+        self.assertEqual(b.stats()['packets expired'], 2)
+        self.assertEqual(b.stats()['bytes buffered'], 0)
+
+
+    def testEviction(self):
+        """Test that the least recently updated packets are evicted when the
+        buffer is full."""
+        b = FragmentBuffer(maxBytes=24)
+        b.add('a', 0, 3, 'abcd', now=0) # 12 bytes.
+        b.add('b', 0, 2, 'abcd', now=1) # 8 bytes.
+        b.add('a', 1, 3, 'efgh', now=2) # Touches 'a'.
+        b.add('c', 0, 2, 'abcd', now=3) # 8 bytes, evicts 'b'.
+        self.assertTrue('a' in b)
+        self.assertFalse('b' in b)
+        self.assertTrue('c' in b)
+        self.assertEqual(b.stats()['bytes buffered'], 20)
+
+        # A packet that can never fit is dropped immediately.
+        self.assertEqual(b.add('d', 0, 7, 'abcd', now=4), None)
+        self.assertFalse('d' in b)
+        self.assertEqual(b.stats()['packets evicted'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,108 @@
 """IPMulticastMessaging is a module to make local multicasted, multithreaded,
 queued, unordered, unreliable messaging simpler than you can imagine.
 Loopback is enabled.
-(Fragmentation and reassembly happen automatically. Unreliable because no
-recovery/resending happens for lost packets.)
+(Fragmentation and reassembly happen automatically, large packets are
+compressed. Lost fragments of a packet are requested again through NACKs.
+Unreliable because packets that are lost entirely are not recovered.)
 Uses IP multicast networking.
+Received messages are put in the inbox, or passed to a message callback
+instead, straight from the thread that received them.
+The outbox has priority lanes (see LaneQueue): large messages are compressed
+and sent in slices, in between the messages of the CONTROL lane, and large
+received packets are decompressed in slices, in between the received control
+packets. Other messages keep their order within their lane.
+EventLoopIPMulticastMessaging runs on a shared EventLoop instead of a thread of
+its own.
 """
 
 
+import binascii
+import hashlib
 import select
-import cPickle
 import math
 import Queue
+from collections import deque, OrderedDict
 import socket
+import struct
+import sys
 import threading
 import time
 import uuid
+import zlib
+
+from Codec import Codec, DecodeError
+from FragmentBuffer import FragmentBuffer
+from LaneQueue import LaneQueue
+from LockProfiler import profiler
+from SequenceTracker import SequenceTracker
 
 
 # Define exceptions.
 class IPMulticastMessagingError(Exception): pass
 class MessageTooLargeError(IPMulticastMessagingError): pass
 class SentIncompleteMessageError(IPMulticastMessagingError): pass
+class MalformedFragmentError(IPMulticastMessagingError): pass
+class IncompatibleFragmentError(IPMulticastMessagingError): pass
+
+
+class NotifyingQueue(object):
+    """An unbounded queue with a lane per priority (see LaneQueue) that calls
+    a callback after every put(), so that the thread consuming the queue can
+    be woken up instead of having to poll it.
+    It has a single consumer, which never blocks, so it doesn't need a lock:
+    every lane is a deque, whose append() and popleft() are atomic."""
+
+    def __init__(self, callback, lane=None):
+        self.callback = callback
+        self.lane     = lane
+        self.lanes    = [deque() for i in xrange(LaneQueue.NUM_LANES)]
+
+        # Statistics. Only updated by the consumer.
+        self.takenPerLane = [0] * LaneQueue.NUM_LANES
+
+
+    def put(self, item, block=True, timeout=None):
+        """Never blocks, since the queue is unbounded."""
+        self.lanes[self.lane(item) if self.lane is not None else LaneQueue.NORMAL].append(item)
+        self.callback()
+
+
+    def get(self, block=False, timeout=None):
+        """Take the next item from the most urgent lane that isn't empty.
+        Never blocks: raises Queue.Empty when the queue is empty. Must only
+        be called by the consumer."""
+        for lane in xrange(len(self.lanes)):
+            if len(self.lanes[lane]):
+                self.takenPerLane[lane] += 1
+                return self.lanes[lane].popleft()
+        raise Queue.Empty
+
+
+    get_nowait = get
+
+
+    def qsize(self):
+        return sum(len(lane) for lane in self.lanes)
+
+
+    def stats(self):
+        return {
+            'size per lane'  : [len(lane) for lane in self.lanes],
+            'taken per lane' : list(self.takenPerLane),
+        }
+
+
+class GroupMessage(object):
+    """A message to be sent to a specific multicast group instead of to
+    MCAST_GRP (unless the group is None), in one of the lanes of the outbox.
+    Put it in the outbox like any other message."""
+
+    def __init__(self, group, message, priority=LaneQueue.NORMAL):
+        self.group    = group
+        self.message  = message
+        self.priority = priority
+
+
 
 
 class IPMulticastMessaging(threading.Thread):
@@ -28,25 +110,209 @@ class IPMulticastMessaging(threading.Thread):
     ANY = "0.0.0.0" # Corresponds to INADDR_ANY.
     MCAST_GRP = '225.0.13.37'
     MCAST_TTL = 1 # 1 for same subnet, 32 for same organization (see http://www.tldp.org/HOWTO/Multicast-HOWTO-2.html)
-    PACKET_SIZE = 64000
-    MAX_NUM_FRAGMENTS = 10000
 
-    FRAGMENT_ID_SIZE   = 36 + 5 + 5 # UUID (36 characters) + number (5 digits) + total number (5 digits)
-    FRAGMENT_DATA_SIZE = PACKET_SIZE - FRAGMENT_ID_SIZE
+    # Traffic can be sharded over GROUP_COUNT multicast groups, starting at
+    # GROUP_BASE: getGroup() maps a key (e.g. a game session UUID) to one of
+    # them. Only hosts that joined a group receive its traffic, so the kernel
+    # filters traffic for other keys.
+    GROUP_BASE  = '225.0.14.0'
+    GROUP_COUNT = 256
+    IP_MULTICAST_ALL = getattr(socket, 'IP_MULTICAST_ALL', 49) # Linux only, missing in Python 2.
+    # By default, each fragment fits in a single Ethernet frame (1500 byte
+    # MTU - 20 bytes IP header - 8 bytes UDP header), so that the IP layer
+    # doesn't have to fragment it, and a lost frame only loses one small
+    # fragment. The largest possible UDP payload is 65507 bytes.
+    PACKET_SIZE = 1500 - 20 - 8
+    MAX_PACKET_SIZE = 65507
+    MAX_NUM_FRAGMENTS = 65535 # The fragment header has room for 16 bits.
+
+    # Every fragment starts with a binary header:
+    # - magic byte (distinguishes this format from the original ASCII
+    #   fragment IDs, which always start with a hexadecimal digit)
+    # - header format version
+    # - flags
+    # - sender ID (16 bytes, a random UUID generated once per instance)
+    # - multicast group the packet was sent to (4 bytes), since receivers
+    #   that joined only some of the groups only see those groups' packets
+    # - sequence number of the packet (unsigned 32-bit, per sender and group)
+    # - fragment index (unsigned 16-bit)
+    # - total number of fragments (unsigned 16-bit)
+    FRAGMENT_HEADER         = struct.Struct('!BBB16s4sIHH')
+    FRAGMENT_MAGIC          = 0xD6
+    FRAGMENT_VERSION        = 2
+    FRAGMENT_HEADER_SIZE    = FRAGMENT_HEADER.size # 31 bytes.
+    LEGACY_FRAGMENT_ID_SIZE = 36 + 5 + 5 # UUID (36 characters) + number (5 digits) + total number (5 digits)
+
+    # Fragment header flags.
+    FLAG_COALESCED  = 0x01 # The packet contains multiple length-prefixed messages.
+    FLAG_COMPRESSED = 0x02 # The packet is compressed with zlib.
+    FLAG_NACK       = 0x04 # The packet is a NACK: a request to resend fragments.
+    FLAG_PARITY     = 0x08 # The fragment is a parity fragment.
+    FLAG_CONTROL    = 0x10 # The packet contains messages of the CONTROL lane, which may overtake other packets.
 
-    def __init__(self, port):
+    # When coalescing is enabled, small messages are held back for at most
+    # COALESCE_MAX_DELAY seconds and packed together into a single packet of
+    # at most COALESCE_MAX_SIZE bytes.
+    COALESCE_MAX_SIZE  = 1400
+    COALESCE_MAX_DELAY = 0.005
+    COALESCED_LENGTH   = struct.Struct('!H')
+
+    # Packets of at least COMPRESS_THRESHOLD bytes are compressed with zlib
+    # at COMPRESS_LEVEL, unless that doesn't make them any smaller.
+    COMPRESS_THRESHOLD = 1024
+    COMPRESS_LEVEL     = 6
+
+    # The maximum time (in seconds) that the thread blocks while waiting for
+    # incoming packets. Putting a message in the outbox or calling kill()
+    # wakes the thread up immediately, so this only bounds the time it takes
+    # to notice state changes that bypass both.
+    SELECT_TIMEOUT = 1.0
+
+    # The maximum number of datagrams that are read from the socket each time
+    # the thread wakes up, and the size of the socket's receive buffer, which
+    # must be able to hold bursts of datagrams in between wakeups.
+    RECEIVE_BATCH_SIZE  = 256
+    RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+
+    # Packets that are still incomplete this many seconds after their last
+    # fragment arrived are dropped, and at most this many bytes are used to
+    # reassemble packets.
+    REASSEMBLY_TIMEOUT   = 10.0
+    REASSEMBLY_MAX_BYTES = 32 * 1024 * 1024
+
+    # When no fragments of an incomplete packet arrive for NACK_DELAY
+    # seconds, a NACK listing the missing fragments is multicast (at most
+    # NACK_MAX_RETRIES times per packet), and the sender resends only those
+    # fragments. Senders keep the fragments of the packets they sent for
+    # RETRANSMIT_TIMEOUT seconds, using at most RETRANSMIT_MAX_BYTES bytes.
+    NACK_DELAY           = 0.05
+    NACK_MAX_RETRIES     = 5
+    NACK_HEADER          = struct.Struct('!16s4sI') # Sender ID, group, sequence number.
+    NACK_INDEX           = struct.Struct('!H')
+    RETRANSMIT_TIMEOUT   = 5.0
+    RETRANSMIT_MAX_BYTES = 16 * 1024 * 1024
+
+    # When forward error correction is enabled, a parity fragment (the XOR of
+    # the fragments) is sent after every group of fecGroupSize fragments of a
+    # packet, so that one lost fragment per group can be reconstructed
+    # without a round trip. The index of a parity fragment is the index of
+    # its group, and its data starts with the group size and the XOR of the
+    # lengths of the fragments in the group.
+    PARITY_HEADER = struct.Struct('!HH')
+
+    # Messages in the NORMAL and BULK lanes of the outbox (e.g. a history
+    # message of many megabytes) are compressed and sent in slices of
+    # SLICE_SIZE bytes, and large received packets are decompressed in slices
+    # of SLICE_SIZE bytes. Messages in the CONTROL lane only have to wait for
+    # the current slice, not for the entire message. Messages in the other
+    # lanes wait for the messages of their lane that are being sent (or
+    # received) in slices, so they keep their order.
+    SLICE_SIZE = 64 * 1024
+
+    def __init__(self, port, packetSize=PACKET_SIZE, receiveBatchSize=RECEIVE_BATCH_SIZE,
+                 reassemblyTimeout=REASSEMBLY_TIMEOUT, reassemblyMaxBytes=REASSEMBLY_MAX_BYTES,
+                 codec=None, coalesce=False, coalesceMaxSize=COALESCE_MAX_SIZE, coalesceMaxDelay=COALESCE_MAX_DELAY,
+                 compressThreshold=COMPRESS_THRESHOLD, compressLevel=COMPRESS_LEVEL,
+                 nackDelay=NACK_DELAY, retransmitTimeout=RETRANSMIT_TIMEOUT, retransmitMaxBytes=RETRANSMIT_MAX_BYTES,
+                 fecGroupSize=None, groupBase=GROUP_BASE, groupCount=GROUP_COUNT, filterSources=True,
+                 messageCallback=None, sliceSize=SLICE_SIZE):
         super(IPMulticastMessaging, self).__init__(name="IPMulticastMessaging-Thread")
 
-        # Message relaying.
-        self.inbox  = Queue.Queue()
-        self.outbox = Queue.Queue()
+        if not (self.FRAGMENT_HEADER_SIZE < packetSize <= self.MAX_PACKET_SIZE):
+            raise IPMulticastMessagingError, "The packet size must be between %d and %d bytes." % (self.FRAGMENT_HEADER_SIZE + 1, self.MAX_PACKET_SIZE)
+
+        # Message relaying. Putting a message in the outbox wakes up the
+        # thread, so that it is sent right away, in the lane of its priority
+        # (GroupMessages have one, other messages are NORMAL). Received
+        # messages are passed to messageCallback when it is given, or put in
+        # the inbox otherwise.
+        self.inbox           = profiler.profileQueue(Queue.Queue(), 'IPMulticastMessaging.inbox')
+        self.outbox          = NotifyingQueue(self._wakeup, lane=self._getPriority)
+        self.messageCallback = messageCallback
 
         # Metadata.
-        self.fragmentsBuffer = {}
-        self.memberships     = []
+        self.fragmentsBuffer = FragmentBuffer(reassemblyTimeout, reassemblyMaxBytes)
+        self.memberships     = set()
+        self.sources         = set() # Hosts whose datagrams are accepted.
+        self.ownSources      = set(['127.0.0.1'])
+        self.groups          = {} # Joined multicast group -> number of joins.
+        self.senderID        = uuid.uuid4().bytes
+        self.sequenceNumbers = {} # Group -> next sequence number.
+        self.peers           = {} # Sender ID -> (host, {group : SequenceTracker}).
+
+        # Recently sent packets that consist of multiple fragments, from least
+        # to most recently sent, for retransmission of lost fragments. Keyed
+        # by (group, sequence number).
+        self.sentPackets = OrderedDict()
+        self.sentBytes   = 0
+
+        # Messages that are being sent in slices, per lane (the CONTROL lane
+        # is never sliced), from first to last taken from the outbox:
+        # _transmitMessage() generators.
+        self.transmissions = [deque() for i in xrange(LaneQueue.NUM_LANES)]
+
+        # Received packets that are being decompressed in slices, followed by
+        # the packets that were received after them (except for CONTROL
+        # packets), from first to last received: _decodePacket() generators.
+        self.receptions = deque()
+
+        # Settings.
+        self.packetSize         = int(packetSize)
+        self.fragmentDataSize   = self.packetSize - self.FRAGMENT_HEADER_SIZE
+        self.receiveBatchSize   = int(receiveBatchSize)
+        self.codec              = codec if codec is not None else Codec()
+        self.coalesce           = coalesce
+        self.coalesceMaxSize    = min(int(coalesceMaxSize), self.fragmentDataSize)
+        self.coalesceMaxDelay   = coalesceMaxDelay
+        self.compressThreshold  = compressThreshold # None disables compression.
+        self.compressLevel      = compressLevel
+        self.maxPacketSize      = reassemblyMaxBytes
+        self.nackDelay          = nackDelay # None disables NACKs.
+        self.retransmitTimeout  = retransmitTimeout
+        self.retransmitMaxBytes = retransmitMaxBytes
+        self.fecGroupSize       = fecGroupSize # None disables forward error correction.
+        self.sliceSize          = int(sliceSize)
+        self.groupBase          = struct.unpack('!I', socket.inet_aton(groupBase))[0]
+        self.groupCount         = groupCount
+        self.filterSources      = filterSources # When False, datagrams from any host are accepted.
+        if self.fecGroupSize is not None:
+            # Parity fragments must fit in a packet as well.
+            self.fragmentDataSize -= self.PARITY_HEADER.size
+
+        # Coalescing state: encoded messages waiting to be packed together.
+        self.coalescedMessages = []
+        self.coalescedSize     = 0
+        self.coalescedGroup    = None
+        self.coalescedFlags    = 0
+        self.coalesceDeadline  = None
+
+        # Statistics.
+        self.wakeups               = 0
+        self.datagramsReceived     = 0
+        self.datagramsPerWakeup    = {}
+        self.malformedDatagrams    = 0
+        self.incompatibleDatagrams = 0
+        self.incompatibleHosts     = set() # Hosts running a different version.
+        self.datagramsSent         = 0
+        self.messagesSent          = 0
+        self.messagesCoalesced     = 0
+        self.packetsCompressed     = 0
+        self.bytesUncompressed     = 0 # Size of the compressed packets before compression.
+        self.bytesCompressed       = 0 # Size of the compressed packets after compression.
+        self.compressionTime       = 0.0
+        self.packetsDecompressed   = 0
+        self.decompressionTime     = 0.0
+        self.nacksSent             = 0
+        self.nacksReceived         = 0
+        self.fragmentsResent       = 0
+        self.parityFragmentsSent   = 0
+        self.unknownDatagrams      = 0
+        self.slicedMessagesSent    = 0
+        self.slicesSent            = 0
+        self.slicedPacketsReceived = 0
 
         # Mutual exclusion.
-        self.lock = threading.Condition()
+        self.lock = profiler.Condition('IPMulticastMessaging.lock')
 
         # General state variables.
         self.alive = True
@@ -60,6 +326,16 @@ class IPMulticastMessaging(threading.Thread):
             self.recvSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Allow multiple processes on the same computer to join the multicast group.
         self.recvSocket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.MCAST_TTL) 
         self.recvSocket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # Enable loopback.
+        if sys.platform.startswith('linux'):
+            # Only receive traffic for the groups this socket joined, not for
+            # those joined by other sockets (e.g. other instances) on this
+            # host.
+            self.recvSocket.setsockopt(socket.IPPROTO_IP, self.IP_MULTICAST_ALL, 0)
+        try:
+            self.recvSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE)
+        except socket.error:
+            # The OS may cap the buffer size; the default is still usable.
+            pass
         self.recvSocket.bind((self.ANY, port))
         # SAMPLE: If we'd like to use a specific network InterFace (IF).
         # host = socket.gethostbyname(socket.gethostname())
@@ -78,6 +354,8 @@ class IPMulticastMessaging(threading.Thread):
         (hostname, aliaslist, ipaddrlist) = socket.gethostbyname_ex(socket.gethostname())
         for ip in ipaddrlist:
             self.subscribe(ip)
+            self.ownSources.add(ip)
+        self.sources.update(self.ownSources)
 
         # Prepare socket for sending IP multicast packets. Always picks a
         # random port. Also necessary for zeroconf: if you pass it the same
@@ -91,6 +369,20 @@ class IPMulticastMessaging(threading.Thread):
         (ip, port) = self.sendSocket.getsockname()
         self.sendPort = port
 
+        # Buffers for sending and receiving datagrams, reused for every
+        # datagram. Other hosts may use a larger packet size, so the receive
+        # buffer can hold any datagram.
+        self.sendBuffer = bytearray(self.packetSize)
+        self.recvBuffer = bytearray(self.MAX_PACKET_SIZE)
+
+        # Self-pipe to wake up the thread while it's blocked in select(). A
+        # UDP socket that sends to itself is used instead of os.pipe(),
+        # because select() only accepts sockets on Windows.
+        self.wakeupSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.wakeupSocket.setblocking(0)
+        self.wakeupSocket.bind(('127.0.0.1', 0))
+        self.wakeupAddress = self.wakeupSocket.getsockname()
+
 
     def getSendPort(self):
         return self.sendPort
@@ -98,23 +390,27 @@ class IPMulticastMessaging(threading.Thread):
 
     def run(self):
         while self.alive:
-            # Send and receive IP multicast messages.
+            # Send IP multicast messages, then block until either a packet
+            # arrives or we're woken up because there's something to send.
             self._send()
-            self._receive()
+            self._receive(self._getTimeout())
 
             # Commit suicide when asked to.
-            with self.lock:
-                if self.die and self.outbox.qsize() == 0:
-                    self._commitSuicide()
-
-            # Processing the queues 50 times per second is sufficient.
-            time.sleep(0.02)
+            self._commitSuicideWhenIdle()
 
 
     def subscribe(self, host):
+        """Join MCAST_GRP on the interface with the given address. Returns
+        whether it was joined: only the addresses of local interfaces can be
+        subscribed to, not those of other hosts (whose datagrams are accepted
+        through addSource())."""
         if host not in self.memberships:
-            self.memberships.append(host)
-            self.recvSocket.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self.MCAST_GRP) + socket.inet_aton(host))
+            try:
+                self.recvSocket.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self.MCAST_GRP) + socket.inet_aton(host))
+            except socket.error:
+                # Not the address of a local interface.
+                return False
+            self.memberships.add(host)
             # print "subscribed to %s" % host
             return True
         else:
@@ -123,133 +419,708 @@ class IPMulticastMessaging(threading.Thread):
 
 
     def unsubscribe(self, host):
+        """Leave MCAST_GRP on the interface with the given address, if it
+        was subscribed to. Returns whether it was left."""
+        if host not in self.memberships:
+            return False
         self.memberships.remove(host)
         self.recvSocket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(self.MCAST_GRP) + socket.inet_aton(host))
+        return True
+
+
+    def addSource(self, host):
+        """Accept datagrams from a host (e.g. a peer discovered through
+        zeroconf)."""
+        with self.lock:
+            self.sources.add(host)
+
+
+    def removeSource(self, host):
+        """Stop accepting datagrams from a host. Our own IPs are always
+        accepted."""
+        with self.lock:
+            if host not in self.ownSources:
+                self.sources.discard(host)
+
+
+    def getGroup(self, key):
+        """Map a key deterministically (on every host) to a multicast group."""
+        offset = struct.unpack('!I', hashlib.md5(key).digest()[:4])[0] % self.groupCount
+        return socket.inet_ntoa(struct.pack('!I', self.groupBase + offset))
+
+
+    def joinGroup(self, group):
+        """Receive the traffic for a multicast group. Groups may be joined
+        multiple times, and are only left when they've been left as many
+        times."""
+        with self.lock:
+            if group not in self.groups:
+                self.recvSocket.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(self.ANY))
+                self.groups[group] = 0
+            self.groups[group] += 1
+
+
+    def leaveGroup(self, group):
+        with self.lock:
+            if group not in self.groups:
+                return
+            self.groups[group] -= 1
+            if self.groups[group] == 0:
+                del self.groups[group]
+                self.recvSocket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(self.ANY))
 
 
     def kill(self):
         # Let the thread know it should commit suicide.
         with self.lock:
             self.die = True
+        self._wakeup()
 
 
-    def _send(self):
-        """Send all messages waiting to be sent in the outbox."""
+    def _wakeup(self):
+        """Wake up the thread if it's blocked in select()."""
+        try:
+            self.wakeupSocket.sendto('\x00', self.wakeupAddress)
+        except socket.error:
+            # The socket buffer is full (so the thread will wake up anyway)
+            # or the socket has already been closed (so there's no thread to
+            # wake up).
+            pass
+
+
+    def _getTimeout(self):
+        """The time to wait for incoming packets: until the coalesced
+        messages must be sent or until incomplete packets must be checked for
+        missing fragments, if any."""
+        if self._isSlicing():
+            # Only check for incoming packets in between slices.
+            return 0
+        timeout = self.SELECT_TIMEOUT
+        if self.coalesceDeadline is not None:
+            timeout = min(timeout, self.coalesceDeadline - time.time())
+        if self.nackDelay is not None and len(self.fragmentsBuffer):
+            timeout = min(timeout, self.nackDelay)
+        return max(0, timeout)
+
+
+    def _getPriority(self, message):
+        """The lane of a message in the outbox."""
+        return getattr(message, 'priority', LaneQueue.NORMAL)
 
+
+    def _isSlicing(self):
+        """Whether messages are being sent or received in slices."""
+        return len(self.receptions) > 0 or any(len(transmissions) for transmissions in self.transmissions)
+
+
+    def _isIdle(self):
+        """Whether all messages in the outbox have been sent."""
+        return self.outbox.qsize() == 0 and not any(len(transmissions) for transmissions in self.transmissions)
+
+
+    def _commitSuicideWhenIdle(self):
+        """Commit suicide when asked to, once all messages have been sent.
+        Returns whether it did."""
         with self.lock:
-            while self.outbox.qsize() > 0:
-                self._sendMessage(self.outbox.get())
+            die = self.die
+        if not die or not self._isIdle():
+            return False
+        self._flushCoalesced()
+        with self.lock:
+            self._commitSuicide()
+        return True
+
+
+    def _send(self):
+        """Send all messages of the CONTROL lane waiting to be sent in the
+        outbox, and a slice of the messages of the other lanes.
+        This doesn't acquire the lock: the outbox doesn't need it, and all
+        other state that is used to send (e.g. the messages being coalesced
+        and the sequence numbers) is only used by the thread that sends. So
+        encoding, compressing and sending never make other threads wait."""
+        while True:
+            try:
+                message = self.outbox.get()
+            except Queue.Empty:
+                break
+            priority = self._getPriority(message)
+            group    = None
+            if isinstance(message, GroupMessage):
+                message, group = message.message, message.group
+            if priority == LaneQueue.CONTROL:
+                self._sendMessage(message, group, self.FLAG_CONTROL)
+            else:
+                self.transmissions[priority].append(self._transmitMessage(message, group))
+        self._sendSlice()
+        if self.coalesceDeadline is not None and time.time() >= self.coalesceDeadline:
+            self._flushCoalesced()
+
 
+    def _sendSlice(self):
+        """Helper method for _send(). Send (at least) sliceSize bytes of
+        the messages of the NORMAL lane, and then of the BULK lane, in the
+        order they were taken from the outbox."""
+        budget = self.sliceSize
+        for transmissions in self.transmissions:
+            while budget > 0 and len(transmissions):
+                try:
+                    budget -= next(transmissions[0])
+                except StopIteration:
+                    transmissions.popleft()
+        if budget < self.sliceSize:
+            self.slicesSent += 1
 
-    def _sendMessage(self, message):
-        """Helper method for _send()."""
 
-        # First pickle the value so we get a string (the message may contain
+    def _transmitMessage(self, message, group=None):
+        """Helper method for _send(). A generator that sends a message of
+        the NORMAL or BULK lane: it yields the number of bytes that were
+        handled after every slice. Small messages are sent like any other
+        (and may be coalesced).
+        Encoding the message isn't sliced: the codec encodes a message in one
+        go."""
+        group = group or self.MCAST_GRP
+        data  = self.codec.encode(message)
+        if len(data) <= self.sliceSize:
+            self._sendEncodedMessage(data, group)
+            yield len(data)
+            return
+        self.messagesSent += 1
+        self.slicedMessagesSent += 1
+        self._flushCoalesced()
+        for size in self._transmitPacket(data, group, sliceSize=self.sliceSize):
+            yield size
+
+
+    def _sendMessage(self, message, group=None, flags=0):
+        """Helper method for _send(). Sends to MCAST_GRP when no group is
+        given."""
+        group = group or self.MCAST_GRP
+
+        # First encode the value so we get a string (the message may contain
         # *any* possible Python value).
         # (UDP doesn't do fragmentation and requires a fixed packet size and
         # thus we must handle fragmentation ourselves.)
-        data = cPickle.dumps(message)
+        self._sendEncodedMessage(self.codec.encode(message), group, flags)
+
+
+    def _sendEncodedMessage(self, data, group, flags=0):
+        """Helper method for _sendMessage() and _transmitMessage()."""
+        self.messagesSent += 1
+
+        # Small messages are coalesced when enabled. Other messages are sent
+        # right away, but not before the messages that are being coalesced,
+        # to preserve the order.
+        if self.coalesce and self.COALESCED_LENGTH.size + len(data) <= self.coalesceMaxSize:
+            self._coalesceMessage(data, group, flags)
+        else:
+            self._flushCoalesced()
+            self._sendPacket(data, group, flags)
+
+
+    def _coalesceMessage(self, data, group, flags=0):
+        """Helper method for _sendMessage(). Add an encoded message to the
+        messages being coalesced. Only messages for the same group and with
+        the same flags (i.e. CONTROL messages only with each other) are
+        coalesced."""
+        size = self.COALESCED_LENGTH.size + len(data)
+        if self.coalescedSize + size > self.coalesceMaxSize or group != self.coalescedGroup or flags != self.coalescedFlags:
+            self._flushCoalesced()
+        self.coalescedGroup = group
+        self.coalescedFlags = flags
+        self.coalescedMessages.append(self.COALESCED_LENGTH.pack(len(data)))
+        self.coalescedMessages.append(data)
+        self.coalescedSize += size
+        if self.coalesceDeadline is None:
+            self.coalesceDeadline = time.time() + self.coalesceMaxDelay
+
+
+    def _flushCoalesced(self):
+        """Send the messages being coalesced as a single packet."""
+        if len(self.coalescedMessages) == 0:
+            return
+        numMessages = len(self.coalescedMessages) / 2
+        if numMessages == 1:
+            # No need for the coalesced format.
+            self._sendPacket(self.coalescedMessages[1], self.coalescedGroup, self.coalescedFlags)
+        else:
+            self._sendPacket(''.join(self.coalescedMessages), self.coalescedGroup, self.coalescedFlags | self.FLAG_COALESCED)
+            self.messagesCoalesced += numMessages
+        self.coalescedMessages = []
+        self.coalescedSize     = 0
+        self.coalescedGroup    = None
+        self.coalescedFlags    = 0
+        self.coalesceDeadline  = None
+
+
+    def _sendPacket(self, data, group, flags=0):
+        """Helper method for _sendMessage(). Send an encoded packet."""
+        for size in self._transmitPacket(data, group, flags):
+            pass
+
+
+    def _transmitPacket(self, data, group, flags=0, sliceSize=None):
+        """Helper method for _sendPacket() and _transmitMessage(). A generator
+        that compresses and sends an encoded packet, and yields the number of
+        bytes that were handled after every slice of sliceSize bytes (the
+        entire packet when no slice size is given)."""
+        sliceSize = sliceSize or max(1, len(data))
+
+        # Compress large packets, so they need fewer fragments.
+        if self.compressThreshold is not None and len(data) >= self.compressThreshold:
+            compressor = zlib.compressobj(self.compressLevel)
+            chunks     = []
+            for offset in xrange(0, len(data), sliceSize):
+                start = time.time()
+                chunks.append(compressor.compress(buffer(data, offset, sliceSize)))
+                if offset + sliceSize >= len(data):
+                    chunks.append(compressor.flush())
+                self.compressionTime += time.time() - start
+                yield min(sliceSize, len(data) - offset)
+            compressed = ''.join(chunks)
+            if len(compressed) < len(data):
+                self.packetsCompressed += 1
+                self.bytesUncompressed += len(data)
+                self.bytesCompressed   += len(compressed)
+                data = compressed
+                flags |= self.FLAG_COMPRESSED
 
         # Fragment the data into multiple packets when there's too much data
-        # to fit in a single packet.
+        # to fit in a single packet. Fragments are memoryview slices, so the
+        # data is never copied.
         bytesData       = len(data)
         bytesFragmented = 0 # At the end, this must match the bytesData.
-        packetID        = str(uuid.uuid1()) # Generate a UUID for the packet.
-        numFragments    = int(math.ceil(1.0 * bytesData / self.FRAGMENT_DATA_SIZE))
+        numFragments    = int(math.ceil(1.0 * bytesData / self.fragmentDataSize))
         fragments       = []
-        # Ensure that the number of fragments does not exceed 10,000.
+        # Ensure that the number of fragments does not exceed 65,535.
         if numFragments > self.MAX_NUM_FRAGMENTS:
-            raise MessageTooLargeError, "Too many fragments were necessary to send the data: %d, while 10,000 is the limit." % (len(numFragments))
+            raise MessageTooLargeError, "Too many fragments were necessary to send the data: %d, while %d is the limit." % (numFragments, self.MAX_NUM_FRAGMENTS)
+        view = memoryview(data)
         for f in xrange(numFragments):
-            # Create the fragment ID.
-            fragmentID = self._createFragmentID(packetID, f, numFragments)
-            # Create the fragment data.
-            fragmentData = data[:self.FRAGMENT_DATA_SIZE]
+            fragmentData = view[f * self.fragmentDataSize:(f + 1) * self.fragmentDataSize]
             bytesFragmented += len(fragmentData)
-            # Combine the ID and the data into the actual fragment.
-            fragment = fragmentID + fragmentData
-            fragments.append(fragment)
-            # print 'FRAGMENT', fragmentID, ', fragment size:', len(fragment), ', bytes Fragmented:', bytesFragmented, ', more:', bytesFragmented < bytesData
-            # Update the remaining data that should be sent.
-            data = data[self.FRAGMENT_DATA_SIZE:]
+            fragments.append(fragmentData)
         # Ensure that all data is sent.
         if bytesFragmented != bytesData:
             raise SentIncompleteMessageError, "Not everything is sent, only %d bytes out of %d!" % (bytesFragmented, bytesData)
 
-        # Actually send all created fragments.
+        # Assign the next sequence number of the group to the packet.
+        sequenceNumber = self.sequenceNumbers.get(group, 0)
+        self.sequenceNumbers[group] = (sequenceNumber + 1) % 2**32
+
+        # Remember the fragments, so they can be resent when they're lost
+        # (also while the packet is still being sent in slices).
+        if numFragments > 1 and self.nackDelay is not None:
+            self._expireSentPackets(len(data))
+            self.sentPackets[(group, sequenceNumber)] = {
+                'group'     : group,
+                'flags'     : flags,
+                'fragments' : fragments,
+                'size'      : len(data),
+                'deadline'  : time.time() + self.retransmitTimeout,
+                'resent'    : {}, # Fragment index -> time of the last retransmission.
+            }
+            self.sentBytes += len(data)
+
+        # Actually send all created fragments, followed by the parity
+        # fragment of each group when forward error correction is enabled.
+        sliceSent = 0
+        for f in xrange(numFragments):
+            self._sendFragment(group, sequenceNumber, f, numFragments, fragments[f], flags)
+            if self.fecGroupSize is not None and numFragments > 1 \
+               and ((f + 1) % self.fecGroupSize == 0 or f == numFragments - 1):
+                parity = self._buildParity(fragments[f - f % self.fecGroupSize:f + 1])
+                self._sendFragment(group, sequenceNumber, f / self.fecGroupSize, numFragments, parity, flags | self.FLAG_PARITY)
+                self.parityFragmentsSent += 1
+            sliceSent += len(fragments[f])
+            if sliceSent >= sliceSize or f == numFragments - 1:
+                yield sliceSent
+                sliceSent = 0
+
+
+    def _buildParity(self, fragments):
+        """Helper method for _sendPacket(). Build the data of the parity
+        fragment for a group of fragments: the XOR of the fragments (padded
+        to the fragment size), computed as long integers."""
+        value   = 0
+        lengths = 0
         for fragment in fragments:
-            self.sendSocket.sendto(fragment, (self.MCAST_GRP, self.recvPort))
+            value   ^= int(binascii.hexlify(fragment.tobytes().ljust(self.fragmentDataSize, '\x00')), 16)
+            lengths ^= len(fragment)
+        parity = binascii.unhexlify('%0*x' % (2 * self.fragmentDataSize, value))
+        return self.PARITY_HEADER.pack(self.fecGroupSize, lengths) + parity
 
 
-    def _createFragmentID(self, packetID, fragmentSeqNum, numFragments):
-        return "%s%05d%05d" % (packetID, fragmentSeqNum, numFragments)
+    def _expireSentPackets(self, size=0):
+        """Forget about sent packets whose deadline has passed, and about the
+        least recently sent packets until size more bytes fit."""
+        now = time.time()
+        while len(self.sentPackets):
+            key = next(iter(self.sentPackets))
+            packet = self.sentPackets[key]
+            if packet['deadline'] > now and self.sentBytes + size <= self.retransmitMaxBytes:
+                break
+            del self.sentPackets[key]
+            self.sentBytes -= packet['size']
 
 
-    def _parseFragmentID(self, fragmentID):
-        """Parse a fragment ID. The first 32 characters are a UUID, the next 5
-        characters form an integer with leading zeros and indicate the
-        sequence number of the fragment and the final 5 characters also form
-        an integer with leading zeros but indciates the total number of
-        fragments for the packet."""
-        # print "\tparsed FRAGMENT ID", fragmentID, (fragmentID[0:36], int(fragmentID[36:41]), int(fragmentID[41:46]))
-        return (fragmentID[0:36], int(fragmentID[36:41]), int(fragmentID[41:46]))
+    def _sendNacks(self, now=None):
+        """Send a NACK for every incomplete packet that has stalled, listing
+        the fragments that are missing."""
+        if self.nackDelay is None:
+            return
+        maxIndices = (self.fragmentDataSize - self.NACK_HEADER.size) / self.NACK_INDEX.size
+        for (senderID, group, sequenceNumber), missing in self.fragmentsBuffer.stalled(self.nackDelay, self.NACK_MAX_RETRIES, now):
+            # When more fragments are missing than fit in a single NACK, the
+            # others will be requested by the next NACK.
+            missing = missing[:maxIndices]
+            nack = self.NACK_HEADER.pack(senderID, socket.inet_aton(group), sequenceNumber) + struct.pack('!%dH' % (len(missing)), *missing)
+            self._sendFragment(self.MCAST_GRP, 0, 0, 1, nack, self.FLAG_NACK)
+            self.nacksSent += 1
 
 
-    def _receive(self):
-        """Send all messages waiting to be sent in the outbox."""
+    def _receiveNack(self, data):
+        """Helper method for _receiveMessage(). Resend the fragments that are
+        listed in a NACK for a packet that we sent."""
+        if len(data) < self.NACK_HEADER.size or (len(data) - self.NACK_HEADER.size) % self.NACK_INDEX.size:
+            self.malformedDatagrams += 1
+            return
+        senderID, group, sequenceNumber = self.NACK_HEADER.unpack_from(data)
+        if senderID != self.senderID:
+            # A NACK for another host's packet.
+            return
+        self.nacksReceived += 1
+        self._expireSentPackets()
+        packet = self.sentPackets.get((socket.inet_ntoa(group), sequenceNumber))
+        if packet is None:
+            return
+        numFragments = len(packet['fragments'])
+        numIndices = (len(data) - self.NACK_HEADER.size) / self.NACK_INDEX.size
+        now = time.time()
+        for fragmentIndex in struct.unpack_from('!%dH' % (numIndices), data, self.NACK_HEADER.size):
+            if fragmentIndex >= numFragments:
+                continue
+            # Multiple hosts may miss the same fragment; resend it only once
+            # per NACK delay.
+            if packet['resent'].get(fragmentIndex, 0) > now - self.nackDelay / 2.0:
+                continue
+            packet['resent'][fragmentIndex] = now
+            self._sendFragment(packet['group'], sequenceNumber, fragmentIndex, numFragments, packet['fragments'][fragmentIndex], packet['flags'])
+            self.fragmentsResent += 1
+
+
+    def _sendFragment(self, group, sequenceNumber, fragmentIndex, numFragments, fragmentData, flags=0):
+        """Helper method for _sendMessage(). Combine the fragment header and
+        the fragment data into the (reused) send buffer and send it. Python 2
+        lacks sendmsg(), so we can't use scatter-gather I/O instead."""
+        size = self.FRAGMENT_HEADER_SIZE + len(fragmentData)
+        self.FRAGMENT_HEADER.pack_into(self.sendBuffer, 0,
+                                       self.FRAGMENT_MAGIC, self.FRAGMENT_VERSION, flags,
+                                       self.senderID, socket.inet_aton(group), sequenceNumber, fragmentIndex, numFragments)
+        self.sendBuffer[self.FRAGMENT_HEADER_SIZE:size] = fragmentData
+        self._sendDatagram(memoryview(self.sendBuffer)[:size], group)
+        self.datagramsSent += 1
+
+
+    def _sendDatagram(self, datagram, group):
+        """Send a single datagram to a multicast group."""
+        self.sendSocket.sendto(datagram, (group, self.recvPort))
 
-        # Check if there's input on the socket that we've bound for multicast
-        # traffic.
-        inputReady, outputReady, exceptReady = select.select([self.recvSocket], [], [], 0)
-        if self.recvSocket in inputReady:
-            for message in self._receiveMessage():
-                self.inbox.put(message)
 
+    def _parseFragmentHeader(self, data):
+        """Parse a fragment header. Returns a (flags, senderID, group,
+        sequenceNumber, fragmentIndex, numFragments) tuple.
+        Raises IncompatibleFragmentError for fragments sent by a different
+        version of this module and MalformedFragmentError for anything else
+        that isn't a valid fragment."""
+        if len(data) < self.FRAGMENT_HEADER_SIZE:
+            raise MalformedFragmentError, "fragment of %d bytes is too small" % (len(data))
+        magic, version, flags, senderID, group, sequenceNumber, fragmentIndex, numFragments = self.FRAGMENT_HEADER.unpack_from(data)
+        if magic != self.FRAGMENT_MAGIC:
+            # The original format started with a UUID in its text form, e.g.
+            # "01234567-89ab-cdef-0123-456789abcdef".
+            if len(data) >= self.LEGACY_FRAGMENT_ID_SIZE and data[8:9].tobytes() == data[13:14].tobytes() == '-':
+                raise IncompatibleFragmentError, "fragment with an ASCII fragment ID"
+            raise MalformedFragmentError, "unknown magic byte 0x%02X" % (magic)
+        if version != self.FRAGMENT_VERSION:
+            raise IncompatibleFragmentError, "fragment header version %d, while %d is supported" % (version, self.FRAGMENT_VERSION)
+        if not (0 <= fragmentIndex < numFragments <= self.MAX_NUM_FRAGMENTS):
+            raise MalformedFragmentError, "fragment %d of %d" % (fragmentIndex, numFragments)
+        return (flags, senderID, socket.inet_ntoa(group), sequenceNumber, fragmentIndex, numFragments)
 
-    def _receiveMessage(self):
+
+    def _receive(self, timeout=0):
+        """Receive messages and put them in the inbox. Blocks for at most
+        timeout seconds, or until the thread is woken up."""
+
+        # Wait until there's input on the socket that we've bound for
+        # multicast traffic, or on the wakeup socket.
         try:
-            data, addr = self.recvSocket.recvfrom(self.PACKET_SIZE)
-            #print 'RECEIVED MESSAGE FROM:', addr, addr[0] in self.memberships
-        except socket.error, e:
-            print 'Expection'
+            inputReady, outputReady, exceptReady = select.select([self.recvSocket, self.wakeupSocket], [], [], timeout)
+        except select.error:
+            # Interrupted by a signal.
+            return
+        if self.wakeupSocket in inputReady:
+            self._drainWakeups()
+
+        self._maintain()
+
+        if self.recvSocket in inputReady:
+            self._receiveDatagrams()
+        self._receiveSlice()
 
-        # Discard messages from hosts we're not interested in.
+
+    def _maintain(self):
+        """Request lost fragments again, and drop packets that will never be
+        completed because fragments were lost."""
+        self._sendNacks()
+        self.fragmentsBuffer.expire()
+
+
+    def _receiveDatagrams(self):
+        """Drain all datagrams that are waiting on the socket (up to the
+        batch size), so that bursts (e.g. the many fragments of a history
+        message) don't overflow the kernel's receive buffer."""
+        messages = []
+        numDatagrams = 0
+        while numDatagrams < self.receiveBatchSize:
+            try:
+                size, addr = self.recvSocket.recvfrom_into(self.recvBuffer)
+            except socket.error:
+                # No more datagrams are waiting.
+                break
+            numDatagrams += 1
+            messages.extend(self._receiveMessage(memoryview(self.recvBuffer)[:size], addr))
+
+        with self.lock:
+            self.wakeups += 1
+            self.datagramsReceived += numDatagrams
+            self.datagramsPerWakeup[numDatagrams] = self.datagramsPerWakeup.get(numDatagrams, 0) + 1
+        self._deliver(messages)
+
+
+    def _receiveSlice(self):
+        """Decompress (at least) sliceSize bytes of the packets that are
+        received in slices, and deliver the messages of the packets that
+        were completed, in the order the packets were received."""
+        messages = []
+        budget = self.sliceSize
+        while budget > 0 and len(self.receptions):
+            try:
+                size, decoded = next(self.receptions[0])
+            except StopIteration:
+                self.receptions.popleft()
+                continue
+            budget -= size
+            messages.extend(decoded)
+        self._deliver(messages)
+
+
+    def _deliver(self, messages):
+        """Pass all decoded messages to the message callback, or put them in
+        the inbox at once. The callback is called without holding the lock."""
+        if self.messageCallback is not None:
+            for message in messages:
+                self.messageCallback(message)
+        elif len(messages):
+            with self.lock:
+                for message in messages:
+                    self.inbox.put(message)
+                self.lock.notifyAll()
+
+
+    def _drainWakeups(self):
+        """Helper method for _receive(). Consume all pending wakeups."""
+        while True:
+            try:
+                self.wakeupSocket.recv(1)
+            except socket.error:
+                break
+
+
+    def _receiveMessage(self, data, addr):
+        """Helper method for _receive(). Process a single datagram and return
+        the list of messages that could be decoded from it (empty when the
+        datagram is a fragment of a packet that is not yet complete)."""
+
+        # Discard messages from hosts we're not interested in, before doing
+        # any work on them.
         # NOTE: this requires discovery of other hosts through another means
         # than IP multicast itself, e.g. zeroconf.
-        if addr[0] not in self.memberships:
-            pass
-        #print 'RECEIVED MESSAGE FROM:', addr, addr[0] in self.memberships
-
-        # Extract the fragment ID from the data.
-        fragmentID = data[:self.FRAGMENT_ID_SIZE]
-        data = data[self.FRAGMENT_ID_SIZE:]
-
-        # Parse the fragment ID.
-        packetID, sequenceNumber, totalNumber = self._parseFragmentID(fragmentID)
-
-        # Reassemble the packet.
-        packet = ""
-        if totalNumber > 1:
-            # Handle fragmentation.
-            if not self.fragmentsBuffer.has_key(packetID):
-                self.fragmentsBuffer[packetID] = {}
-            self.fragmentsBuffer[packetID][sequenceNumber] = data
-            # When we have all fragments of a packet, reassemble the packet.
-            if len(self.fragmentsBuffer[packetID]) == totalNumber:
-                for key in xrange(totalNumber):
-                    packet += self.fragmentsBuffer[packetID][key]
-                del self.fragmentsBuffer[packetID]
-        else:
-            # This packet consists of a single frame: no need to reassemble!
+        if self.filterSources and addr[0] not in self.sources:
+            self.unknownDatagrams += 1
+            return []
+
+        # Parse the fragment header. Keep track of hosts that run an
+        # incompatible version, so they can be detected.
+        try:
+            flags, senderID, group, sequenceNumber, fragmentIndex, totalNumber = self._parseFragmentHeader(data)
+        except IncompatibleFragmentError:
+            self.incompatibleDatagrams += 1
+            self.incompatibleHosts.add(addr[0])
+            return []
+        except MalformedFragmentError:
+            self.malformedDatagrams += 1
+            return []
+        data = data[self.FRAGMENT_HEADER_SIZE:]
+        packetID = (senderID, group, sequenceNumber)
+
+        if flags & self.FLAG_NACK:
+            self._receiveNack(data)
+            return []
+
+        # This packet consists of a single frame: no need to reassemble!
+        # Otherwise, handle fragmentation.
+        if flags & self.FLAG_PARITY:
+            if len(data) < self.PARITY_HEADER.size:
+                self.malformedDatagrams += 1
+                return []
+            groupSize, lengths = self.PARITY_HEADER.unpack_from(data)
+            packet = self.fragmentsBuffer.addParity(packetID, fragmentIndex, groupSize, totalNumber, lengths, data[self.PARITY_HEADER.size:])
+        elif totalNumber == 1:
             packet = data
+        else:
+            packet = self.fragmentsBuffer.add(packetID, fragmentIndex, totalNumber, data)
 
-        # Decode the message in the packet.
-        if packet != "":
-            with self.lock:
-                # WARNING: insecure! Global variables might be
-                # unpickled!
-                message = cPickle.loads(packet)
-                yield message
+        # When we have all fragments of a packet, decode the packet, unless
+        # it's a duplicate. Every group of a sender has its own sequence
+        # numbers.
+        if packet is None:
+            return []
+        if senderID not in self.peers:
+            self.peers[senderID] = (addr[0], {})
+        trackers = self.peers[senderID][1]
+        if group not in trackers:
+            trackers[group] = SequenceTracker()
+        if not trackers[group].add(sequenceNumber):
+            return []
+
+        # Large packets are decompressed in slices, and the packets that are
+        # received after them wait for them, except for CONTROL packets.
+        if not flags & self.FLAG_CONTROL and (len(self.receptions) or len(packet) > self.sliceSize):
+            if totalNumber == 1:
+                # Copy it out of the receive buffer, which is reused.
+                packet = memoryview(packet.tobytes())
+            self.receptions.append(self._decodePacket(packet, flags, self.sliceSize))
+            if len(packet) > self.sliceSize:
+                self.slicedPacketsReceived += 1
+            return []
+        for size, messages in self._decodePacket(packet, flags):
+            pass
+        return messages
+
+
+    def _decodePacket(self, packet, flags, sliceSize=None):
+        """Helper method for _receiveMessage() and _receiveSlice(). A
+        generator that decompresses (in slices of sliceSize bytes, the entire
+        packet when no slice size is given) and decodes a packet. It yields
+        the number of bytes that were handled and the messages that were
+        decoded (none until the last slice) after every slice."""
+        sliceSize = sliceSize or max(1, len(packet))
+        handled   = min(sliceSize, len(packet)) # In the last slice.
+        try:
+            if flags & self.FLAG_COMPRESSED:
+                decompressor = zlib.decompressobj()
+                chunks       = []
+                size         = 0
+                for offset in xrange(0, len(packet), sliceSize):
+                    chunks.append(self._decompress(decompressor, packet[offset:offset + sliceSize], size))
+                    size += len(chunks[-1])
+                    if offset + sliceSize < len(packet):
+                        yield sliceSize, []
+                    else:
+                        handled = len(packet) - offset
+                packet = ''.join(chunks)
+                self.packetsDecompressed += 1
+            if flags & self.FLAG_COALESCED:
+                messages = [self.codec.decode(message) for message in self._splitCoalesced(packet)]
+            else:
+                messages = [self.codec.decode(packet)]
+        except DecodeError:
+            self.malformedDatagrams += 1
+            messages = []
+        yield handled, messages
+
+
+    def _decompress(self, decompressor, data, size):
+        """Decompress a slice of a packet, of which size bytes have been
+        decompressed already. Packets that would decompress to more than the
+        maximum packet size are rejected."""
+        start = time.time()
+        try:
+            data = decompressor.decompress(data.tobytes(), self.maxPacketSize - size + 1)
+        except zlib.error, e:
+            raise DecodeError, "invalid compressed data: %s" % (e)
+        if size + len(data) > self.maxPacketSize:
+            raise DecodeError, "decompressed packet exceeds %d bytes" % (self.maxPacketSize)
+        self.decompressionTime += time.time() - start
+        return data
+
+
+    def _splitCoalesced(self, packet):
+        """Split a packet of coalesced messages into the encoded messages."""
+        messages = []
+        offset = 0
+        while offset < len(packet):
+            if offset + self.COALESCED_LENGTH.size > len(packet):
+                raise DecodeError, "truncated coalesced message length"
+            (length,) = self.COALESCED_LENGTH.unpack_from(packet, offset)
+            offset += self.COALESCED_LENGTH.size
+            if offset + length > len(packet):
+                raise DecodeError, "truncated coalesced message"
+            messages.append(packet[offset:offset + length])
+            offset += length
+        return messages
+
+
+    def stats(self):
+        """Statistics about the sent and received datagrams."""
+        with self.lock:
+            stats = {
+                'wakeups'                : self.wakeups,
+                'datagrams received'     : self.datagramsReceived,
+                'datagrams per wakeup'   : dict(self.datagramsPerWakeup), # Batch size -> number of wakeups.
+                'malformed datagrams'    : self.malformedDatagrams,
+                'incompatible datagrams' : self.incompatibleDatagrams,
+                'incompatible hosts'     : set(self.incompatibleHosts),
+                'datagrams sent'         : self.datagramsSent,
+                'messages sent'          : self.messagesSent,
+                'messages coalesced'     : self.messagesCoalesced,
+                'packets compressed'     : self.packetsCompressed,
+                'compression ratio'      : 1.0 * self.bytesCompressed / self.bytesUncompressed if self.bytesUncompressed else None,
+                'compression time'       : self.compressionTime,
+                'packets decompressed'   : self.packetsDecompressed,
+                'decompression time'     : self.decompressionTime,
+                'nacks sent'             : self.nacksSent,
+                'nacks received'         : self.nacksReceived,
+                'fragments resent'       : self.fragmentsResent,
+                'parity fragments sent'  : self.parityFragmentsSent,
+                'unknown datagrams'      : self.unknownDatagrams, # From hosts that aren't sources.
+                'messages per lane'      : self.outbox.stats()['taken per lane'],
+                'sliced messages sent'   : self.slicedMessagesSent,
+                'slices sent'            : self.slicesSent,
+                'sliced packets received': self.slicedPacketsReceived,
+            }
+            stats.update(self.fragmentsBuffer.stats())
+            stats['peers'] = self.peerStats()
+        return stats
+
+
+    def peerStats(self):
+        """Loss and reordering statistics per sender (a host may run
+        multiple senders), as seen by this receiver: the totals of the
+        groups that were received, and the statistics per group."""
+        peerStats = {}
+        for senderID, (host, trackers) in self.peers.items():
+            groups = dict((group, tracker.stats()) for (group, tracker) in trackers.items())
+            stats = {}
+            for key in ('packets received', 'packets lost', 'packets missing', 'packets duplicated', 'packets reordered'):
+                stats[key] = sum(groupStats[key] for groupStats in groups.values())
+            total = stats['packets lost'] + stats['packets received']
+            stats['loss rate'] = 1.0 * stats['packets lost'] / total if stats['packets received'] else 0.0
+            stats['host']      = host
+            stats['groups']    = groups
+            peerStats[str(uuid.UUID(bytes=senderID))] = stats
+        return peerStats
 
 
     def _commitSuicide(self):
@@ -257,13 +1128,18 @@ class IPMulticastMessaging(threading.Thread):
         calling this method.
         """
         # Drop memberships.
-        while len(self.memberships): # Tricky: we cannot simply iterate over the list because we're changing it!
-            host = self.memberships[0]
+        for host in list(self.memberships):
             self.unsubscribe(host)
 
+        # Leave groups.
+        for group in self.groups.keys():
+            self.recvSocket.setsockopt(socket.SOL_IP, socket.IP_DROP_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton(self.ANY))
+        self.groups = {}
+
         # Close sockets.
         self.sendSocket.close()
         self.recvSocket.close()
+        self.wakeupSocket.close()
 
         # Stop us from running any further.
         self.alive = False
@@ -271,6 +1147,97 @@ class IPMulticastMessaging(threading.Thread):
 
 
 
+class EventLoopIPMulticastMessaging(IPMulticastMessaging):
+    """IPMulticastMessaging without a thread of its own: it runs on an
+    EventLoop, which can be shared by many instances (e.g. many game sessions
+    in a single process). Decoded messages are passed to messageCallback (in
+    the loop's thread) when it is given, or put in the inbox otherwise."""
+
+    def __init__(self, loop, port, messageCallback=None, **kwargs):
+        super(EventLoopIPMulticastMessaging, self).__init__(port, messageCallback=messageCallback, **kwargs)
+        self.loop          = loop
+        self.sendScheduled = False
+        self.timer         = None # Timer for the next _maintain() and coalescing deadline.
+        self.dead          = threading.Event()
+
+
+    def start(self):
+        """Start receiving and sending on the loop (instead of a thread)."""
+        self.loop.callSoon(self._start)
+
+
+    def join(self, timeout=None):
+        self.dead.wait(timeout)
+
+
+    def isAlive(self):
+        return self.alive and not self.dead.is_set()
+
+
+    def _start(self):
+        self.loop.addReader(self.recvSocket, self._onReadable)
+        self._onWakeup()
+
+
+    def _wakeup(self):
+        """Send the outbox in the loop's thread. Called whenever a message is
+        put in the outbox, from any thread: only schedule a single send.
+        This doesn't acquire the lock: the flag is only cleared before the
+        outbox is sent, so a message is never left behind, and at worst a
+        send is scheduled twice."""
+        if self.sendScheduled:
+            return
+        self.sendScheduled = True
+        self.loop.callSoon(self._onWakeup)
+
+
+    def _onWakeup(self):
+        self.sendScheduled = False
+        if not self.alive:
+            return
+        self._send()
+        if not self._commitSuicideWhenIdle():
+            self._schedule()
+
+
+    def _onReadable(self):
+        self._receiveDatagrams()
+        self._receiveSlice()
+        self._schedule()
+
+
+    def _onTimer(self):
+        self.timer = None
+        # Sends the coalesced messages when their deadline has passed, and
+        # the next slice of the messages that are sent and received in
+        # slices.
+        self._send()
+        self._maintain()
+        self._receiveSlice()
+        if not self._commitSuicideWhenIdle():
+            self._schedule()
+
+
+    def _schedule(self):
+        """Make sure the timer fires no later than _getTimeout() says."""
+        timeout = self._getTimeout()
+        if self.timer is not None:
+            if self.timer.deadline <= time.time() + timeout:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.callLater(timeout, self._onTimer)
+
+
+    def _commitSuicide(self):
+        self.loop.removeReader(self.recvSocket)
+        if self.timer is not None:
+            self.timer.cancel()
+        super(EventLoopIPMulticastMessaging, self)._commitSuicide()
+        self.dead.set()
+
+
+
+
 if __name__ == "__main__":
     import time
     import platform
@@ -0,0 +1,483 @@
+"""Benchmarks for IPMulticastMessaging.
+
+IP multicast traffic is sent to ourselves over the loopback interface, so that
+the benchmarks can run on a single host without any multicast routing.
+"""
+
+
+import math
+import os
+import random
+import threading
+import time
+from optparse import OptionParser
+
+from Codec_benchmark import buildPackets
+from EventLoop import EventLoop
+from IPMulticastMessaging import IPMulticastMessaging, EventLoopIPMulticastMessaging
+
+
+
+
+class LoopbackIPMulticastMessaging(IPMulticastMessaging):
+    """Sends all datagrams to our own receive socket over the loopback
+    interface instead of to the multicast group."""
+
+    def _sendDatagram(self, datagram, group):
+        self.sendSocket.sendto(datagram, ('127.0.0.1', self.recvPort))
+
+
+class LoopbackEventLoopIPMulticastMessaging(EventLoopIPMulticastMessaging):
+
+    def _sendDatagram(self, datagram, group):
+        self.sendSocket.sendto(datagram, ('127.0.0.1', self.recvPort))
+
+
+class CapturingIPMulticastMessaging(IPMulticastMessaging):
+    """Captures all datagrams in a list instead of sending them, so the
+    fragmentation and reassembly code can be benchmarked without sockets."""
+
+    def __init__(self, *args, **kwargs):
+        super(CapturingIPMulticastMessaging, self).__init__(*args, **kwargs)
+        self.datagrams = []
+
+    def _sendDatagram(self, datagram, group):
+        self.datagrams.append(datagram.tobytes())
+
+
+class LossyIPMulticastMessaging(IPMulticastMessaging):
+    """Delivers all datagrams directly to a receiver, over a simulated
+    Ethernet link that loses a fraction loss of the frames, in bursts of on
+    average burst frames. Datagrams that don't fit in a single frame are
+    fragmented by the IP layer, and are lost when any of their frames is
+    lost."""
+
+    MTU = 1500
+
+    def __init__(self, receiver, loss, seed=0, burst=1, *args, **kwargs):
+        super(LossyIPMulticastMessaging, self).__init__(*args, **kwargs)
+        self.receiver = receiver
+        self.loss     = loss
+        self.random   = random.Random(seed)
+        # Two-state (Gilbert) loss model: all frames are lost in the bad
+        # state, which lasts burst frames on average.
+        self.leaveBad  = 1.0 / burst
+        self.enterBad  = loss * self.leaveBad / (1 - loss)
+        self.bad       = False
+        self.frames   = 0
+        self.lost     = 0
+        self.bytesSent      = 0
+        self.bytesDelivered = 0
+
+    def _sendDatagram(self, datagram, group):
+        # IP fragments carry up to MTU - 20 bytes, the first one includes the
+        # UDP header.
+        numFrames = int(math.ceil((len(datagram) + 8) / (self.MTU - 20.0)))
+        self.frames += numFrames
+        self.bytesSent += len(datagram)
+        lost = False
+        for i in xrange(numFrames):
+            if self.bad:
+                self.bad = self.random.random() >= self.leaveBad
+            else:
+                self.bad = self.random.random() < self.enterBad
+            if self.bad:
+                self.lost += 1
+                lost = True
+        if not lost:
+            self.bytesDelivered += len(datagram)
+            addr = ('127.0.0.1', self.sendPort)
+            self.receiver.inbox.queue.extend(receiveDatagram(self.receiver, datagram.tobytes(), addr))
+
+
+class PollingIPMulticastMessaging(LoopbackIPMulticastMessaging):
+    """The original event loop: poll the sockets 50 times per second and
+    handle at most one datagram per iteration."""
+
+    def run(self):
+        while self.alive:
+            self._send()
+            self._receive(0)
+
+            with self.lock:
+                if self.die and self.outbox.qsize() == 0:
+                    self._commitSuicide()
+
+            time.sleep(0.02)
+
+
+
+class PollingConsumer(threading.Thread):
+    """Moves the messages out of an inbox 20 times per second, like
+    OneToManyService.run() does, and records their latency."""
+
+    def __init__(self, mc, latencies):
+        super(PollingConsumer, self).__init__()
+        self.mc        = mc
+        self.latencies = latencies
+        self.alive     = True
+
+    def run(self):
+        while self.alive:
+            with self.mc.lock:
+                while self.mc.inbox.qsize() > 0:
+                    message = self.mc.inbox.get()
+                    self.latencies.append(time.time() - message['timestamp'])
+            time.sleep(0.05)
+
+
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values."""
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def receiveDatagram(mc, datagram, addr):
+    """Let mc receive a datagram like its thread does, and decode the packets
+    that are received in slices right away. Returns the decoded messages."""
+    messages = mc._receiveMessage(memoryview(datagram), addr)
+    while len(mc.receptions):
+        mc._receiveSlice()
+    while mc.inbox.qsize() > 0:
+        messages.append(mc.inbox.get())
+    return messages
+
+
+def waitForMessages(mc, count, timeout):
+    """Wait until count messages have been received or the timeout expires.
+    Returns a list of (message, receive time) tuples."""
+    received = []
+    endTime = time.time() + timeout
+    with mc.lock:
+        while len(received) < count and time.time() < endTime:
+            while mc.inbox.qsize() == 0 and time.time() < endTime:
+                mc.lock.wait(0.5)
+            while mc.inbox.qsize() > 0:
+                received.append((mc.inbox.get(), time.time()))
+    return received
+
+
+def benchmarkThroughput(cls, count, timeout, **kwargs):
+    """Enqueue count messages at once and measure how many messages per
+    second are received."""
+    mc = cls(port=0, **kwargs)
+    mc.start()
+    try:
+        start = time.time()
+        for i in xrange(count):
+            mc.outbox.put({'seq' : i, 'timestamp' : time.time()})
+        received = waitForMessages(mc, count, timeout)
+        duration = time.time() - start
+    finally:
+        mc.kill()
+        mc.join()
+    return len(received), len(received) / duration, mc.stats()
+
+
+def benchmarkLatency(cls, count, interval, timeout, **kwargs):
+    """Send count messages, one every interval seconds, and measure the
+    latency of each message (time between enqueueing and receiving)."""
+    mc = cls(port=0, **kwargs)
+    mc.start()
+    latencies = []
+    try:
+        for i in xrange(count):
+            mc.outbox.put({'seq' : i, 'timestamp' : time.time()})
+            for message, receiveTime in waitForMessages(mc, 1, timeout):
+                latencies.append(receiveTime - message['timestamp'])
+            time.sleep(interval)
+    finally:
+        mc.kill()
+        mc.join()
+    return latencies
+
+
+def benchmarkFragmentation(size, repeat):
+    """Fragment and reassemble a message of size bytes. Returns the time per
+    message (in seconds) for fragmentation and reassembly."""
+    mc = CapturingIPMulticastMessaging(port=0, compressThreshold=None)
+    try:
+        message = 'x' * size
+        start = time.time()
+        for i in xrange(repeat):
+            mc._sendMessage(message)
+        fragmentationTime = (time.time() - start) / repeat
+
+        addr = ('127.0.0.1', mc.recvPort)
+        start = time.time()
+        for datagram in mc.datagrams:
+            for received in receiveDatagram(mc, datagram, addr):
+                assert len(received) == size
+        reassemblyTime = (time.time() - start) / repeat
+    finally:
+        mc._commitSuicide()
+    return fragmentationTime, reassemblyTime
+
+
+def benchmarkCompression(packet, compressThreshold, repeat):
+    """Send a packet repeat times. Returns the number of datagrams and bytes
+    per packet, and the time per packet (in seconds) for sending and
+    receiving it."""
+    mc = CapturingIPMulticastMessaging(port=0, compressThreshold=compressThreshold)
+    try:
+        start = time.time()
+        for i in xrange(repeat):
+            mc._sendMessage(packet)
+        sendTime = (time.time() - start) / repeat
+
+        addr = ('127.0.0.1', mc.recvPort)
+        start = time.time()
+        for datagram in mc.datagrams:
+            receiveDatagram(mc, datagram, addr)
+        receiveTime = (time.time() - start) / repeat
+    finally:
+        mc._commitSuicide()
+    numBytes = sum(len(datagram) for datagram in mc.datagrams)
+    return len(mc.datagrams) / repeat, numBytes / repeat, sendTime, receiveTime
+
+
+def benchmarkLoss(packetSize, loss, size, count):
+    """Send count messages of size bytes over a lossy link. Returns the
+    fraction of the data and of the messages that was delivered, and the
+    number of bytes that was lost per lost frame."""
+    receiver = IPMulticastMessaging(port=0)
+    sender = LossyIPMulticastMessaging(receiver, loss, 0, port=0, packetSize=packetSize, compressThreshold=None)
+    try:
+        message = os.urandom(size)
+        for i in xrange(count):
+            sender._sendMessage(message)
+    finally:
+        sender._commitSuicide()
+        receiver._commitSuicide()
+    dataDelivered = 1.0 * sender.bytesDelivered / sender.bytesSent
+    bytesPerLostFrame = 1.0 * (sender.bytesSent - sender.bytesDelivered) / max(1, sender.lost)
+    return dataDelivered, 1.0 * receiver.inbox.qsize() / count, bytesPerLostFrame
+
+
+def benchmarkRetransmission(loss, size, count, nackDelay):
+    """Send count messages of size bytes over a lossy link in both
+    directions, and let the receiver request lost fragments (when nackDelay
+    is not None). Returns the fraction of the messages that was delivered and
+    the number of extra datagrams (NACKs and resent fragments) relative to
+    the number of datagrams needed without losses."""
+    receiver = LossyIPMulticastMessaging(None, loss, 1, port=0, nackDelay=nackDelay)
+    sender = LossyIPMulticastMessaging(receiver, loss, 0, port=0, compressThreshold=None)
+    receiver.receiver = sender
+    try:
+        message = os.urandom(size)
+        datagrams = 0
+        for i in xrange(count):
+            before = sender.datagramsSent
+            sender._sendMessage(message)
+            datagrams += sender.datagramsSent - before
+
+            # Let the receiver send NACKs for stalled packets every 50
+            # messages, like its thread would.
+            if nackDelay is not None and ((i + 1) % 50 == 0 or i == count - 1):
+                for j in xrange(receiver.NACK_MAX_RETRIES + 1):
+                    time.sleep(nackDelay)
+                    receiver._sendNacks()
+        extra = sender.datagramsSent - datagrams + receiver.datagramsSent
+    finally:
+        sender._commitSuicide()
+        receiver._commitSuicide()
+    return 1.0 * receiver.inbox.qsize() / count, 1.0 * extra / datagrams
+
+
+def benchmarkForwardErrorCorrection(loss, burst, size, count, fecGroupSize):
+    """Send count messages of size bytes over a lossy link, with parity
+    fragments for every fecGroupSize fragments (None: no parity). Returns the
+    fraction of the messages that was delivered, the overhead of the parity
+    fragments and the time spent per message on sending and receiving."""
+    receiver = IPMulticastMessaging(port=0)
+    sender = LossyIPMulticastMessaging(receiver, loss, 0, burst, port=0, compressThreshold=None, fecGroupSize=fecGroupSize)
+    try:
+        message = os.urandom(size)
+        start = time.time()
+        for i in xrange(count):
+            sender._sendMessage(message)
+        duration = (time.time() - start) / count
+        stats = sender.stats()
+    finally:
+        sender._commitSuicide()
+        receiver._commitSuicide()
+    overhead = 1.0 * stats['parity fragments sent'] / (stats['datagrams sent'] - stats['parity fragments sent'])
+    return 1.0 * receiver.inbox.qsize() / count, overhead, duration
+
+
+def benchmarkSessions(eventLoop, numSessions, count, interval, idleTime, timeout):
+    """Run numSessions sessions in this process: each with a thread for
+    IPMulticastMessaging and a polling consumer thread, or all of them on a
+    single EventLoop. Every session sends count messages to itself, one
+    every interval seconds. Returns the latencies, the number of threads and
+    the CPU time used per second while all sessions are idle."""
+    latencies = []
+    if eventLoop:
+        loop = EventLoop()
+        loop.start()
+        received = lambda message: latencies.append(time.time() - message['timestamp'])
+        sessions  = [LoopbackEventLoopIPMulticastMessaging(loop, 0, messageCallback=received) for i in xrange(numSessions)]
+        consumers = []
+    else:
+        sessions  = [LoopbackIPMulticastMessaging(port=0) for i in xrange(numSessions)]
+        consumers = [PollingConsumer(mc, latencies) for mc in sessions]
+    for thread in sessions + consumers:
+        thread.start()
+    try:
+        numThreads = threading.active_count()
+
+        # Let all sessions settle, then measure the CPU time while idle.
+        time.sleep(0.5)
+        before = os.times()
+        time.sleep(idleTime)
+        after = os.times()
+        idleCPU = ((after[0] - before[0]) + (after[1] - before[1])) / idleTime
+
+        for i in xrange(count):
+            for mc in sessions:
+                mc.outbox.put({'seq' : i, 'timestamp' : time.time()})
+            time.sleep(interval)
+        endTime = time.time() + timeout
+        while len(latencies) < count * numSessions and time.time() < endTime:
+            time.sleep(0.01)
+    finally:
+        for consumer in consumers:
+            consumer.alive = False
+            consumer.join()
+        for mc in sessions:
+            mc.kill()
+            mc.join()
+        if eventLoop:
+            loop.kill()
+            loop.join()
+    return latencies, numThreads, idleCPU
+
+
+def runLoopBenchmarks(options):
+    print "%-10s %10s %12s %10s %10s" % ('loop', 'received', 'messages/s', 'p50 (ms)', 'p99 (ms)')
+    for name, cls in (('polling', PollingIPMulticastMessaging), ('select', LoopbackIPMulticastMessaging)):
+        received, rate, stats = benchmarkThroughput(cls, options.messages, options.timeout)
+        latencies = benchmarkLatency(cls, options.messages, options.interval, options.timeout)
+        print "%-10s %10d %12.1f %10.2f %10.2f" % (name, received, rate,
+                                                   percentile(latencies, 50) * 1000,
+                                                   percentile(latencies, 99) * 1000)
+
+
+def runFragmentationBenchmarks(options):
+    print "%-10s %18s %18s" % ('size (MB)', 'fragment (ms/MB)', 'reassemble (ms/MB)')
+    for megabytes in (1, 2, 4, 8, 16):
+        fragmentationTime, reassemblyTime = benchmarkFragmentation(megabytes * 1024 * 1024, options.repeat)
+        print "%-10d %18.2f %18.2f" % (megabytes,
+                                       fragmentationTime * 1000 / megabytes,
+                                       reassemblyTime * 1000 / megabytes)
+
+
+
+def runCoalescingBenchmarks(options):
+    print "%-12s %12s %12s %12s %10s %10s" % ('coalescing', 'messages/s', 'datagrams', 'datagrams/s', 'p50 (ms)', 'p99 (ms)')
+    for name, coalesce in (('off', False), ('on', True)):
+        start = time.time()
+        received, rate, stats = benchmarkThroughput(LoopbackIPMulticastMessaging, options.messages, options.timeout, coalesce=coalesce)
+        duration = time.time() - start
+        latencies = benchmarkLatency(LoopbackIPMulticastMessaging, options.messages, options.interval, options.timeout, coalesce=coalesce)
+        print "%-12s %12.1f %12d %12.1f %10.2f %10.2f" % (name, rate, stats['datagrams sent'],
+                                                          stats['datagrams sent'] / duration,
+                                                          percentile(latencies, 50) * 1000,
+                                                          percentile(latencies, 99) * 1000)
+
+
+
+def runCompressionBenchmarks(options):
+    print "%-14s %-12s %10s %10s %10s %12s" % ('history moves', 'compression', 'datagrams', 'bytes', 'send (ms)', 'receive (ms)')
+    for historySize in (200, 5000, 50000):
+        name, packet = buildPackets(historySize)[-1]
+        for compression, compressThreshold in (('off', None), ('on', IPMulticastMessaging.COMPRESS_THRESHOLD)):
+            numDatagrams, numBytes, sendTime, receiveTime = benchmarkCompression(packet, compressThreshold, options.repeat)
+            print "%-14d %-12s %10d %10d %10.2f %12.2f" % (historySize, compression, numDatagrams, numBytes,
+                                                          sendTime * 1000, receiveTime * 1000)
+
+
+
+def runLossBenchmarks(options):
+    size = 32 * 1024
+    print "%d messages of %d bytes" % (options.messages, size)
+    print "%-8s %-12s %14s %20s %18s" % ('loss', 'packet size', 'data delivered', 'bytes per lost frame', 'messages delivered')
+    for loss in (0.001, 0.01, 0.05):
+        for packetSize in (IPMulticastMessaging.PACKET_SIZE, 9000 - 28, 16000, 32000, 64000):
+            dataDelivered, messagesDelivered, bytesPerLostFrame = benchmarkLoss(packetSize, loss, size, options.messages)
+            print "%-8s %-12d %13.1f%% %20d %17.1f%%" % ('%.1f%%' % (loss * 100), packetSize, dataDelivered * 100,
+                                                         bytesPerLostFrame, messagesDelivered * 100)
+
+
+
+def runRetransmissionBenchmarks(options):
+    size = 64 * 1024
+    print "%d messages of %d bytes" % (options.messages, size)
+    print "%-8s %-6s %18s %18s" % ('loss', 'nacks', 'messages delivered', 'extra datagrams')
+    for loss in (0.01, 0.05, 0.1):
+        for nacks, nackDelay in (('off', None), ('on', IPMulticastMessaging.NACK_DELAY)):
+            messagesDelivered, extra = benchmarkRetransmission(loss, size, options.messages, nackDelay)
+            print "%-8s %-6s %17.1f%% %17.1f%%" % ('%.1f%%' % (loss * 100), nacks, messagesDelivered * 100, extra * 100)
+
+
+
+def runForwardErrorCorrectionBenchmarks(options):
+    size = 16 * 1024
+    print "%d messages of %d bytes, without NACKs" % (options.messages, size)
+    print "%-8s %-6s %-6s %18s %10s %10s" % ('loss', 'burst', 'group', 'messages delivered', 'overhead', 'time (ms)')
+    for loss, burst in ((0.01, 1), (0.05, 1), (0.05, 2), (0.1, 1)):
+        for fecGroupSize in (None, 16, 8, 4):
+            messagesDelivered, overhead, duration = benchmarkForwardErrorCorrection(loss, burst, size, options.messages, fecGroupSize)
+            print "%-8s %-6d %-6s %17.1f%% %9.1f%% %10.2f" % ('%.1f%%' % (loss * 100), burst, fecGroupSize or '-',
+                                                              messagesDelivered * 100, overhead * 100, duration * 1000)
+
+
+
+
+def runSessionsBenchmarks(options):
+    numSessions = 100
+    count = options.messages / 10
+    print "%d sessions, %d messages per session" % (numSessions, count)
+    print "%-12s %10s %10s %10s %8s %14s" % ('backend', 'received', 'p50 (ms)', 'p99 (ms)', 'threads', 'idle CPU (%)')
+    for name, eventLoop in (('threads', False), ('event loop', True)):
+        latencies, numThreads, idleCPU = benchmarkSessions(eventLoop, numSessions, count, options.interval * 10, 2.0, options.timeout)
+        print "%-12s %10d %10.2f %10.2f %8d %14.1f" % (name, len(latencies),
+                                                       percentile(latencies, 50) * 1000,
+                                                       percentile(latencies, 99) * 1000,
+                                                       numThreads, idleCPU * 100)
+
+
+
+
+BENCHMARKS = {
+    'loop'          : runLoopBenchmarks,
+    'fragmentation' : runFragmentationBenchmarks,
+    'coalescing'    : runCoalescingBenchmarks,
+    'compression'   : runCompressionBenchmarks,
+    'loss'          : runLossBenchmarks,
+    'retransmission': runRetransmissionBenchmarks,
+    'fec'           : runForwardErrorCorrectionBenchmarks,
+    'sessions'      : runSessionsBenchmarks,
+}
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--messages", type="int", dest="messages", default=200,
+                      help="number of messages to send per benchmark")
+    parser.add_option("-i", "--interval", type="float", dest="interval", default=0.005,
+                      help="time between messages in the latency benchmark (seconds)")
+    parser.add_option("-t", "--timeout", type="float", dest="timeout", default=30,
+                      help="maximum time to wait for messages (seconds)")
+    parser.add_option("-r", "--repeat", type="int", dest="repeat", default=3,
+                      help="number of repetitions for the fragmentation and compression benchmarks")
+    parser.usage = "%%prog [options] [%s]" % '|'.join(sorted(BENCHMARKS.keys()))
+    (options, args) = parser.parse_args()
+
+    for name in args or sorted(BENCHMARKS.keys()):
+        print "== %s ==" % name
+        BENCHMARKS[name](options)
+        print
@@ -0,0 +1,587 @@
+import os
+import Queue
+import time
+import unittest
+import uuid
+
+
+from EventLoop import EventLoop
+from IPMulticastMessaging import *
+from LaneQueue import LaneQueue
+
+
+
+
+class LoopbackIPMulticastMessaging(IPMulticastMessaging):
+    """Sends all datagrams to our own receive socket over the loopback
+    interface, so the tests don't depend on multicast routing."""
+
+    def _sendDatagram(self, datagram, group):
+        self.sendSocket.sendto(datagram, ('127.0.0.1', self.recvPort))
+
+
+
+
+class LoopbackEventLoopIPMulticastMessaging(EventLoopIPMulticastMessaging):
+
+    def _sendDatagram(self, datagram, group):
+        self.sendSocket.sendto(datagram, ('127.0.0.1', self.recvPort))
+
+
+
+
+class IPMulticastMessagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mc = LoopbackIPMulticastMessaging(port=0)
+        self.mc.start()
+
+
+    def tearDown(self):
+        self.mc.kill()
+        self.mc.join(5)
+
+
+    def receive(self, count, timeout=5):
+        """Wait for count messages to arrive in the inbox."""
+        messages = []
+        endTime = time.time() + timeout
+        with self.mc.lock:
+            while len(messages) < count and time.time() < endTime:
+                if self.mc.inbox.qsize() == 0:
+                    self.mc.lock.wait(0.1)
+                while self.mc.inbox.qsize() > 0:
+                    messages.append(self.mc.inbox.get())
+        return messages
+
+
+    def testSimpleMessage(self):
+        self.mc.outbox.put({'type' : 'test', 'value' : 42})
+        self.assertEqual(self.receive(1), [{'type' : 'test', 'value' : 42}])
+
+
+    def testManyMessages(self):
+        for i in xrange(100):
+            self.mc.outbox.put(i)
+        self.assertEqual(sorted(self.receive(100)), range(100))
+
+
+    def testFragmentedMessage(self):
+        message = ''.join(chr(ord('a') + i % 26) for i in xrange(3 * self.mc.fragmentDataSize))
+        self.mc.compressThreshold = None
+        self.mc.outbox.put(message)
+        self.assertEqual(self.receive(1), [message])
+
+
+    def testKillWakesUpThread(self):
+        start = time.time()
+        self.mc.kill()
+        self.mc.join(5)
+        self.assertFalse(self.mc.isAlive())
+        self.assertTrue(time.time() - start < self.mc.SELECT_TIMEOUT)
+
+
+    def testMessageCallback(self):
+        received = Queue.Queue()
+        mc = LoopbackIPMulticastMessaging(port=0, messageCallback=received.put)
+        mc.start()
+        try:
+            mc.outbox.put({'type' : 'test', 'value' : 42})
+            self.assertEqual(received.get(True, 5), {'type' : 'test', 'value' : 42})
+            self.assertEqual(mc.inbox.qsize(), 0)
+        finally:
+            mc.kill()
+            mc.join(5)
+
+
+
+
+class IPMulticastMessagingReceiveTest(unittest.TestCase):
+    """Tests that drive the messaging layer by hand, without its thread."""
+
+    def setUp(self):
+        self.mc = LoopbackIPMulticastMessaging(port=0, receiveBatchSize=16)
+
+
+    def tearDown(self):
+        self.mc._commitSuicide()
+
+
+    def testBatchDrain(self):
+        for i in xrange(20):
+            self.mc._sendMessage(i)
+        time.sleep(0.1)
+
+        # A single wakeup reads at most receiveBatchSize datagrams.
+        self.mc._receive(1)
+        self.assertEqual(self.mc.inbox.qsize(), 16)
+        self.mc._receive(1)
+        self.assertEqual(self.mc.inbox.qsize(), 20)
+        self.assertEqual([self.mc.inbox.get() for i in xrange(20)], range(20))
+
+        stats = self.mc.stats()
+        self.assertEqual(stats['wakeups'], 2)
+        self.assertEqual(stats['datagrams received'], 20)
+        self.assertEqual(stats['datagrams per wakeup'], {16 : 1, 4 : 1})
+
+
+    def testReassemblyOutOfOrder(self):
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        message = ''.join(chr(ord('a') + i % 26) for i in xrange(5 * self.mc.fragmentDataSize))
+        self.mc.compressThreshold = None
+        self.mc._sendMessage(message)
+        self.assertEqual(len(datagrams), 6)
+
+        # Deliver the fragments in reverse order, with a duplicate.
+        addr = ('127.0.0.1', self.mc.recvPort)
+        datagrams.reverse()
+        datagrams.insert(1, datagrams[0])
+        messages = []
+        for datagram in datagrams:
+            messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages, [message])
+        self.assertEqual(len(self.mc.fragmentsBuffer), 0)
+
+
+    def testRetransmission(self):
+        """Test that lost fragments are requested with a NACK and resent."""
+        sender = LoopbackIPMulticastMessaging(port=0, compressThreshold=None)
+        try:
+            sent = []
+            sender._sendDatagram = lambda datagram, group: sent.append(datagram.tobytes())
+            nacks = []
+            self.mc._sendDatagram = lambda datagram, group: nacks.append(datagram.tobytes())
+            message = ''.join(chr(ord('a') + i % 26) for i in xrange(5 * sender.fragmentDataSize))
+            sender._sendMessage(message)
+            self.assertEqual(len(sent), 6)
+
+            # Fragments 1 and 4 are lost.
+            addr = ('127.0.0.1', sender.recvPort)
+            for f in (0, 2, 3, 5):
+                self.assertEqual(self.mc._receiveMessage(memoryview(sent[f]), addr), [])
+            self.mc._sendNacks(time.time() + self.mc.nackDelay)
+            self.assertEqual(len(nacks), 1)
+
+            # The sender only resends the missing fragments, once.
+            del sent[:]
+            sender._receiveMessage(memoryview(nacks[0]), ('127.0.0.1', self.mc.recvPort))
+            sender._receiveMessage(memoryview(nacks[0]), ('127.0.0.1', self.mc.recvPort))
+            self.assertEqual(len(sent), 2)
+            self.assertEqual(self.mc._receiveMessage(memoryview(sent[0]), addr), [])
+            self.assertEqual(self.mc._receiveMessage(memoryview(sent[1]), addr), [message])
+
+            self.assertEqual(self.mc.stats()['nacks sent'], 1)
+            self.assertEqual(self.mc.stats()['packets recovered'], 1)
+            self.assertEqual(sender.stats()['nacks received'], 2)
+            self.assertEqual(sender.stats()['fragments resent'], 2)
+        finally:
+            sender._commitSuicide()
+
+
+    def testForwardErrorCorrection(self):
+        """Test that a lost fragment per group is reconstructed from the
+        parity fragments."""
+        sender = LoopbackIPMulticastMessaging(port=0, compressThreshold=None, fecGroupSize=4)
+        try:
+            sent = []
+            sender._sendDatagram = lambda datagram, group: sent.append(datagram.tobytes())
+            message = ''.join(chr(ord('a') + i % 26) for i in xrange(5 * sender.fragmentDataSize + 100))
+            sender._sendMessage(message)
+            # 6 fragments and 2 parity fragments, each of which fits in a
+            # packet.
+            self.assertEqual(len(sent), 8)
+            self.assertEqual(max(len(datagram) for datagram in sent), sender.packetSize)
+            self.assertEqual(sender.stats()['parity fragments sent'], 2)
+        finally:
+            sender._commitSuicide()
+
+        # Fragment 2 and the last fragment are lost, the parity fragments
+        # arrive before and after the other fragments of their group.
+        addr = ('127.0.0.1', sender.recvPort)
+        messages = []
+        for i in (4, 0, 1, 3, 7, 5):
+            messages.extend(self.mc._receiveMessage(memoryview(sent[i]), addr))
+        self.assertEqual(messages, [message])
+        self.assertEqual(self.mc.stats()['fragments reconstructed'], 2)
+
+
+    def testPeerStats(self):
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        for i in xrange(5):
+            self.mc._sendMessage(i)
+
+        # Packet 1 is lost, 3 and 4 are reordered, 0 is duplicated.
+        addr = ('127.0.0.1', self.mc.recvPort)
+        messages = []
+        for i in (0, 2, 4, 3, 0):
+            messages.extend(self.mc._receiveMessage(memoryview(datagrams[i]), addr))
+        self.assertEqual(messages, [0, 2, 4, 3])
+
+        peerStats = self.mc.stats()['peers']
+        self.assertEqual(peerStats.keys(), [str(uuid.UUID(bytes=self.mc.senderID))])
+        stats = peerStats.values()[0]
+        self.assertEqual(stats['host'], '127.0.0.1')
+        self.assertEqual(stats['packets received'], 4)
+        self.assertEqual(stats['packets lost'], 1)
+        self.assertEqual(stats['packets duplicated'], 1)
+        self.assertEqual(stats['packets reordered'], 1)
+
+
+    def testEarlierPacketReassembledLater(self):
+        """Test that a packet that is seen after a later packet (e.g. a large
+        packet that is still being reassembled when a keep-alive message
+        overtakes it) is not dropped as a duplicate."""
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        self.mc.compressThreshold = None
+        message = ''.join(chr(ord('a') + i % 26) for i in xrange(3 * self.mc.fragmentDataSize))
+        self.mc._sendMessage(message)
+        self.mc._sendMessage('keep-alive')
+        self.assertTrue(len(datagrams) > 2)
+
+        addr = ('127.0.0.1', self.mc.recvPort)
+        messages = []
+        for datagram in datagrams[-1:] + datagrams[:-1]:
+            messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages, ['keep-alive', message])
+        stats = self.mc.stats()['peers'].values()[0]
+        self.assertEqual(stats['packets duplicated'], 0)
+        self.assertEqual(stats['packets lost'], 0)
+
+
+    def testPeerStatsPerGroup(self):
+        """Test that a receiver that only joined some of the groups doesn't
+        count the packets sent to the other groups as lost."""
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append((group, datagram.tobytes()))
+        for i in xrange(6):
+            self.mc._sendMessage(i, '225.0.14.%d' % (i % 2))
+
+        # Only the packets sent to 225.0.14.1 are received.
+        addr = ('127.0.0.1', self.mc.recvPort)
+        messages = []
+        for group, datagram in datagrams:
+            if group == '225.0.14.1':
+                messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages, [1, 3, 5])
+        stats = self.mc.stats()['peers'].values()[0]
+        self.assertEqual(stats['packets received'], 3)
+        self.assertEqual(stats['packets lost'], 0)
+        self.assertEqual(stats['packets reordered'], 0)
+        self.assertEqual(stats['groups'].keys(), ['225.0.14.1'])
+
+
+    def testPacketSize(self):
+        """Test that packets from a host with a different packet size are
+        reassembled."""
+        self.assertEqual(self.mc.packetSize, 1472)
+        sender = LoopbackIPMulticastMessaging(port=0, packetSize=8000, compressThreshold=None)
+        try:
+            datagrams = []
+            sender._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+            message = ''.join(chr(ord('a') + i % 26) for i in xrange(20000))
+            sender._sendMessage(message)
+            self.assertEqual(max(len(datagram) for datagram in datagrams), 8000)
+        finally:
+            sender._commitSuicide()
+
+        addr = ('127.0.0.1', sender.recvPort)
+        messages = []
+        for datagram in reversed(datagrams):
+            messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages, [message])
+
+        self.assertRaises(IPMulticastMessagingError, IPMulticastMessaging, 0, packetSize=70000)
+
+
+    def testGroups(self):
+        group = self.mc.getGroup('01234567-89ab-cdef-0123-456789abcdef')
+        self.assertEqual(group, self.mc.getGroup('01234567-89ab-cdef-0123-456789abcdef'))
+        self.assertTrue(group.startswith('225.0.14.'))
+        groups = set(self.mc.getGroup(str(i)) for i in xrange(5000))
+        self.assertEqual(len(groups), self.mc.GROUP_COUNT)
+
+        # Groups are left when they've been left as many times as joined.
+        self.mc.joinGroup(group)
+        self.mc.joinGroup(group)
+        self.mc.leaveGroup(group)
+        self.assertEqual(self.mc.groups, {group : 1})
+        self.mc.leaveGroup(group)
+        self.assertEqual(self.mc.groups, {})
+
+
+    def testGroupMessages(self):
+        sent = []
+        self.mc._sendDatagram = lambda datagram, group: sent.append(group)
+        self.mc.coalesce = True
+        self.mc.outbox.put('a')
+        self.mc.outbox.put(GroupMessage('225.0.14.1', 'b'))
+        self.mc.outbox.put(GroupMessage('225.0.14.1', 'c'))
+        self.mc._send()
+        self.mc._flushCoalesced()
+        # Messages for different groups are not coalesced.
+        self.assertEqual(sent, [self.mc.MCAST_GRP, '225.0.14.1'])
+
+
+    def testPriorityLanes(self):
+        sent = []
+        self.mc._sendDatagram = lambda datagram, group: sent.append(datagram.tobytes())
+        self.mc.compressThreshold = None
+        large = 'x' * (3 * self.mc.sliceSize)
+        addr = ('127.0.0.1', self.mc.recvPort)
+        with self.mc.lock:
+            self.mc.outbox.put(GroupMessage(None, 'chat', LaneQueue.BULK))
+            self.mc.outbox.put(large)
+            self.mc.outbox.put('normal')
+            self.mc.outbox.put(GroupMessage(None, 'control', LaneQueue.CONTROL))
+            # Only a slice of the large message is sent, after the control
+            # message. The message after it waits.
+            self.mc._send()
+            messages = []
+            for datagram in sent:
+                messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+            self.assertEqual(messages, ['control'])
+            self.assertEqual(len(self.mc.transmissions[LaneQueue.NORMAL]), 2)
+            # Control messages that are put in the outbox in the meantime
+            # don't have to wait for the rest of it.
+            del sent[:]
+            self.mc.outbox.put(GroupMessage(None, 'control', LaneQueue.CONTROL))
+            self.mc._send()
+            self.assertEqual(self.mc._receiveMessage(memoryview(sent[0]), addr), ['control'])
+            while self.mc._isSlicing():
+                self.mc._send()
+            self.mc.messageCallback = messages.append
+            for datagram in sent[1:]:
+                messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+            while self.mc._isSlicing():
+                self.mc._receiveSlice()
+            # Normal messages keep their order, bulk messages come last.
+            self.assertEqual(messages, ['control', large, 'normal', 'chat'])
+            stats = self.mc.stats()
+            self.assertEqual(stats['messages per lane'], [2, 2, 1])
+            self.assertEqual(stats['sliced messages sent'], 1)
+            self.assertTrue(stats['slices sent'] >= 3)
+
+
+    def testSlicedReception(self):
+        """A large compressed packet is decompressed in slices. Packets that
+        are received after it wait for it, unless they're CONTROL packets."""
+        sent = []
+        self.mc._sendDatagram = lambda datagram, group: sent.append(datagram.tobytes())
+        delivered = []
+        self.mc.messageCallback = delivered.append
+        self.mc.sliceSize = 1024
+        large = ''.join(str(i) for i in xrange(20000))
+        for message in (large, 'normal', GroupMessage(None, 'control', LaneQueue.CONTROL)):
+            self.mc.outbox.put(message)
+        while self.mc._isSlicing() or self.mc.outbox.qsize():
+            self.mc._send()
+        self.assertTrue(self.mc.stats()['compression ratio'] * len(large) > 2 * self.mc.sliceSize)
+
+        addr = ('127.0.0.1', self.mc.recvPort)
+        messages = []
+        for datagram in sent:
+            messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages, ['control'])
+        slices = 0
+        while self.mc._isSlicing():
+            self.mc._receiveSlice()
+            slices += 1
+        self.assertTrue(slices > 2)
+        self.assertEqual(delivered, [large, 'normal'])
+        stats = self.mc.stats()
+        self.assertEqual(stats['sliced packets received'], 1)
+        self.assertEqual(stats['packets decompressed'], 1)
+
+
+    def testSourceFiltering(self):
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        for i in xrange(3):
+            self.mc._sendMessage(i)
+        peer = ('10.0.0.1', self.mc.recvPort)
+
+        # Datagrams from unknown hosts are dropped.
+        self.assertEqual(self.mc._receiveMessage(memoryview(datagrams[0]), peer), [])
+        self.assertEqual(self.mc.stats()['unknown datagrams'], 1)
+        self.mc.addSource('10.0.0.1')
+        self.assertEqual(self.mc._receiveMessage(memoryview(datagrams[0]), peer), [0])
+        self.mc.removeSource('10.0.0.1')
+        self.assertEqual(self.mc._receiveMessage(memoryview(datagrams[1]), peer), [])
+
+        # Our own IPs are always accepted.
+        self.mc.removeSource('127.0.0.1')
+        self.assertEqual(self.mc._receiveMessage(memoryview(datagrams[2]), ('127.0.0.1', self.mc.recvPort)), [2])
+        self.assertEqual(self.mc.stats()['unknown datagrams'], 2)
+
+
+    def testIncompatibleFragments(self):
+        self.mc.addSource('10.0.0.1')
+        self.mc.addSource('10.0.0.2')
+        addr = ('10.0.0.1', self.mc.recvPort)
+        # A fragment with the original ASCII fragment ID.
+        legacy = "%s%05d%05d%s" % ('01234567-89ab-cdef-0123-456789abcdef', 0, 1, 'S\'test\'\np0\n.')
+        self.assertEqual(self.mc._receiveMessage(memoryview(legacy), addr), [])
+        # A fragment with an unknown header version.
+        header = self.mc.FRAGMENT_HEADER.pack(self.mc.FRAGMENT_MAGIC, self.mc.FRAGMENT_VERSION + 1, 0, 'x' * 16, '\x00' * 4, 0, 0, 1)
+        self.assertEqual(self.mc._receiveMessage(memoryview(header + 'data'), addr), [])
+        # Garbage.
+        self.assertEqual(self.mc._receiveMessage(memoryview('garbage'), ('10.0.0.2', 1)), [])
+
+        stats = self.mc.stats()
+        self.assertEqual(stats['incompatible datagrams'], 2)
+        self.assertEqual(stats['incompatible hosts'], set(['10.0.0.1']))
+        self.assertEqual(stats['malformed datagrams'], 1)
+
+
+    def testCompression(self):
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        message = ''.join(chr(ord('a') + i % 26) for i in xrange(5 * self.mc.fragmentDataSize))
+        self.mc._sendMessage(message)
+        # Small messages and messages that don't get smaller are sent as is.
+        self.mc._sendMessage('small')
+        self.mc._sendMessage(os.urandom(1200))
+        self.assertEqual(len(datagrams), 3)
+
+        addr = ('127.0.0.1', self.mc.recvPort)
+        messages = []
+        for datagram in datagrams:
+            messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages[:2], [message, 'small'])
+        stats = self.mc.stats()
+        self.assertEqual(stats['packets compressed'], 1)
+        self.assertEqual(stats['packets decompressed'], 1)
+        self.assertTrue(stats['compression ratio'] < 0.01)
+
+        # A compressed packet that decompresses to more than the maximum
+        # packet size is rejected.
+        self.mc.maxPacketSize = 1000
+        self.mc._sendMessage(message)
+        self.assertEqual(self.mc._receiveMessage(memoryview(datagrams[-1]), addr), [])
+        self.assertEqual(self.mc.stats()['malformed datagrams'], 1)
+
+
+    def testSendWithoutLock(self):
+        """Test that messages are encoded, compressed and sent without
+        holding the lock, which other threads need to deliver messages."""
+        lockHeld = []
+        self.mc._sendDatagram = lambda datagram, group: lockHeld.append(self.mc.lock._is_owned())
+        self.mc.outbox.put(''.join(chr(ord('a') + i % 26) for i in xrange(5 * self.mc.fragmentDataSize)))
+        self.mc.outbox.put(os.urandom(3 * self.mc.fragmentDataSize))
+        self.mc._send()
+        self.assertTrue(len(lockHeld) > 3)
+        self.assertEqual(set(lockHeld), set([False]))
+        self.assertEqual(self.mc.stats()['packets compressed'], 1)
+
+
+    def testCoalescing(self):
+        datagrams = []
+        self.mc._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        self.mc.coalesce = True
+        self.mc.coalesceMaxSize = 100
+
+        # Small messages are held back until the budget is exhausted.
+        for i in xrange(10):
+            self.mc._sendMessage({'seq' : i})
+        self.assertTrue(0 < len(datagrams) < 10)
+        # A large message flushes the small ones first, to preserve the order.
+        large = 'x' * 200
+        self.mc._sendMessage(large)
+        self.mc._sendMessage({'seq' : 10})
+        self.assertTrue(self.mc.coalescedSize > 0)
+        self.mc._flushCoalesced()
+
+        addr = ('127.0.0.1', self.mc.recvPort)
+        messages = []
+        for datagram in datagrams:
+            messages.extend(self.mc._receiveMessage(memoryview(datagram), addr))
+        self.assertEqual(messages, [{'seq' : i} for i in xrange(10)] + [large, {'seq' : 10}])
+        stats = self.mc.stats()
+        self.assertEqual(stats['messages sent'], 12)
+        self.assertEqual(stats['datagrams sent'], len(datagrams))
+        self.assertTrue(len(datagrams) < 12)
+
+
+    def testCoalescingDelay(self):
+        self.mc.coalesce = True
+        self.mc._sendMessage('a')
+        self.assertTrue(self.mc._getTimeout() <= self.mc.coalesceMaxDelay)
+        self.mc.outbox.put('b')
+        time.sleep(self.mc.coalesceMaxDelay)
+        # The deadline has passed, so both messages are sent in one datagram.
+        self.mc._send()
+        self.assertEqual(self.mc._getTimeout(), self.mc.SELECT_TIMEOUT)
+        self.mc._receive(1)
+        self.assertEqual([self.mc.inbox.get() for i in xrange(2)], ['a', 'b'])
+        self.assertEqual(self.mc.stats()['datagrams received'], 1)
+        self.assertEqual(self.mc.stats()['messages coalesced'], 2)
+
+
+
+
+
+
+class EventLoopIPMulticastMessagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.loop.start()
+        self.received = []
+        self.sessions = [LoopbackEventLoopIPMulticastMessaging(self.loop, 0, messageCallback=self.received.append)
+                         for i in xrange(3)]
+        for mc in self.sessions:
+            mc.start()
+
+
+    def tearDown(self):
+        for mc in self.sessions:
+            mc.kill()
+            mc.join(5)
+        self.loop.kill()
+        self.loop.join(5)
+
+
+    def waitFor(self, count, timeout=5):
+        endTime = time.time() + timeout
+        while len(self.received) < count and time.time() < endTime:
+            time.sleep(0.01)
+
+
+    def testSessions(self):
+        """Test many sessions on a single loop, without threads of their
+        own."""
+        for i, mc in enumerate(self.sessions):
+            mc.outbox.put(i)
+        self.waitFor(3)
+        self.assertEqual(sorted(self.received), [0, 1, 2])
+        self.assertEqual(self.loop.stats()['readers'], 3)
+
+
+    def testFragmentedAndCoalesced(self):
+        mc = self.sessions[0]
+        mc.coalesce = True
+        mc.compressThreshold = None
+        message = os.urandom(3 * mc.fragmentDataSize)
+        for i in xrange(10):
+            mc.outbox.put(i)
+        mc.outbox.put(message)
+        self.waitFor(11)
+        self.assertEqual(self.received, range(10) + [message])
+        self.assertTrue(mc.stats()['datagrams sent'] < 11)
+
+
+    def testKill(self):
+        mc = self.sessions[0]
+        mc.outbox.put('last')
+        mc.kill()
+        mc.join(5)
+        self.assertFalse(mc.isAlive())
+        self.assertEqual(mc.stats()['datagrams sent'], 1)
+        self.assertEqual(self.loop.stats()['readers'], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
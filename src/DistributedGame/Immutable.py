@@ -0,0 +1,63 @@
+"""Immutable is a module to freeze decoded values, so that they can be handed
+to any number of callbacks without copying them first.
+
+freeze() converts dicts into ImmutableDicts, lists into tuples and sets into
+frozensets, recursively. Other values (numbers, strings, tuples of those,
+Player objects ...) are returned as they are.
+"""
+
+
+class ImmutableError(TypeError): pass
+
+
+
+
+class ImmutableDict(dict):
+    """A dict that can't be modified after it has been created. Copying it
+    returns the same object, since there is no need for a copy."""
+
+    def _immutable(self, *args, **kwargs):
+        raise ImmutableError, "ImmutableDict objects can't be modified"
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear       = _immutable
+    pop         = _immutable
+    popitem     = _immutable
+    setdefault  = _immutable
+    update      = _immutable
+
+
+    def __copy__(self):
+        return self
+
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+    def __reduce__(self):
+        return (ImmutableDict, (dict(self),))
+
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+
+    def __repr__(self):
+        return 'ImmutableDict(%s)' % (dict.__repr__(self))
+
+
+
+
+def freeze(value):
+    """Return an immutable version of value."""
+    if isinstance(value, ImmutableDict):
+        return value
+    elif isinstance(value, dict):
+        return ImmutableDict((key, freeze(v)) for (key, v) in value.iteritems())
+    elif isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(freeze(v) for v in value)
+    return value
@@ -0,0 +1,38 @@
+from Immutable import *
+import copy
+import cPickle
+import unittest
+
+
+class TestImmutable(unittest.TestCase):
+
+    def testFreeze(self):
+        value = freeze({'name' : 'game', 'players' : ['a', 'b'], 'options' : {'rows' : 6, 'cols' : set([7])}})
+        self.assertTrue(isinstance(value, ImmutableDict))
+        self.assertEqual(value['players'], ('a', 'b'))
+        self.assertTrue(isinstance(value['options'], ImmutableDict))
+        self.assertEqual(value['options']['cols'], frozenset([7]))
+        self.assertEqual(value, {'name' : 'game', 'players' : ('a', 'b'), 'options' : {'rows' : 6, 'cols' : frozenset([7])}})
+        self.assertEqual(freeze(5), 5)
+        self.assertEqual(freeze('five'), 'five')
+
+
+    def testImmutableDict(self):
+        d = ImmutableDict({'a' : 1})
+        self.assertRaises(ImmutableError, d.__setitem__, 'b', 2)
+        self.assertRaises(ImmutableError, d.__delitem__, 'a')
+        self.assertRaises(ImmutableError, d.update, {'b' : 2})
+        self.assertRaises(ImmutableError, d.pop, 'a')
+        self.assertRaises(ImmutableError, d.setdefault, 'b', 2)
+        self.assertRaises(ImmutableError, d.clear)
+        self.assertEqual(d, {'a' : 1})
+        # Copies are unnecessary, but a mutable copy can still be made.
+        self.assertTrue(copy.copy(d) is d)
+        self.assertTrue(copy.deepcopy(d) is d)
+        self.assertEqual(dict(d), {'a' : 1})
+        self.assertEqual(cPickle.loads(cPickle.dumps(d, cPickle.HIGHEST_PROTOCOL)), d)
+        self.assertEqual(hash(d), hash(ImmutableDict({'a' : 1})))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""LaneQueue is a module with a queue that has a lane per priority, so that
+urgent items (e.g. keep-alive messages) don't have to wait behind items that
+take long to process (e.g. a history message of many megabytes).
+
+Items are taken from the most urgent lane that isn't empty: CONTROL, then
+NORMAL, then BULK. Within a lane, items are taken in the order they were
+put.
+"""
+
+
+import Queue
+from collections import deque
+
+
+class LaneQueue(Queue.Queue):
+
+    CONTROL, NORMAL, BULK = range(3)
+    NUM_LANES = 3
+
+    def __init__(self, maxsize=0, lane=None):
+        """lane(item) returns the lane of an item. All items are put in the
+        NORMAL lane when it isn't given."""
+        self.lane = lane
+        Queue.Queue.__init__(self, maxsize)
+
+        # Statistics.
+        self.putsPerLane = [0] * self.NUM_LANES
+
+
+    def _init(self, maxsize):
+        self.lanes = [deque() for i in xrange(self.NUM_LANES)]
+        self.size  = 0
+
+
+    def _qsize(self, len=len):
+        return self.size
+
+
+    def _getLane(self, item):
+        return self.lane(item) if self.lane is not None else self.NORMAL
+
+
+    def _put(self, item):
+        lane = self._getLane(item)
+        self.lanes[lane].append(item)
+        self.size += 1
+        self.putsPerLane[lane] += 1
+
+
+    def _get(self):
+        for lane in self.lanes:
+            if lane:
+                self.size -= 1
+                return lane.popleft()
+
+
+    def nextLane(self):
+        """The lane of the item that will be taken next, or None when the
+        queue is empty."""
+        with self.mutex:
+            for lane in xrange(self.NUM_LANES):
+                if self.lanes[lane]:
+                    return lane
+            return None
+
+
+    def stats(self):
+        with self.mutex:
+            return {
+                'size per lane' : [len(lane) for lane in self.lanes],
+                'puts per lane' : list(self.putsPerLane),
+            }
@@ -0,0 +1,29 @@
+from LaneQueue import *
+import unittest
+
+
+class TestLaneQueue(unittest.TestCase):
+
+    def testSingleLane(self):
+        queue = LaneQueue()
+        for i in xrange(10):
+            queue.put(i)
+        self.assertEqual(queue.nextLane(), LaneQueue.NORMAL)
+        self.assertEqual([queue.get() for i in xrange(10)], range(10))
+        self.assertEqual(queue.nextLane(), None)
+
+
+    def testLanes(self):
+        queue = LaneQueue(lane=lambda (lane, value): lane)
+        for item in [(LaneQueue.BULK, 1), (LaneQueue.NORMAL, 2), (LaneQueue.BULK, 3), (LaneQueue.CONTROL, 4), (LaneQueue.NORMAL, 5)]:
+            queue.put(item)
+        self.assertEqual(queue.qsize(), 5)
+        self.assertEqual(queue.nextLane(), LaneQueue.CONTROL)
+        # Most urgent lane first, and in order within each lane.
+        self.assertEqual([queue.get()[1] for i in xrange(5)], [4, 2, 5, 1, 3])
+        self.assertEqual(queue.qsize(), 0)
+        self.assertEqual(queue.stats(), {'size per lane' : [0, 0, 0], 'puts per lane' : [1, 2, 2]})
+
+
+if __name__ == '__main__':
+    unittest.main()
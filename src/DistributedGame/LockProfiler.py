@@ -0,0 +1,208 @@
+"""LockProfiler is a module to find out which locks threads have to wait for,
+and for how long.
+
+Locks, conditions and the mutexes of queues are created (or wrapped) through
+the module's profiler, under a name (e.g. 'Service.lock'). While profiling is
+disabled (the default), plain locks are created, so this costs nothing. To
+profile, enable it before the objects are created:
+
+    LockProfiler.profiler.enable()
+    ...
+    print LockProfiler.profiler.report()
+
+The stats of all locks with the same name (e.g. of all services) are summed.
+"""
+
+
+import thread
+import threading
+import time
+
+
+class ProfiledLock(object):
+    """A lock (reentrant or not) that keeps track of how often it was
+    acquired, how long threads had to wait for it and how long it was held.
+    It can be used by threading.Condition, just like the locks of the
+    threading module."""
+
+    def __init__(self, name, reentrant=True):
+        self.name      = name
+        self.reentrant = reentrant
+        self.block     = threading.Lock()
+        self.owner     = None
+        self.count     = 0
+        self.acquired  = None # The time at which the lock was acquired.
+
+        # Statistics. Only updated while the lock is held.
+        self.acquisitions = 0
+        self.contended    = 0
+        self.waitTime     = 0.0
+        self.maxWaitTime  = 0.0
+        self.holdTime     = 0.0
+
+
+    def acquire(self, blocking=True):
+        if self.reentrant and self.owner == thread.get_ident():
+            self.count += 1
+            return True
+        if not self._acquire(blocking):
+            return False
+        self.owner = thread.get_ident()
+        self.count = 1
+        return True
+
+
+    def release(self):
+        # Like threading.Lock, a lock that isn't reentrant may be released by
+        # any thread.
+        if self.reentrant and self.owner != thread.get_ident():
+            raise RuntimeError, "cannot release un-acquired lock"
+        if self.count == 0:
+            raise thread.error, "release unlocked lock"
+        self.count -= 1
+        if self.count == 0:
+            self._release()
+
+
+    def __enter__(self):
+        return self.acquire()
+
+
+    def __exit__(self, *args):
+        self.release()
+
+
+    def _acquire(self, blocking=True):
+        if not self.block.acquire(False):
+            if not blocking:
+                return False
+            start = time.time()
+            self.block.acquire()
+            wait = time.time() - start
+            self.contended  += 1
+            self.waitTime   += wait
+            self.maxWaitTime = max(self.maxWaitTime, wait)
+        self.acquisitions += 1
+        self.acquired = time.time()
+        return True
+
+
+    def _release(self):
+        self.holdTime += time.time() - self.acquired
+        self.owner = None
+        self.block.release()
+
+
+    # Used by threading.Condition.wait(), which releases the lock entirely
+    # while waiting, however many times it was acquired.
+
+    def _is_owned(self):
+        return self.owner == thread.get_ident()
+
+
+    def _release_save(self):
+        state = self.count
+        self.count = 0
+        self._release()
+        return state
+
+
+    def _acquire_restore(self, state):
+        self._acquire()
+        self.owner = thread.get_ident()
+        self.count = state
+
+
+
+
+class LockProfiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.locks   = []
+        self.mutex   = threading.Lock()
+
+
+    def enable(self):
+        """Profile the locks that are created from now on."""
+        self.enabled = True
+
+
+    def disable(self):
+        self.enabled = False
+
+
+    def reset(self):
+        """Forget about the locks that were created so far."""
+        with self.mutex:
+            self.locks = []
+
+
+    def Lock(self, name):
+        return self._createLock(name, False) if self.enabled else threading.Lock()
+
+
+    def RLock(self, name):
+        return self._createLock(name, True) if self.enabled else threading.RLock()
+
+
+    def Condition(self, name):
+        return threading.Condition(self._createLock(name, True)) if self.enabled else threading.Condition()
+
+
+    def profileQueue(self, queue, name):
+        """Profile the mutex of a Queue (or a subclass), right after it was
+        created. Returns the queue."""
+        if self.enabled:
+            queue.mutex          = self._createLock(name, False)
+            queue.not_empty      = threading.Condition(queue.mutex)
+            queue.not_full       = threading.Condition(queue.mutex)
+            queue.all_tasks_done = threading.Condition(queue.mutex)
+        return queue
+
+
+    def _createLock(self, name, reentrant):
+        lock = ProfiledLock(name, reentrant)
+        with self.mutex:
+            self.locks.append(lock)
+        return lock
+
+
+    def stats(self):
+        """Lock name -> stats of all locks with that name."""
+        with self.mutex:
+            locks = list(self.locks)
+        stats = {}
+        for lock in locks:
+            if lock.name not in stats:
+                stats[lock.name] = {
+                    'locks'                  : 0,
+                    'acquisitions'           : 0,
+                    'contended acquisitions' : 0,
+                    'wait time'              : 0.0,
+                    'max wait time'          : 0.0,
+                    'hold time'              : 0.0,
+                }
+            s = stats[lock.name]
+            s['locks']                  += 1
+            s['acquisitions']           += lock.acquisitions
+            s['contended acquisitions'] += lock.contended
+            s['wait time']              += lock.waitTime
+            s['max wait time']           = max(s['max wait time'], lock.maxWaitTime)
+            s['hold time']              += lock.holdTime
+        return stats
+
+
+    def report(self):
+        """A table of the stats, the locks that were waited for the longest
+        first."""
+        lines = ["%-30s %6s %12s %10s %14s %14s %13s" % ('lock', 'locks', 'acquisitions', 'contended', 'wait time (ms)', 'max wait (ms)', 'hold time (ms)')]
+        for name, s in sorted(self.stats().items(), key=lambda (name, s): -s['wait time']):
+            lines.append("%-30s %6d %12d %10d %14.1f %14.2f %13.1f" % (name, s['locks'], s['acquisitions'], s['contended acquisitions'],
+                                                                        s['wait time'] * 1000, s['max wait time'] * 1000, s['hold time'] * 1000))
+        return '\n'.join(lines)
+
+
+
+
+profiler = LockProfiler()
@@ -0,0 +1,74 @@
+from LockProfiler import *
+import Queue
+import threading
+import time
+import unittest
+
+
+class TestLockProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = LockProfiler()
+        self.profiler.enable()
+
+
+    def testDisabled(self):
+        profiler = LockProfiler()
+        lock = profiler.Lock('lock')
+        self.assertFalse(isinstance(lock, ProfiledLock))
+        queue = Queue.Queue()
+        self.assertTrue(profiler.profileQueue(queue, 'queue') is queue)
+        self.assertFalse(isinstance(queue.mutex, ProfiledLock))
+        self.assertEqual(profiler.stats(), {})
+
+
+    def testWaitTime(self):
+        lock = self.profiler.Lock('lock')
+        lock.acquire()
+        threading.Timer(0.1, lock.release).start()
+        # Blocks until the timer has released the lock.
+        with lock:
+            pass
+        stats = self.profiler.stats()['lock']
+        self.assertEqual(stats['acquisitions'], 2)
+        self.assertEqual(stats['contended acquisitions'], 1)
+        self.assertTrue(stats['wait time'] > 0.05)
+        self.assertTrue(stats['hold time'] > 0.05)
+
+
+    def testReentrant(self):
+        lock = self.profiler.RLock('lock')
+        with lock:
+            with lock:
+                pass
+        self.assertEqual(self.profiler.stats()['lock']['acquisitions'], 1)
+        self.assertRaises(RuntimeError, lock.release)
+
+
+    def testCondition(self):
+        condition = self.profiler.Condition('condition')
+        ready = []
+        def notify():
+            with condition:
+                ready.append(True)
+                condition.notify()
+        with condition:
+            threading.Timer(0.1, notify).start()
+            while not ready:
+                condition.wait()
+        self.assertEqual(self.profiler.stats()['condition']['locks'], 1)
+
+
+    def testQueue(self):
+        queues = [self.profiler.profileQueue(Queue.Queue(), 'queue') for i in xrange(2)]
+        for queue in queues:
+            queue.put(1)
+            self.assertEqual(queue.get(), 1)
+        stats = self.profiler.stats()['queue']
+        self.assertEqual(stats['locks'], 2)
+        self.assertEqual(stats['acquisitions'], 4)
+        self.assertTrue('queue' in self.profiler.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
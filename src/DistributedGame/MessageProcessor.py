@@ -11,6 +11,9 @@ from collections import namedtuple as namedtuple
 import ntplib
 
 # Imports from this module.
+from BoundedInbox import BoundedInbox
+from LaneQueue import LaneQueue
+from LockProfiler import profiler
 from VectorClock import VectorClock
 import Service
 
@@ -40,8 +43,25 @@ class MessageProcessor(threading.Thread):
     SERVER_MOVE_TYPE = 'SERVER-MESSAGE'
     SERVER_ELECTED_TYPE = 'SERVER-ELECTED'
     SERVER_RESPONSE_TYPE = 'SERVER-RESPONSE'
+
+    # Classes of incoming messages. When the session's inbox is full, the
+    # wakeups of run() (None) are dropped first, then chat messages, then
+    # keep-alive messages (each of which supersedes the previous one anyway),
+    # and only then game messages.
+    WAKEUP_CLASS, CHAT_CLASS, KEEP_ALIVE_CLASS, GAME_CLASS = range(4)
+    INBOX_SIZE = 10000
+
+    # Messages that keep the session together (keep-alives and the host's
+    # messages) are sent and processed before all others: otherwise
+    # keep-alives would wait behind large messages (e.g. a history message),
+    # and players would be considered to have left. Game messages (including
+    # history messages) keep their order, and chat messages may be overtaken
+    # by them.
+    CONTROL_TYPES = (KEEP_ALIVE_TYPE, SERVER_ELECTED_TYPE, SERVER_RESPONSE_TYPE)
+    BULK_TYPES    = (CHAT,)
     
-    def __init__(self, service, sessionUUID, senderUUID, peerWaitingTime=30, messageWaitingTime=2):
+    def __init__(self, service, sessionUUID, senderUUID, peerWaitingTime=30, messageWaitingTime=2,
+                 inboxSize=INBOX_SIZE, inboxPolicy=BoundedInbox.DROP_BY_CLASS):
         # MulticastMessaging subclass.
         if not isinstance(service, Service.OneToManyService):
             raise OneToManyServiceError
@@ -59,9 +79,14 @@ class MessageProcessor(threading.Thread):
         #self.keepAliveLeftTime = 5 #the time to wait for a keep-alive message to arrive before we disconnect the player 
         #self.keepAliveMessages = {} # Contains the last time a keep-alive message was received per player
 
-        # Message storage.
-        self.inbox       = Queue.Queue()
+        # Message storage. The service puts the messages for our session
+        # straight in the incoming queue, on which run() blocks. It is
+        # bounded, so a slow game can't make it grow without limit, and has
+        # a lane per priority.
+        self.inbox       = profiler.profileQueue(Queue.Queue(), 'MessageProcessor.inbox')
         self.outbox      = Queue.Queue()
+        self.incoming    = profiler.profileQueue(BoundedInbox(inboxSize, inboxPolicy, self.classifyMessage, self.prioritizeMessage),
+                                                 'MessageProcessor.incoming')
 
         # Settings.
         self.peerWaitingTime    = int(peerWaitingTime)
@@ -70,7 +95,7 @@ class MessageProcessor(threading.Thread):
         # Thread state variables.
         self.alive = True
         self.die = False
-        self.lock = threading.Condition()
+        self.lock = profiler.Condition('MessageProcessor.lock')
         
         #Keep-alive.
         
@@ -96,7 +121,13 @@ class MessageProcessor(threading.Thread):
 
         # Register this Global State's session UUID with the service as a
         # valid destination.
-        self.service.registerDestination(self.sessionUUID)
+        self.service.registerDestination(self.sessionUUID, inbox=self.incoming)
+
+        # Wakes up run() when the next keep-alive message is due. It's a
+        # thread that sleeps, because in Python 2 a get() with a timeout
+        # polls the queue (up to every 50 ms) instead of blocking.
+        self.ticker = threading.Thread(target=self._tick, name="MessageProcessor-Ticker")
+        self.ticker.daemon = True
 
         super(MessageProcessor, self).__init__()
 
@@ -107,34 +138,58 @@ class MessageProcessor(threading.Thread):
     ##########################################################################
 
     def sendMessage(self, message, sendToSelf = True):
-        """Enqueue a message to be sent."""
-        with self.lock:
-            # print "\tGlobalState.sendMessage()", message
-            envelope = self._wrapMessage(message)
-            if sendToSelf:
-                self.inbox.put((self.senderUUID, message))
-            with self.service.lock:
-                # print "\tGlobalState._sendMessage()", envelope
-                self.service.sendMessage(self.sessionUUID, envelope)
-                self.service.lock.notifyAll()
+        """Enqueue a message to be sent. No lock is acquired: the inbox and
+        the service are thread-safe, so messages are handed off through
+        their queues."""
+        # print "\tGlobalState.sendMessage()", message
+        envelope = self._wrapMessage(message)
+        if sendToSelf:
+            self.inbox.put((self.senderUUID, message))
+        # print "\tGlobalState._sendMessage()", envelope
+        self.service.sendMessage(self.sessionUUID, envelope, self.getPriority(message))
+
+    def classifyMessage(self, envelope):
+        """Classify an incoming message, for the bounded inbox. None wakes up
+        run(): it's dropped before any message."""
+        if envelope is None:
+            return self.WAKEUP_CLASS
+        type = envelope['message']['type']
+        if type == self.CHAT:
+            return self.CHAT_CLASS
+        elif type == self.KEEP_ALIVE_TYPE:
+            return self.KEEP_ALIVE_CLASS
+        return self.GAME_CLASS
+
+    def getPriority(self, message):
+        """The priority (LaneQueue lane) of a message."""
+        if message['type'] in self.CONTROL_TYPES:
+            return LaneQueue.CONTROL
+        elif message['type'] in self.BULK_TYPES:
+            return LaneQueue.BULK
+        return LaneQueue.NORMAL
+
+    def prioritizeMessage(self, envelope):
+        """The lane of an incoming message, for the inbox. None wakes up
+        run() to send a keep-alive message: it's a control message."""
+        if envelope is None:
+            return LaneQueue.CONTROL
+        return self.getPriority(envelope['message'])
+
 
     def countReceivedMessages(self):
-        with self.lock:
-            return self.inbox.qsize()
+        return self.inbox.qsize()
 
 
     def receiveMessage(self):
-        with self.lock:
-            return self.inbox.get()
+        return self.inbox.get()
 
     def sendKeepAliveMessage(self):
-        with self.service.lock:
-            # send a keepalive message which contains the NTP time at which it was sent, so we can calculate
-            # Roundtrip time, and see if a player leaves the game
-            if self.useNTP:
-                self.sendMessage({'type' : self.KEEP_ALIVE_TYPE, 'originUUID':self.senderUUID, 'timestamp' : time.time() + self.NTPoffset}, False)
-            else:
-                self.sendMessage({'type' : self.KEEP_ALIVE_TYPE, 'originUUID':self.senderUUID, 'timestamp' : 0}, False)
+        # send a keepalive message which contains the NTP time at which it was sent, so we can calculate
+        # Roundtrip time, and see if a player leaves the game
+        if self.useNTP:
+            self.sendMessage({'type' : self.KEEP_ALIVE_TYPE, 'originUUID':self.senderUUID, 'timestamp' : time.time() + self.NTPoffset}, False)
+        else:
+            self.sendMessage({'type' : self.KEEP_ALIVE_TYPE, 'originUUID':self.senderUUID, 'timestamp' : 0}, False)
             
     def receiveKeepAliveMessage(self, message):
         with self.lock:
@@ -269,15 +324,15 @@ class MessageProcessor(threading.Thread):
 
 
     def processMessage(self, envelope):
-        """Process a message and put it in the inbox if its meant for us"""
+        """Process a message and put it in the inbox if its meant for us. The
+        lock must be acquired before calling this method."""
 
         # If the message was a request to make a move, do the move, and let the player who
         # did the move know his message was processed
         if envelope['message']['type'] == self.SERVER_MOVE_TYPE:
             if envelope['message']['target'] == self.senderUUID:
-                with self.lock:
-                    self.sendMessage({'type' : self.SERVER_RESPONSE_TYPE, 'col' : envelope['message']['col'], 'target' : envelope['originUUID']})
-                    self.inbox.put((envelope['originUUID'], envelope['message']))
+                self.sendMessage({'type' : self.SERVER_RESPONSE_TYPE, 'col' : envelope['message']['col'], 'target' : envelope['originUUID']})
+                self.inbox.put((envelope['originUUID'], envelope['message']))
         # If the message was an approval of a message sent by this user, approve that message
         elif envelope['message']['type'] == self.SERVER_RESPONSE_TYPE:
             self.messageApproval(envelope['message'])
@@ -292,8 +347,7 @@ class MessageProcessor(threading.Thread):
             self.receiveLeaveMessage(envelope)
         else:    
             # Move the message to the inbox queue, so it can be retrieved.
-            with self.lock:
-                self.inbox.put((envelope['originUUID'], envelope['message']))
+            self.inbox.put((envelope['originUUID'], envelope['message']))
 
     def erase(self):
         """Erase the global state."""
@@ -320,40 +374,63 @@ class MessageProcessor(threading.Thread):
             
         # print 'NTPoffset is now: ' + str(self.NTPoffset)
 
+    def _getKeepAliveTimeout(self):
+        """The time until the next keep-alive message is due."""
+        if self.useNTP and ('avg' in self.playerRTT.keys()):
+            interval = float(min(self.playerRTT['avg'], 1))
+        else:
+            interval = 1
+        return max(0, interval - (time.time() - self.lastKeepAliveSendTime))
+
+
+    def _tick(self):
+        while self.alive:
+            time.sleep(max(0.01, self._getKeepAliveTimeout()))
+            self._wakeup()
+
+
+    def _wakeup(self):
+        """Wake up run() without a message, by putting None in the incoming
+        queue. When it is full, run() has plenty of messages to wake up for,
+        so nothing is put: a message must never be dropped (nor the caller
+        blocked) to make room for a wakeup."""
+        self.incoming.offer(None)
+
+
     def run(self):
         self.getNTPoffset()
+        self.ticker.start()
 
         while self.alive:
             # Check if it's time to send liveness messages.
             # TODO
 
-            # Retrieve incoming messages and store them in the waiting room.            
+            # Wait until a message arrives or a keep-alive message is due.
+            envelope = self.incoming.get()
+
+            # Ignore our own messages, without acquiring the lock.
+            if envelope is not None and envelope['senderUUID'] == self.senderUUID:
+                continue
+
+            # Process the incoming message: a single critical section.
             with self.lock:
-                with self.service.lock:
-                    if self.service.countReceivedMessages(self.sessionUUID) > 0:
-                        envelope = self.service.receiveMessage(self.sessionUUID)
-                        # Ignore our own messages.
-                        
-                        if envelope['senderUUID'] != self.senderUUID:
-                            self.processMessage(envelope)
-                    # If there are other players, send keepalive messages with an interval suitable
-                    # to their roundtrip time
-                    if self.useNTP and ('avg' in self.playerRTT.keys()):
-                        if(float(min(self.playerRTT['avg'], 1)) < float(time.time() - self.lastKeepAliveSendTime)):
-                            self.sendKeepAliveMessage()
-                            self.checkKeepAlive()
-                            # check if move and join requests were received
-                            self.checkApproval()
-                            self.lastKeepAliveSendTime = time.time()
-                    elif time.time() - self.lastKeepAliveSendTime > 1:
-                        self.keepAliveSent = True
+                if envelope is not None:
+                    self.processMessage(envelope)
+                # If there are other players, send keepalive messages with an interval suitable
+                # to their roundtrip time
+                if self.useNTP and ('avg' in self.playerRTT.keys()):
+                    if(float(min(self.playerRTT['avg'], 1)) < float(time.time() - self.lastKeepAliveSendTime)):
                         self.sendKeepAliveMessage()
                         self.checkKeepAlive()
+                        # check if move and join requests were received
                         self.checkApproval()
                         self.lastKeepAliveSendTime = time.time()
-
-            # 100 refreshes per second is plenty.
-            time.sleep(0.01)
+                elif time.time() - self.lastKeepAliveSendTime > 1:
+                    self.keepAliveSent = True
+                    self.sendKeepAliveMessage()
+                    self.checkKeepAlive()
+                    self.checkApproval()
+                    self.lastKeepAliveSendTime = time.time()
 
 
     def kill(self):
@@ -370,5 +447,6 @@ class MessageProcessor(threading.Thread):
         calling this method.
         """
 
-        # Stop us from running any further.
+        # Stop us from running any further, and wake up run().
         self.alive = False
+        self._wakeup()
@@ -0,0 +1,86 @@
+import sys
+import unittest
+import uuid
+
+import SimulatedBonjour
+sys.modules['pybonjour'] = SimulatedBonjour
+from LaneQueue import LaneQueue
+from MessageProcessor import *
+from Service import OneToManyService
+
+
+
+
+class OfflineService(OneToManyService):
+    """Doesn't open any sockets or start any threads: it only keeps track of
+    the registered destinations and the sent messages."""
+
+    def __init__(self):
+        self.routes = {}
+        self.sent   = []
+
+
+    def registerDestination(self, destinationUUID, callback=None, inbox=None, **kwargs):
+        self.routes[destinationUUID] = (callback, inbox)
+
+
+    def sendMessage(self, destinationUUID, message, priority=LaneQueue.NORMAL):
+        self.sent.append((destinationUUID, message, priority))
+
+
+
+
+class MessageProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peerUUID  = str(uuid.uuid1())
+        self.processor = MessageProcessor(OfflineService(), str(uuid.uuid1()), str(uuid.uuid1()), inboxSize=3)
+
+
+    def envelope(self, message):
+        return {'timestamp' : 0.0, 'senderUUID' : self.peerUUID, 'originUUID' : self.peerUUID, 'message' : message}
+
+
+    def testFullInbox(self):
+        """Test that waking up run() never pushes a move out of a full
+        inbox."""
+        incoming = self.processor.incoming
+        moves = [self.envelope({'type' : MessageProcessor.MOVE, 'col' : col}) for col in xrange(3)]
+        for move in moves:
+            incoming.put(move)
+        self.processor._wakeup()
+        self.assertEqual(incoming.qsize(), 3)
+        self.assertEqual([incoming.get() for i in xrange(3)], moves)
+
+        # A wakeup that was put while there was room is dropped before any
+        # message.
+        incoming.put(moves[0])
+        incoming.put(moves[1])
+        self.processor._wakeup()
+        incoming.put(moves[2])
+        self.assertEqual([incoming.get() for i in xrange(3)], moves)
+        self.assertEqual(incoming.stats()['dropped per class'], {MessageProcessor.WAKEUP_CLASS : 1})
+
+
+    def testLanes(self):
+        """Only control messages overtake other messages: history messages
+        keep their order with moves, both when sent and when received."""
+        processor = MessageProcessor(OfflineService(), str(uuid.uuid1()), str(uuid.uuid1()))
+        messages = [{'type' : MessageProcessor.MOVE, 'col' : 0},
+                    {'type' : MessageProcessor.HISTORY_MESSAGE_TYPE, 'players' : {}, 'history' : []},
+                    {'type' : MessageProcessor.CHAT, 'message' : 'hi'},
+                    {'type' : MessageProcessor.MOVE, 'col' : 1},
+                    {'type' : MessageProcessor.KEEP_ALIVE_TYPE, 'originUUID' : self.peerUUID, 'timestamp' : 0}]
+        for message in messages:
+            processor.sendMessage(message, False)
+            processor.incoming.put(self.envelope(message))
+        self.assertEqual([priority for (destinationUUID, message, priority) in processor.service.sent],
+                         [LaneQueue.NORMAL, LaneQueue.NORMAL, LaneQueue.BULK, LaneQueue.NORMAL, LaneQueue.CONTROL])
+        received = [processor.incoming.get()['message'] for message in messages]
+        self.assertEqual(received, [messages[4], messages[0], messages[1], messages[3], messages[2]])
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
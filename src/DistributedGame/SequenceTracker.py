@@ -0,0 +1,100 @@
+"""SequenceTracker keeps track of the sequence numbers of the packets received
+from a single sender, to detect lost, reordered and duplicate packets.
+
+Sequence numbers are unsigned 32-bit integers that wrap around. Within a
+window behind the highest sequence number seen so far, a bitmap remembers which
+packets were received: only those are duplicates. Packets that are missing are
+counted as reordered when they arrive after all, and as lost when they fall out
+of the window. Older packets (e.g. a large packet that took long to reassemble,
+or one sent before the first packet that was seen) can't be told apart from
+duplicates, so they are accepted.
+"""
+
+
+from collections import OrderedDict
+
+
+class SequenceTracker(object):
+
+    MODULO = 2**32
+    WINDOW = 1024
+
+    def __init__(self, window=WINDOW):
+        # Settings.
+        self.window = window
+
+        # State.
+        self.highest = None
+        self.bitmap  = 0 # Bit i is set when highest - i was received.
+        self.missing = OrderedDict() # Missing sequence numbers, from old to new.
+
+        # Statistics.
+        self.received   = 0
+        self.lost       = 0
+        self.duplicates = 0
+        self.reordered  = 0
+
+
+    def add(self, sequenceNumber):
+        """Add the sequence number of a received packet. Returns False when
+        the packet is a duplicate, True otherwise."""
+        if self.highest is None:
+            self.highest = sequenceNumber
+            self.bitmap  = 1
+            self.received += 1
+            return True
+
+        ahead = (sequenceNumber - self.highest) % self.MODULO
+        if ahead == 0:
+            self.duplicates += 1
+            return False
+        elif ahead < self.MODULO / 2:
+            # A new highest sequence number: the ones in between are missing.
+            # Only those within the window are remembered.
+            skipped = ahead - 1
+            if skipped > self.window:
+                self.lost += skipped - self.window
+                skipped = self.window
+            for i in xrange(skipped, 0, -1):
+                self.missing[(sequenceNumber - i) % self.MODULO] = True
+            self.highest = sequenceNumber
+            self.bitmap  = ((self.bitmap << ahead) | 1) & ((1 << (self.window + 1)) - 1) if ahead <= self.window else 1
+            self.received += 1
+            self._forget()
+            return True
+
+        behind = self.MODULO - ahead
+        if behind <= self.window:
+            if self.bitmap & (1 << behind):
+                self.duplicates += 1
+                return False
+            self.bitmap |= 1 << behind
+        # An older packet that was missing, or that is too old to tell.
+        self.missing.pop(sequenceNumber, None)
+        self.received += 1
+        self.reordered += 1
+        return True
+
+
+    def _forget(self):
+        """Count the missing packets that fell out of the window as lost."""
+        while len(self.missing):
+            sequenceNumber = next(iter(self.missing))
+            if (self.highest - sequenceNumber) % self.MODULO <= self.window:
+                break
+            del self.missing[sequenceNumber]
+            self.lost += 1
+
+
+    def stats(self):
+        # Packets that are still missing are counted as lost as well: most of
+        # them will never arrive.
+        lost = self.lost + len(self.missing)
+        return {
+            'packets received'   : self.received,
+            'packets lost'       : lost,
+            'packets missing'    : len(self.missing),
+            'packets duplicated' : self.duplicates,
+            'packets reordered'  : self.reordered,
+            'loss rate'          : 1.0 * lost / (lost + self.received) if self.received else 0.0,
+        }
@@ -0,0 +1,70 @@
+from SequenceTracker import *
+import unittest
+
+
+class TestSequenceTracker(unittest.TestCase):
+
+    def testInOrder(self):
+        t = SequenceTracker()
+        for i in xrange(10):
+            self.assertTrue(t.add(i))
+        stats = t.stats()
+        self.assertEqual(stats['packets received'], 10)
+        self.assertEqual(stats['packets lost'], 0)
+        self.assertEqual(stats['loss rate'], 0.0)
+
+
+    def testGapsDuplicatesAndReordering(self):
+        t = SequenceTracker()
+        for i in [0, 1, 4, 2, 4, 1, 6]:
+            t.add(i)
+        stats = t.stats()
+        self.assertEqual(stats['packets received'], 5)
+        self.assertEqual(stats['packets duplicated'], 2)
+        self.assertEqual(stats['packets reordered'], 1)
+        self.assertEqual(stats['packets missing'], 2) # 3 and 5.
+        self.assertEqual(stats['loss rate'], 2.0 / 7)
+
+
+    def testWindow(self):
+        t = SequenceTracker(window=4)
+        t.add(0)
+        t.add(10) # 1-5 fall outside the window, 6-9 are missing.
+        self.assertEqual(t.lost, 5)
+        self.assertEqual(list(t.missing), [6, 7, 8, 9])
+        t.add(12) # 6 and 7 fall out of the window.
+        self.assertEqual(t.lost, 7)
+        self.assertEqual(list(t.missing), [8, 9, 11])
+        # Too old to tell, so it's accepted.
+        self.assertTrue(t.add(3))
+        # Received packets within the window are duplicates.
+        self.assertFalse(t.add(10))
+        self.assertTrue(t.add(9))
+        self.assertFalse(t.add(9))
+
+
+    def testEarlierPacketSeenLater(self):
+        """A packet sent before the first packet that was seen (e.g. a large
+        packet that took longer to reassemble) is not a duplicate."""
+        t = SequenceTracker()
+        t.add(1)
+        self.assertTrue(t.add(0))
+        self.assertFalse(t.add(0))
+        stats = t.stats()
+        self.assertEqual(stats['packets received'], 2)
+        self.assertEqual(stats['packets duplicated'], 1)
+        self.assertEqual(stats['packets lost'], 0)
+
+
+    def testWrapAround(self):
+        t = SequenceTracker()
+        t.add(2**32 - 2)
+        t.add(1)
+        self.assertEqual(list(t.missing), [2**32 - 1, 0])
+        t.add(0)
+        self.assertEqual(t.stats()['packets reordered'], 1)
+        self.assertEqual(t.highest, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
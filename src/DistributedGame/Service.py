@@ -1,7 +1,10 @@
 import Queue
 import threading
 import time
-from IPMulticastMessaging import IPMulticastMessaging
+from BoundedInbox import BoundedInbox
+from IPMulticastMessaging import IPMulticastMessaging, EventLoopIPMulticastMessaging, GroupMessage
+from LaneQueue import LaneQueue
+from LockProfiler import profiler
 from ZeroconfMessaging import ZeroconfMessaging
 
 
@@ -14,14 +17,23 @@ class DestinationNotRegisteredError(ServiceError): pass
 class Service(threading.Thread):
 
 
-    def __init__(self, serviceName, serviceType, port, protocolVersion=1):
+    def __init__(self, serviceName, serviceType, port, protocolVersion=1, coalesce=False):
         super(Service, self).__init__(name='Service-Thread')
 
-        # Initialize IP multicast layer.
-        self.multicast = IPMulticastMessaging(port)
+        # Mutual exclusion. Created first: the multicast layer may call back
+        # into the service as soon as it is started.
+        self.lock = profiler.Condition('Service.lock')
+
+        # Initialize IP multicast layer. When coalesce is enabled, small
+        # messages are packed together into a single datagram.
+        self.multicast = self._createMulticast(port, coalesce)
         uniquePort = self.multicast.getSendPort()
         self.multicast.start()
 
+        # IP storage (for managing multicast subscriptions). Created before
+        # the zeroconf layer is started, which may discover peers right away.
+        self.ips = {}
+
         # Initialize zeroconf layer.
         self.zeroconf = ZeroconfMessaging(serviceName, serviceType, uniquePort, protocolVersion,
                                           serviceRegisteredCallback=self._serviceRegisteredCallback,
@@ -37,9 +49,6 @@ class Service(threading.Thread):
         self.inbox  = Queue.Queue()
         self.outbox = Queue.Queue()
 
-        # IP storage (for managing multicast subscriptions).
-        self.ips = {}
-
         # Service description storage.
         self.ownServiceDescription = {} # No need for a queue, keeping only the latest is sufficient, since it doens't convey history but the current status.
         self.serviceDescriptions = {}
@@ -47,14 +56,20 @@ class Service(threading.Thread):
         # Thread state variables.
         self.alive = True
         self.die   = False
-        self.lock = threading.Condition()
+
+
+    def _createMulticast(self, port, coalesce):
+        return IPMulticastMessaging(port, coalesce=coalesce)
 
 
     def _peerServiceDiscoveryCallbackRouter(self, serviceName, interfaceIndex, fullname, hosttarget, ip, port):
         with self.lock:
-            # Subscribe to this peer's multicast traffic.
+            # Accept the datagrams this peer sends. Subscribing only succeeds
+            # when the peer runs on this host (on a local interface), so
+            # it must not keep its datagrams from being accepted.
             id = "%s-%s" % (serviceName, interfaceIndex)
             self.ips[id] = ip
+            self.multicast.addSource(ip)
             self.multicast.subscribe(ip)
 
         # Call peerServiceDiscoveryCallback.
@@ -63,14 +78,17 @@ class Service(threading.Thread):
 
     def _peerServiceRemovalCallbackRouter(self, serviceName, interfaceIndex):
         with self.lock:
-            # Unsubscribe to this peer's multicast traffic.
-            # TODO: only unsubscribe when no other service lives on the same IP
+            # Stop accepting this peer's datagrams, unless other services
+            # live on the same IP. (Only peers on this host were subscribed
+            # to.)
             id = "%s-%s" % (serviceName, interfaceIndex)
-            self.multicast.unsubscribe(self.ips[id])
-            del self.ips[id]
+            ip = self.ips.pop(id, None)
+            if ip is not None and ip not in self.ips.values():
+                self.multicast.unsubscribe(ip)
+                self.multicast.removeSource(ip)
 
-            # Call peerServiceRemovalCallback.
-            self.peerServiceRemovalCallback(serviceName, interfaceIndex)
+        # Call peerServiceRemovalCallback.
+        self._peerServiceRemovalCallback(serviceName, interfaceIndex)
 
 
     def _serviceRegisteredCallback(self, sdRef, flags, errorCode, name, regtype, domain, port):
@@ -97,11 +115,11 @@ class Service(threading.Thread):
         print "SERVICE UPDATE CALLBACK FIRED, params: serviceName=%s, interfaceIndex=%d, fullname=%s, hosttarget=%s, ip=%s, port=%d" % (serviceName, interfaceIndex, fullname, hosttarget, ip, port)
 
 
-    def _peerServiceDescriptionUpdatedCallback(self, serviceName, interfaceIndex, txtRecords, updated, deleted):
-        print "SERVICE DESCRIPTION UPDATED CALLBACK FIRED", serviceName, interfaceIndex, txtRecords
+    def _peerServiceDescriptionUpdatedCallback(self, serviceName, interfaceIndex, updated, deleted):
+        print "SERVICE DESCRIPTION UPDATED CALLBACK FIRED", serviceName, interfaceIndex
         print "\tupdated:"
-        for key in updated:
-            print "\t\t", key, txtRecords[key]
+        for key, value in updated.items():
+            print "\t\t", key, value
         print "\tdeleted:"
         for key in deleted:
             print "\t\t", key
@@ -121,6 +139,7 @@ class Service(threading.Thread):
         # Let the thread know it should commit suicide.
         with self.lock:
             self.die = True
+            self.lock.notifyAll()
 
 
     def _commitSuicide(self):
@@ -139,14 +158,46 @@ class Service(threading.Thread):
 
 
 class OneToManyService(Service):
-    """One service for many possible destinations per host."""
+    """One service for many possible destinations per host.
+
+    By default, this service's thread moves messages between the queues of
+    the multicast layer and the inboxes of the destinations, 20 times per
+    second. With direct routing, the multicast layer passes each received
+    message straight to the destination it's addressed to, through a routing
+    table (in the multicast layer's thread), and sent messages are handed to
+    the multicast layer right away: nothing is polled.
+
+    Messages are sent with a priority: CONTROL messages (e.g. keep-alives)
+    are sent before NORMAL ones (e.g. moves and history messages), and those
+    before BULK ones (e.g. chat messages). Large messages are sent in slices
+    (see IPMulticastMessaging), so CONTROL messages don't wait for them."""
 
 
     SERVICE_TO_SERVICE = 'service-to-service'
 
 
-    def __init__(self, serviceName, serviceType, port, protocolVersion=1):
-        super(OneToManyService, self).__init__(serviceName, serviceType, port, protocolVersion)
+    def __init__(self, serviceName, serviceType, port, protocolVersion=1, coalesce=False, shardDestinations=True, directRouting=False,
+                 groupBase=IPMulticastMessaging.GROUP_BASE, groupCount=IPMulticastMessaging.GROUP_COUNT):
+        # When destinations are sharded, the messages for each destination
+        # are sent to a multicast group of their own (see
+        # IPMulticastMessaging.getGroup()), which is only joined by the hosts
+        # that registered the destination. Service-to-service messages are
+        # always sent to the default group. The groups are taken from the
+        # groupCount groups starting at groupBase: all hosts must use the
+        # same range.
+        self.shardDestinations = shardDestinations
+        self.groupBase         = groupBase
+        self.groupCount        = groupCount
+
+        # Routing table: destination -> (callback, inbox); the callback is
+        # None for destinations whose messages are put in their inbox. Set
+        # before the multicast layer is started, since it routes messages
+        # directly. It's read without acquiring the lock: entries are only
+        # ever replaced as a whole, which is atomic.
+        self.directRouting = directRouting
+        self.routes        = {}
+
+        super(OneToManyService, self).__init__(serviceName, serviceType, port, protocolVersion, coalesce)
 
         # There are multiple destinations per service, so allow for one inbox
         # per destination.
@@ -156,37 +207,70 @@ class OneToManyService(Service):
         # hence we also provide a 'global' address: SERVICE_TO_SERVICE.
         self.registerDestination(self.SERVICE_TO_SERVICE)
 
+        # The outbox has a lane per priority: it holds (priority, packet)
+        # tuples.
+        self.outbox = profiler.profileQueue(LaneQueue(lane=lambda item: item[0]), 'Service.outbox')
+
 
-    def registerDestination(self, destinationUUID):
+    def _createMulticast(self, port, coalesce):
+        messageCallback = self._routeIncomingMessage if self.directRouting else None
+        return IPMulticastMessaging(port, coalesce=coalesce, groupBase=self.groupBase, groupCount=self.groupCount,
+                                    messageCallback=messageCallback)
+
+
+    def registerDestination(self, destinationUUID, callback=None, inbox=None,
+                            maxsize=0, policy=BoundedInbox.BLOCK, classify=None):
+        """Register a destination. Its messages are passed to callback when
+        it is given (in the thread that routes them), or put in its inbox
+        otherwise. inbox may be any queue (e.g. one that its owner blocks
+        on); by default, a BoundedInbox is created with the given maxsize
+        (unbounded by default), policy and classify function."""
+        if inbox is None:
+            inbox = profiler.profileQueue(BoundedInbox(maxsize, policy, classify), 'Service.inbox')
         with self.lock:
-            self.inbox[destinationUUID] = Queue.Queue()
+            join = not self.routes.has_key(destinationUUID) and self._isSharded(destinationUUID)
+            self.inbox[destinationUUID]  = inbox
+            self.routes[destinationUUID] = (callback, inbox)
+        # Join the group without holding the lock: the multicast layer has a
+        # lock of its own.
+        if join:
+            self.multicast.joinGroup(self.multicast.getGroup(destinationUUID))
 
 
     def removeDestination(self, destinationUUID):
         with self.lock:
-            if self.inbox.has_key(destinationUUID):
+            leave = self.routes.has_key(destinationUUID) and self._isSharded(destinationUUID)
+            if self.routes.has_key(destinationUUID):
+                del self.routes[destinationUUID]
                 del self.inbox[destinationUUID]
+        if leave:
+            self.multicast.leaveGroup(self.multicast.getGroup(destinationUUID))
 
 
-    def sendMessage(self, destinationUUID, message):
-        """Enqueue a message to be sent."""
-        with self.lock:
-            packet = {}
-            packet[destinationUUID] = message
+    def _isSharded(self, destinationUUID):
+        return self.shardDestinations and destinationUUID != self.SERVICE_TO_SERVICE
+
+
+    def sendMessage(self, destinationUUID, message, priority=LaneQueue.NORMAL):
+        """Enqueue a message to be sent, in the lane of its priority. With
+        direct routing, it's handed to the multicast layer right away, which
+        sends it (or coalesces it)."""
+        packet = {}
+        packet[destinationUUID] = message
+        if self.directRouting:
+            self._multicastSendMessage(packet, priority)
+        else:
             # print '\tService.sendMessage():', message
-            self.outbox.put(packet)
+            self.outbox.put((priority, packet))
 
 
-    def sendServiceMessage(self, message):
+    def sendServiceMessage(self, message, priority=LaneQueue.NORMAL):
         """Enqueue a service message to be sent."""
-        self.sendMessage(self.SERVICE_TO_SERVICE, message)
+        self.sendMessage(self.SERVICE_TO_SERVICE, message, priority)
 
 
     def countReceivedMessages(self, destinationUUID):
-        with self.lock:
-            if not self.inbox.has_key(destinationUUID):
-                raise DestinationNotRegisteredError
-            return self.inbox[destinationUUID].qsize()
+        return self._getInbox(destinationUUID).qsize()
 
 
     def countReceivedServiceMessages(self):
@@ -194,10 +278,16 @@ class OneToManyService(Service):
 
 
     def receiveMessage(self, destinationUUID):
-        with self.lock:
-            if not self.inbox.has_key(destinationUUID):
-                raise DestinationNotRegisteredError
-            return self.inbox[destinationUUID].get()
+        return self._getInbox(destinationUUID).get()
+
+
+    def _getInbox(self, destinationUUID):
+        """Look up the inbox of a destination in the routing table, without
+        acquiring the lock."""
+        route = self.routes.get(destinationUUID)
+        if route is None:
+            raise DestinationNotRegisteredError
+        return route[1]
 
 
     def receiveServiceMessage(self):
@@ -206,30 +296,76 @@ class OneToManyService(Service):
 
     def _multicastRouteIncomingMessages(self):
         """Route incoming multicast messages to the correct destination."""
+        while True:
+            try:
+                packet = self.multicast.inbox.get_nowait()
+            except Queue.Empty:
+                break
+            self._routeIncomingMessage(packet)
+
+
+    def _routeIncomingMessage(self, packet):
+        """Route an incoming multicast message to the correct destination,
+        through the routing table. With direct routing, this is called by the
+        multicast layer, in its thread. The lock is not acquired: the inbox
+        is thread-safe, and the callback may send messages or (un)register
+        destinations."""
+        for destinationUUID in packet.keys():
+            route = self.routes.get(destinationUUID)
+            if route is None:
+                continue
+            (callback, inbox) = route
+            if callback is None:
+                # Copy the message from the packet to the inbox with the
+                # correct destination.
+                inbox.put(packet[destinationUUID])
+            else:
+                callback(packet[destinationUUID])
+
+
+    def stats(self):
+        """The stats of the destinations' inboxes (for those that keep
+        stats), and the total number of messages dropped and of puts that
+        blocked because an inbox was full."""
         with self.lock:
-            with self.multicast.lock:
-                while self.multicast.inbox.qsize() > 0:
-                    packet = self.multicast.inbox.get()
-                    for destinationUUID in packet.keys():
-                        if self.inbox.has_key(destinationUUID):
-                            # Copy the message from the packet to the
-                            # inbox with the correct destination.
-                            message = packet[destinationUUID]
-                            self.inbox[destinationUUID].put(message)
+            inboxes = dict((destinationUUID, inbox.stats()) for (destinationUUID, inbox) in self.inbox.items() if hasattr(inbox, 'stats'))
+        return {
+            'inboxes'          : inboxes,
+            'messages dropped' : sum(stats['messages dropped'] for stats in inboxes.values()),
+            'puts blocked'     : sum(stats['puts blocked'] for stats in inboxes.values()),
+        }
 
 
     def _multicastSendMessages(self):
         """Send outgoing messages."""
-        with self.lock:
-            with self.multicast.lock:
-                while self.outbox.qsize() > 0:
-                    # Move the message from the Service outbox to the
-                    # multicast messaging outbox, so that it will be sent.
-                    message = self.outbox.get()
-                    self.multicast.outbox.put(message)
+        while True:
+            # Move the message from the Service outbox to the multicast
+            # messaging outbox, so that it will be sent.
+            try:
+                (priority, packet) = self.outbox.get_nowait()
+            except Queue.Empty:
+                break
+            self._multicastSendMessage(packet, priority)
+
+
+    def _multicastSendMessage(self, packet, priority=LaneQueue.NORMAL):
+        (destinationUUID,) = packet.keys()
+        group = self.multicast.getGroup(destinationUUID) if self._isSharded(destinationUUID) else None
+        if group is not None or priority != LaneQueue.NORMAL:
+            self.multicast.outbox.put(GroupMessage(group, packet, priority))
+        else:
+            self.multicast.outbox.put(packet)
 
 
     def run(self):
+        if self.directRouting:
+            # Nothing to poll: wait until we're asked to commit suicide.
+            with self.lock:
+                while not self.die:
+                    self.lock.wait()
+                self._commitSuicide()
+            return
+
         while self.alive:
             # Multicast messages.
             self._multicastRouteIncomingMessages()
@@ -252,6 +388,47 @@ class OneToManyService(Service):
 
 
 
+class EventLoopOneToManyService(OneToManyService):
+    """OneToManyService without a thread of its own, nor one for the
+    multicast layer: both run on an EventLoop, which can be shared by many
+    services (e.g. many game sessions in a single process). Routing is always
+    direct: received messages are passed to the callback of their
+    destination (in the loop's thread) as soon as they're received.
+    Destinations that are registered without a callback get an inbox, just
+    like in OneToManyService.
+    The zeroconf layer keeps its own thread, since pybonjour's calls block."""
+
+
+    def __init__(self, serviceName, serviceType, port, loop, protocolVersion=1, coalesce=False, shardDestinations=True,
+                 groupBase=IPMulticastMessaging.GROUP_BASE, groupCount=IPMulticastMessaging.GROUP_COUNT):
+        self.loop = loop
+
+        super(EventLoopOneToManyService, self).__init__(serviceName, serviceType, port, protocolVersion, coalesce, shardDestinations,
+                                                        directRouting=True, groupBase=groupBase, groupCount=groupCount)
+
+
+    def _createMulticast(self, port, coalesce):
+        return EventLoopIPMulticastMessaging(self.loop, port, messageCallback=self._routeIncomingMessage, coalesce=coalesce,
+                                             groupBase=self.groupBase, groupCount=self.groupCount)
+
+
+    def start(self):
+        """There's no thread to start: the multicast layer already runs on
+        the loop."""
+        pass
+
+
+    def join(self, timeout=None):
+        self.multicast.join(timeout)
+
+
+    def kill(self):
+        with self.lock:
+            self._commitSuicide()
+
+
+
+
 class OneToOneService(Service):
     """One service for a single possible destination per host."""
 
@@ -260,14 +437,10 @@ class OneToOneService(Service):
 
 
     def sendMessage(self, message):
-        with self.lock:
-            with self.multicast.lock:
-                self.multicast.outbox.put(message)
+        self.multicast.outbox.put(message)
 
 
     def receiveMessage(self):
-        with self.lock:
-            with self.multicast.lock:
-                return self.multicast.inbox.get()
+        return self.multicast.inbox.get()
 
         
\ No newline at end of file
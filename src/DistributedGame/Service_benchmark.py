@@ -0,0 +1,413 @@
+"""Benchmarks for OneToManyService (and the MessageProcessor on top of it).
+
+pybonjour is replaced by SimulatedBonjour and IP multicast traffic is sent to
+ourselves over the loopback interface, so that the benchmarks can run on a
+single host, without an mDNS daemon or multicast routing.
+"""
+
+
+import multiprocessing
+import Queue
+import random
+import sys
+import threading
+import time
+import uuid
+from optparse import OptionParser
+
+import SimulatedBonjour
+sys.modules['pybonjour'] = SimulatedBonjour
+from BoundedInbox import BoundedInbox
+from IPMulticastMessaging import IPMulticastMessaging
+from LaneQueue import LaneQueue
+from LockProfiler import profiler
+from MessageProcessor import MessageProcessor
+from Service import OneToManyService
+
+
+SERVICE_TYPE = '_benchmark._tcp'
+
+
+
+
+class LoopbackIPMulticastMessaging(IPMulticastMessaging):
+    """Sends all datagrams to our own receive socket over the loopback
+    interface instead of to the multicast group."""
+
+    def _sendDatagram(self, datagram, group):
+        self.sendSocket.sendto(datagram, ('127.0.0.1', self.recvPort))
+
+
+class SharedLoopbackIPMulticastMessaging(IPMulticastMessaging):
+    """Sends all datagrams to the receive sockets of all instances over the
+    loopback interface, as if they were hosts on the same network."""
+
+    ports = []
+
+    def _sendDatagram(self, datagram, group):
+        for port in self.ports:
+            self.sendSocket.sendto(datagram, ('127.0.0.1', port))
+
+
+class LoopbackOneToManyService(OneToManyService):
+
+    multicastClass = LoopbackIPMulticastMessaging
+
+    def _createMulticast(self, port, coalesce):
+        messageCallback = self._routeIncomingMessage if self.directRouting else None
+        return self.multicastClass(port, coalesce=coalesce, messageCallback=messageCallback)
+
+    # There are no peers: ignore the simulated zeroconf events (notably the
+    # discovery of our own service, whose simulated IP address can't be
+    # subscribed to).
+    def _serviceRegisteredCallback(self, *args):
+        pass
+
+    def _serviceUnregisteredCallback(self, *args):
+        pass
+
+    def _peerServiceDiscoveryCallbackRouter(self, *args):
+        pass
+
+    def _peerServiceRemovalCallbackRouter(self, *args):
+        pass
+
+
+class SharedLoopbackOneToManyService(LoopbackOneToManyService):
+
+    multicastClass = SharedLoopbackIPMulticastMessaging
+
+    def _createMulticast(self, port, coalesce):
+        multicast = super(SharedLoopbackOneToManyService, self)._createMulticast(port, coalesce)
+        multicast.ports.append(multicast.recvPort)
+        return multicast
+
+
+class OfflineMessageProcessor(MessageProcessor):
+    """Doesn't contact an NTP server."""
+
+    def getNTPoffset(self):
+        self.useNTP = False
+
+
+class SynchronizedMessageProcessor(MessageProcessor):
+    """Doesn't contact an NTP server, but acts as if it did: all instances
+    run on the same host, so their clocks are synchronized. Keep-alives are
+    then expected every round trip time (at most every second), and a player
+    is considered to have left after 5 round trip times plus 1 second without
+    any. Records when they are received."""
+
+    def __init__(self, *args, **kwargs):
+        MessageProcessor.__init__(self, *args, **kwargs)
+        self.keepAlivesReceived = []
+
+
+    def getNTPoffset(self):
+        self.useNTP    = True
+        self.NTPoffset = 0
+
+
+    def receiveKeepAliveMessage(self, message):
+        self.keepAlivesReceived.append(time.time())
+        MessageProcessor.receiveKeepAliveMessage(self, message)
+
+
+class FIFOMessageProcessor(SynchronizedMessageProcessor):
+    """Sends and processes all messages in a single lane, in order."""
+
+    def getPriority(self, message):
+        return LaneQueue.NORMAL
+
+
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values."""
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def benchmarkMoves(directRouting, count, interval):
+    """Send count moves of another player to a session, on average one every
+    interval seconds (randomized, so that the moves aren't in phase with any
+    polling), and measure the time until each of them can be retrieved from
+    the session's MessageProcessor (which is where the game picks them up).
+    Returns the latencies and the number of threads."""
+    service = LoopbackOneToManyService('benchmark', SERVICE_TYPE, 0, directRouting=directRouting)
+    service.start()
+    sessionUUID = str(uuid.uuid1())
+    processor = OfflineMessageProcessor(service, sessionUUID, str(uuid.uuid1()))
+    processor.start()
+    otherPlayerUUID = str(uuid.uuid1())
+    rng = random.Random(0)
+    latencies = []
+    try:
+        # Let everything settle down.
+        time.sleep(0.5)
+        numThreads = threading.activeCount()
+        for i in xrange(count):
+            move = {'type' : MessageProcessor.MOVE, 'row' : i % 6, 'col' : i % 7, 'player' : otherPlayerUUID}
+            envelope = {'timestamp' : time.time(), 'senderUUID' : otherPlayerUUID, 'originUUID' : otherPlayerUUID, 'message' : move}
+            service.sendMessage(sessionUUID, envelope)
+            # Block without a timeout: in Python 2, a get() with a timeout
+            # polls the queue, which would add to the measured latency.
+            senderUUID, message = processor.inbox.get()
+            latencies.append(time.time() - envelope['timestamp'])
+            time.sleep(rng.uniform(0, 2 * interval))
+    finally:
+        processor.kill()
+        service.kill()
+        processor.join()
+        service.join()
+    return latencies, numThreads
+
+
+def runMovesBenchmarks(options):
+    print "%-8s %10s %10s %10s %10s %8s" % ('routing', 'moves', 'mean (ms)', 'p50 (ms)', 'p99 (ms)', 'threads')
+    for name, directRouting in (('polling', False), ('direct', True)):
+        latencies, numThreads = benchmarkMoves(directRouting, options.moves, options.interval)
+        print "%-8s %10d %10.2f %10.2f %10.2f %8d" % (name, len(latencies),
+                                                      sum(latencies) / len(latencies) * 1000,
+                                                      percentile(latencies, 50) * 1000,
+                                                      percentile(latencies, 99) * 1000,
+                                                      numThreads)
+
+
+def benchmarkOverflow(policy, count, inboxSize, consumeInterval, timeout):
+    """Send count messages (alternately chat messages and moves) to a
+    destination with a bounded inbox of inboxSize messages, while the
+    consumer only takes a message every consumeInterval seconds. Returns the
+    numbers of moves and chat messages that were consumed, and the stats of
+    the inbox."""
+    CHAT, MOVE = range(2)
+    classify = lambda message: message[0] if message is not None else MOVE
+    service = LoopbackOneToManyService('benchmark', SERVICE_TYPE, 0, directRouting=True)
+    service.start()
+    sessionUUID = str(uuid.uuid1())
+    service.registerDestination(sessionUUID, maxsize=inboxSize, policy=policy, classify=classify)
+    consumed = {CHAT : 0, MOVE : 0}
+    def consume():
+        while True:
+            message = service.receiveMessage(sessionUUID)
+            if message is None:
+                break
+            consumed[message[0]] += 1
+            time.sleep(consumeInterval)
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    try:
+        for i in xrange(count):
+            service.sendMessage(sessionUUID, (i % 2, 'x' * 100))
+            # Pace the sender a bit, so the loopback socket buffer doesn't
+            # overflow.
+            if i % 50 == 0:
+                time.sleep(0.001)
+        # Wait until all messages have been delivered or dropped (or lost
+        # on the way, when the socket buffer overflows).
+        endTime = time.time() + timeout
+        while time.time() < endTime:
+            stats = service.stats()['inboxes'][sessionUUID]
+            if consumed[CHAT] + consumed[MOVE] + stats['size'] + stats['messages dropped'] >= count:
+                break
+            time.sleep(0.01)
+        service.inbox[sessionUUID].put(None)
+        consumer.join()
+    finally:
+        service.kill()
+        service.join()
+    return consumed[MOVE], consumed[CHAT], service.stats()['inboxes'][sessionUUID]
+
+
+def createHistoryPeer(processorClass, sessionUUID, connection):
+    """Create a player of a session on a SharedLoopbackOneToManyService and
+    exchange the ports of the services with the other peer, through a
+    multiprocessing connection."""
+    service = SharedLoopbackOneToManyService('benchmark', SERVICE_TYPE, 0, directRouting=True)
+    connection.send(service.multicast.recvPort)
+    SharedLoopbackIPMulticastMessaging.ports.append(connection.recv())
+    service.start()
+    processor = processorClass(service, sessionUUID, str(uuid.uuid1()))
+    processor.start()
+    return service, processor
+
+
+def runHistoryHost(processorClass, sessionUUID, numMoves, connection):
+    """The host of the session, in a process of its own (see
+    benchmarkHistory()): it sends a history message of numMoves moves to the
+    player when asked to, and stops when asked to."""
+    service, host = createHistoryPeer(processorClass, sessionUUID, connection)
+    try:
+        playerUUID = connection.recv()
+        rng = random.Random(0)
+        moves = [{'type' : MessageProcessor.MOVE, 'row' : i, 'col' : i % 7, 'player' : str(uuid.UUID(int=rng.getrandbits(128)))} for i in xrange(numMoves)]
+        history = {'type' : MessageProcessor.HISTORY_MESSAGE_TYPE, 'players' : {}, 'history' : moves, 'target' : playerUUID}
+        connection.send(len(service.multicast.codec.encode(history)))
+        connection.recv()
+        host.sendMessage(history, False)
+        connection.recv()
+    finally:
+        host.kill()
+        service.kill()
+        host.join()
+        service.join()
+
+
+def benchmarkHistory(processorClass, numMoves, timeout):
+    """Let the host of a session send a history message of numMoves moves to
+    another player, while both exchange keep-alive messages. The host runs in
+    a process of its own, as it would on another host: otherwise the decoding
+    of the history message would hold up both, since they'd share the GIL.
+    Returns the size of the encoded history message, the time until it was
+    received, the number of times the player considered the host to have
+    left, and the longest time between two keep-alive messages that the
+    player received."""
+    SharedLoopbackIPMulticastMessaging.ports[:] = []
+    sessionUUID = str(uuid.uuid1())
+    connection, hostConnection = multiprocessing.Pipe()
+    hostProcess = multiprocessing.Process(target=runHistoryHost, args=(processorClass, sessionUUID, numMoves, hostConnection))
+    hostProcess.start()
+    service, player = createHistoryPeer(processorClass, sessionUUID, connection)
+    leaves  = 0
+    latency = None
+    try:
+        connection.send(player.senderUUID)
+        size = connection.recv()
+        # Let the players get to know each other's round trip time.
+        time.sleep(1)
+        start = time.time()
+        connection.send('send')
+        # Keep watching for (false) leaves until a while after the history
+        # message was received.
+        endTime = start + timeout
+        while time.time() < endTime:
+            try:
+                senderUUID, message = player.inbox.get(True, 0.1)
+            except Queue.Empty:
+                continue
+            if message['type'] == MessageProcessor.LEAVE:
+                leaves += 1
+            elif message['type'] == MessageProcessor.HISTORY_MESSAGE_TYPE:
+                latency = time.time() - start
+                endTime = min(endTime, time.time() + 2)
+        connection.send('stop')
+        hostProcess.join()
+    finally:
+        player.kill()
+        service.kill()
+        player.join()
+        service.join()
+    keepAlives = [t for t in player.keepAlivesReceived if t >= start - 1]
+    maxGap = max(b - a for (a, b) in zip(keepAlives, keepAlives[1:])) if len(keepAlives) > 1 else None
+    return size, latency, leaves, maxGap
+
+
+def runHistoryBenchmarks(options):
+    numMoves = options.moves * 1000
+    print "history of %d moves, keep-alives every round trip time, leave after 5 round trip times + 1 s" % (numMoves)
+    print "%-8s %10s %12s %8s %18s" % ('lanes', 'size (MB)', 'latency (s)', 'leaves', 'max keep-alive gap (s)')
+    for name, processorClass in (('single', FIFOMessageProcessor), ('priority', SynchronizedMessageProcessor)):
+        size, latency, leaves, maxGap = benchmarkHistory(processorClass, numMoves, options.timeout)
+        print "%-8s %10.1f %12s %8d %18s" % (name, size / 1024.0 / 1024,
+                                              "%.2f" % latency if latency is not None else 'lost',
+                                              leaves,
+                                              "%.3f" % maxGap if maxGap is not None else '-')
+
+
+def benchmarkContention(numSenders, count, timeout):
+    """Let numSenders threads of the host of a session each send count moves
+    as fast as they can, while the other player's game thread polls for them
+    (like ManyInARowGame does, but without sleeping 50 ms). Both players are
+    on this host, and the locks of both are profiled. Returns the number of
+    moves that were received, the time it took and the stats of the lock
+    profiler."""
+    SharedLoopbackIPMulticastMessaging.ports[:] = []
+    profiler.reset()
+    profiler.enable()
+    sessionUUID = str(uuid.uuid1())
+    services = [SharedLoopbackOneToManyService('benchmark-%d' % (i), SERVICE_TYPE, 0, directRouting=True) for i in xrange(2)]
+    host, player = [OfflineMessageProcessor(service, sessionUUID, str(uuid.uuid1())) for service in services]
+    profiler.disable()
+    for thread in services + [host, player]:
+        thread.start()
+    total = numSenders * count
+    received = []
+    def send():
+        for i in xrange(count):
+            host.sendMessage({'type' : MessageProcessor.MOVE, 'row' : i % 6, 'col' : i % 7, 'player' : host.senderUUID}, False)
+            # Pace the senders a bit, so the loopback socket buffer doesn't
+            # overflow.
+            if i % 20 == 0:
+                time.sleep(0.001)
+    def consume():
+        endTime = time.time() + timeout
+        while len(received) < total and time.time() < endTime:
+            if player.countReceivedMessages() > 0:
+                senderUUID, message = player.receiveMessage()
+                if message['type'] == MessageProcessor.MOVE:
+                    received.append(message)
+            else:
+                time.sleep(0.0001)
+    try:
+        time.sleep(0.5)
+        consumer = threading.Thread(target=consume)
+        senders = [threading.Thread(target=send) for i in xrange(numSenders)]
+        start = time.time()
+        consumer.start()
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        consumer.join()
+        duration = time.time() - start
+    finally:
+        for thread in [host, player] + services:
+            thread.kill()
+        for thread in [host, player] + services:
+            thread.join()
+    return len(received), duration, profiler
+
+
+def runContentionBenchmarks(options):
+    numSenders = 4
+    moves, duration, profiler = benchmarkContention(numSenders, options.moves * 10, options.timeout)
+    print "%d threads sent %d moves, %d received in %.2f s (%.0f moves/s)" % (numSenders, numSenders * options.moves * 10, moves, duration, moves / duration)
+    print profiler.report()
+
+
+def runOverflowBenchmarks(options):
+    count = options.moves * 10
+    print "%d messages (half of them chat messages), inbox of %d messages, consumer takes 1 message per ms" % (count, count / 20)
+    print "%-14s %8s %8s %8s %10s %12s %10s" % ('policy', 'moves', 'chat', 'dropped', 'watermark', 'puts blocked', 'blocked (s)')
+    for name, policy in (('block', BoundedInbox.BLOCK), ('drop oldest', BoundedInbox.DROP_OLDEST), ('drop by class', BoundedInbox.DROP_BY_CLASS)):
+        moves, chat, stats = benchmarkOverflow(policy, count, count / 20, 0.001, options.timeout)
+        print "%-14s %8d %8d %8d %10d %12d %10.2f" % (name, moves, chat, stats['messages dropped'], stats['high watermark'],
+                                                     stats['puts blocked'], stats['time blocked'])
+
+
+
+
+BENCHMARKS = {
+    'contention' : runContentionBenchmarks,
+    'history'    : runHistoryBenchmarks,
+    'moves'      : runMovesBenchmarks,
+    'overflow'   : runOverflowBenchmarks,
+}
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--moves", type="int", dest="moves", default=200,
+                      help="number of moves to send per benchmark (thousands of moves in the history benchmark)")
+    parser.add_option("-i", "--interval", type="float", dest="interval", default=0.02,
+                      help="time between moves (seconds)")
+    parser.add_option("-t", "--timeout", type="float", dest="timeout", default=10,
+                      help="maximum time to wait for all messages to be delivered (seconds)")
+    parser.usage = "%%prog [options] [%s]" % '|'.join(sorted(BENCHMARKS.keys()))
+    (options, args) = parser.parse_args()
+
+    for name in args or sorted(BENCHMARKS.keys()):
+        print "== %s ==" % name
+        BENCHMARKS[name](options)
+        print
+    SimulatedBonjour.network.stop()
@@ -1,16 +1,122 @@
 import copy
 import Queue
+import sys
+import threading
+import time
 import uuid
 from optparse import OptionParser
 import unittest
 
 
-from GlobalState import *
+import SimulatedBonjour
+sys.modules['pybonjour'] = SimulatedBonjour
+from IPMulticastMessaging import IPMulticastMessaging
 from Service import OneToManyService
 
 
 
 
+class OfflineOneToManyService(OneToManyService):
+    """Doesn't start any threads or zeroconf: its multicast layer is driven
+    by hand, and it records the peer service callbacks."""
+
+    def __init__(self):
+        self.lock      = threading.Condition()
+        self.ips       = {}
+        self.multicast = IPMulticastMessaging(0)
+        self.events    = []
+
+
+    def _peerServiceDiscoveryCallback(self, serviceName, interfaceIndex, fullname, hosttarget, ip, port):
+        self.events.append(('discovered', serviceName, ip))
+
+
+    def _peerServiceRemovalCallback(self, serviceName, interfaceIndex):
+        self.events.append(('removed', serviceName))
+
+
+
+
+class PeerServiceRouterTest(unittest.TestCase):
+
+    PEER_IP = '10.1.2.3'
+
+    def setUp(self):
+        self.service = OfflineOneToManyService()
+
+
+    def tearDown(self):
+        self.service.multicast._commitSuicide()
+
+
+    def discover(self):
+        self.service._peerServiceDiscoveryCallbackRouter('peer', 1, 'peer._test._tcp.local.', 'peer.local.', self.PEER_IP, 2000)
+
+
+    def peerDatagram(self, message):
+        """A datagram with a message, as sent by another instance."""
+        datagrams = []
+        peer = IPMulticastMessaging(0)
+        peer._sendDatagram = lambda datagram, group: datagrams.append(datagram.tobytes())
+        try:
+            peer._sendMessage(message)
+        finally:
+            peer._commitSuicide()
+        return memoryview(datagrams[0])
+
+
+    def testRemotePeerDiscovered(self):
+        """The datagrams of a peer on another host are accepted, although
+        its address can't be subscribed to."""
+        addr = (self.PEER_IP, 2000)
+        self.assertEqual(self.service.multicast._receiveMessage(self.peerDatagram('before'), addr), [])
+        self.discover()
+        self.assertEqual(self.service.events, [('discovered', 'peer', self.PEER_IP)])
+        self.assertEqual(self.service.multicast._receiveMessage(self.peerDatagram('after'), addr), ['after'])
+        self.assertFalse(self.PEER_IP in self.service.multicast.memberships)
+
+
+    def testRemotePeerRemoved(self):
+        addr = (self.PEER_IP, 2000)
+        self.discover()
+        self.service._peerServiceRemovalCallbackRouter('peer', 1)
+        self.assertEqual(self.service.events, [('discovered', 'peer', self.PEER_IP), ('removed', 'peer')])
+        self.assertEqual(self.service.multicast._receiveMessage(self.peerDatagram('after'), addr), [])
+        self.assertFalse(self.PEER_IP in self.service.multicast.sources)
+
+
+    def testSharedIP(self):
+        """A peer's datagrams are accepted as long as any of the services on
+        its IP is known."""
+        addr = (self.PEER_IP, 2000)
+        self.discover()
+        self.service._peerServiceDiscoveryCallbackRouter('other', 1, 'other._test._tcp.local.', 'peer.local.', self.PEER_IP, 2001)
+        self.service._peerServiceRemovalCallbackRouter('peer', 1)
+        self.assertEqual(self.service.multicast._receiveMessage(self.peerDatagram('shared'), addr), ['shared'])
+        self.service._peerServiceRemovalCallbackRouter('other', 1)
+        self.assertFalse(self.PEER_IP in self.service.multicast.sources)
+
+
+
+
+
+class GroupRangeTest(unittest.TestCase):
+
+    def testGroupRange(self):
+        """The range of multicast groups that destinations are sharded over
+        can be configured through the service."""
+        service = OneToManyService('testhost', '_testService._tcp', 0, groupBase='239.1.2.0', groupCount=4)
+        service.start()
+        try:
+            groups = set(service.multicast.getGroup(str(uuid.uuid1())) for i in xrange(100))
+        finally:
+            service.kill()
+            service.join()
+        self.assertEqual(groups, set(['239.1.2.0', '239.1.2.1', '239.1.2.2', '239.1.2.3']))
+
+
+
+
 class OneToManyServiceTest(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,437 @@
+"""SimulatedBonjour is a pure-Python stand-in for the subset of pybonjour that
+ZeroconfMessaging uses. It is backed by a simulated mDNS network inside the
+current process, so that ZeroconfMessaging can be benchmarked with many peers,
+without real hosts or an mDNS daemon:
+
+    import sys
+    import SimulatedBonjour
+    sys.modules['pybonjour'] = SimulatedBonjour
+    from ZeroconfMessaging import ZeroconfMessaging
+
+Services of simulated peers are added to and removed from the network directly
+(see Network.addService()), or through unstarted ZeroconfMessaging instances,
+which register their service and publish their TXT records through the API
+below. Every response is delivered after a configurable latency, and is lost
+with a configurable probability. Like mDNS, the network recovers lost
+responses through retransmissions, after 1 second, 2 seconds, 4 seconds, ...
+"""
+
+
+import heapq
+import itertools
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+
+# Flags.
+kDNSServiceFlagsMoreComing     = 0x1
+kDNSServiceFlagsAdd            = 0x2
+kDNSServiceFlagsLongLivedQuery = 0x100
+
+# Errors.
+kDNSServiceErr_NoError      = 0
+kDNSServiceErr_NameConflict = -65548
+
+# Record types and classes.
+kDNSServiceType_A   = 1
+kDNSServiceType_TXT = 16
+kDNSServiceClass_IN = 1
+
+
+class BonjourError(Exception):
+    _errmsg = {
+        kDNSServiceErr_NameConflict : 'name conflict',
+    }
+
+
+
+
+class TXTRecord(object):
+    """A TXT record: key-value pairs, each stored as a length-prefixed
+    "key=value" string of at most 255 bytes."""
+
+    def __init__(self, items=None):
+        self._items = []
+        for key, value in (items or {}).items():
+            self[key] = value
+
+
+    def __setitem__(self, key, value):
+        item = '%s=%s' % (key, value)
+        if len(item) > 255:
+            raise ValueError, "name=value string must be 255 bytes or less"
+        self._items = [(k, v) for (k, v) in self._items if k != key] + [(key, str(value))]
+
+
+    def __getitem__(self, key):
+        for k, v in self._items:
+            if k == key:
+                return v
+        raise KeyError, key
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+    def __str__(self):
+        return ''.join(chr(len(k) + 1 + len(v)) + k + '=' + v for (k, v) in self._items)
+
+
+
+
+class DNSServiceRef(object):
+    """A service descriptor reference. Responses are queued in it; a UDP
+    socket that sends to itself makes it readable for select() while
+    responses are waiting."""
+
+    def __init__(self, network, callback):
+        self.network  = network
+        self.callback = callback
+        self.results  = deque()
+        self.closed   = False
+        self.onClose  = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.socket.setblocking(0)
+        self.socket.bind(('127.0.0.1', 0))
+        self.address = self.socket.getsockname()
+
+
+    def fileno(self):
+        return self.socket.fileno()
+
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.onClose is not None:
+            self.onClose()
+        self.socket.close()
+
+
+    def _deliver(self, flags, args):
+        if self.closed:
+            return
+        self.results.append((flags, args))
+        try:
+            self.socket.sendto('\x00', self.address)
+        except socket.error:
+            pass
+
+
+    def _process(self):
+        if self.closed or len(self.results) == 0:
+            return
+        try:
+            self.socket.recv(1)
+        except socket.error:
+            pass
+        flags, args = self.results.popleft()
+        if len(self.results):
+            flags |= kDNSServiceFlagsMoreComing
+        self.callback(self, flags, *args)
+
+
+
+
+class Network(object):
+    """The simulated mDNS network: the registered services, the browse
+    operations and the responses that are on their way."""
+
+    DOMAIN   = 'local.'
+    HOST_TTL = 120
+    TXT_TTL  = 4500
+
+    # The delay (in seconds) after which a lost response is retransmitted;
+    # it doubles for every retransmission (RFC 6762, section 5.2).
+    RETRANSMIT_DELAY = 1.0
+
+    def __init__(self, latency=0.0, loss=0.0, interfaceIndex=1):
+        self.lock = threading.RLock()
+        self.reset(latency, loss, interfaceIndex)
+
+        # Responses that are on their way: a heap of (delivery time, number,
+        # sdRef, flags, args) tuples, delivered by a thread of its own, which
+        # is started when the first response is delayed.
+        self.responses = []
+        self.counter   = itertools.count()
+        self.condition = threading.Condition(self.lock)
+        self.thread    = None
+        self.alive     = True
+
+
+    def reset(self, latency=0.0, loss=0.0, interfaceIndex=1, seed=0):
+        """Remove all services and set the latency (in seconds) with which
+        responses are delivered and the fraction of responses that is
+        lost."""
+        with self.lock:
+            self.latency        = latency
+            self.loss           = loss
+            self.random         = random.Random(seed)
+            self.interfaceIndex = interfaceIndex
+            self.services       = {} # Service name -> service.
+            self.hosts          = {} # Host name -> IP address.
+            self.browsers       = [] # (regtype, sdRef) tuples.
+            self.txtQueries     = {} # Full name -> sdRefs of its TXT record queries.
+            self.calls          = {} # API function -> number of calls.
+            self.responsesSent  = 0
+            self.responsesLost  = 0
+
+
+    def addService(self, name, regtype, port, txtRecord='', host=None):
+        """Register a service (e.g. of a simulated peer). Returns the name,
+        which is made unique when it is already taken."""
+        with self.lock:
+            unique = name
+            n = 2
+            while unique in self.services:
+                unique = '%s (%d)' % (name, n)
+                n += 1
+            host = host or '%s.%s' % (unique.replace(' ', '-'), self.DOMAIN)
+            if host not in self.hosts:
+                ip = len(self.hosts) + 1
+                self.hosts[host] = '10.%d.%d.%d' % (ip >> 16 & 0xFF, ip >> 8 & 0xFF, ip & 0xFF)
+            service = {
+                'name'      : unique,
+                'regtype'   : regtype,
+                'port'      : port,
+                'host'      : host,
+                'fullname'  : '%s.%s.%s' % (unique, regtype, self.DOMAIN),
+                'txtRecord' : str(txtRecord) or '\x00', # An empty TXT record is a single empty string (RFC 6763, section 6.1).
+                'records'   : {}, # Record reference -> additional TXT record.
+            }
+            self.services[unique] = service
+            for browseRegtype, sdRef in self.browsers:
+                if browseRegtype == regtype:
+                    self._respond(sdRef, kDNSServiceFlagsAdd, (self.interfaceIndex, kDNSServiceErr_NoError, unique, regtype, self.DOMAIN))
+            for sdRef in self.txtQueries.get(service['fullname'], []):
+                self._respondTXTRecords(sdRef, service)
+            return unique
+
+
+    def removeService(self, name):
+        with self.lock:
+            service = self.services.pop(name, None)
+            if service is None:
+                return
+            for browseRegtype, sdRef in self.browsers:
+                if browseRegtype == service['regtype']:
+                    self._respond(sdRef, 0, (self.interfaceIndex, kDNSServiceErr_NoError, name, service['regtype'], self.DOMAIN))
+
+
+    def _call(self, function):
+        self.calls[function] = self.calls.get(function, 0) + 1
+
+
+    def _respond(self, sdRef, flags, args):
+        """Deliver a response to an sdRef after the latency, plus the time
+        it takes to retransmit it as often as it is lost."""
+        self.responsesSent += 1
+        delay = self.latency
+        retransmitDelay = self.RETRANSMIT_DELAY
+        while self.loss > 0 and self.random.random() < self.loss:
+            self.responsesLost += 1
+            delay += retransmitDelay
+            retransmitDelay *= 2
+        if delay <= 0:
+            sdRef._deliver(flags, args)
+            return
+        heapq.heappush(self.responses, (time.time() + delay, next(self.counter), sdRef, flags, args))
+        if self.thread is None:
+            self.alive  = True
+            self.thread = threading.Thread(target=self._deliverResponses, name='SimulatedBonjour-Thread')
+            self.thread.daemon = True
+            self.thread.start()
+        self.condition.notify()
+
+
+    def stop(self):
+        """Stop the thread that delivers delayed responses."""
+        with self.lock:
+            thread = self.thread
+            self.alive  = False
+            self.thread = None
+            self.condition.notify()
+        if thread is not None:
+            thread.join()
+
+
+    def _deliverResponses(self):
+        with self.lock:
+            while self.alive:
+                now = time.time()
+                while len(self.responses) and self.responses[0][0] <= now:
+                    deliveryTime, number, sdRef, flags, args = heapq.heappop(self.responses)
+                    sdRef._deliver(flags, args)
+                if len(self.responses):
+                    self.condition.wait(self.responses[0][0] - now)
+                else:
+                    self.condition.wait()
+
+
+    def register(self, name, regtype, port, txtRecord, callBack):
+        with self.lock:
+            self._call('DNSServiceRegister')
+            sdRef = DNSServiceRef(self, callBack)
+            name = self.addService(name, regtype, port, txtRecord)
+            sdRef.serviceName = name
+            sdRef.onClose = lambda: self.removeService(name)
+            self._respond(sdRef, 0, (kDNSServiceErr_NoError, name, regtype, self.DOMAIN))
+            return sdRef
+
+
+    def browse(self, regtype, callBack):
+        with self.lock:
+            self._call('DNSServiceBrowse')
+            sdRef = DNSServiceRef(self, callBack)
+            self.browsers.append((regtype, sdRef))
+            sdRef.onClose = lambda: self._removeBrowser(sdRef)
+            for service in self.services.values():
+                if service['regtype'] == regtype:
+                    self._respond(sdRef, kDNSServiceFlagsAdd, (self.interfaceIndex, kDNSServiceErr_NoError, service['name'], regtype, self.DOMAIN))
+            return sdRef
+
+
+    def _removeBrowser(self, sdRef):
+        with self.lock:
+            self.browsers = [(regtype, s) for (regtype, s) in self.browsers if s is not sdRef]
+
+
+    def resolve(self, interfaceIndex, name, callBack):
+        with self.lock:
+            self._call('DNSServiceResolve')
+            sdRef = DNSServiceRef(self, callBack)
+            # Services that don't exist (anymore) are never resolved.
+            if name in self.services:
+                service = self.services[name]
+                self._respond(sdRef, 0, (interfaceIndex, kDNSServiceErr_NoError, service['fullname'],
+                                         service['host'], service['port'], service['txtRecord']))
+            return sdRef
+
+
+    def queryRecord(self, interfaceIndex, fullname, rrtype, callBack):
+        with self.lock:
+            self._call('DNSServiceQueryRecord')
+            sdRef = DNSServiceRef(self, callBack)
+            if rrtype == kDNSServiceType_A and fullname in self.hosts:
+                rdata = socket.inet_aton(self.hosts[fullname])
+                self._respond(sdRef, kDNSServiceFlagsAdd, (interfaceIndex, kDNSServiceErr_NoError, fullname,
+                                                           rrtype, kDNSServiceClass_IN, rdata, self.HOST_TTL))
+            elif rrtype == kDNSServiceType_TXT:
+                # TXT record queries are long-lived: they're answered with
+                # the current TXT records, and with every change.
+                self.txtQueries.setdefault(fullname, []).append(sdRef)
+                sdRef.onClose = lambda: self._removeTXTQuery(fullname, sdRef)
+                for service in self.services.values():
+                    if service['fullname'] == fullname:
+                        self._respondTXTRecords(sdRef, service)
+            return sdRef
+
+
+    def _removeTXTQuery(self, fullname, sdRef):
+        with self.lock:
+            self.txtQueries[fullname].remove(sdRef)
+            if len(self.txtQueries[fullname]) == 0:
+                del self.txtQueries[fullname]
+
+
+    def _respondTXTRecords(self, sdRef, service):
+        for rdata in [service['txtRecord']] + service['records'].values():
+            self._respondTXTRecord(sdRef, service, rdata, self.TXT_TTL)
+
+
+    def _respondTXTRecord(self, sdRef, service, rdata, ttl):
+        self._respond(sdRef, kDNSServiceFlagsAdd, (self.interfaceIndex, kDNSServiceErr_NoError, service['fullname'],
+                                                   kDNSServiceType_TXT, kDNSServiceClass_IN, rdata, ttl))
+
+
+    def _announceTXTRecord(self, service, oldRdata, rdata):
+        """Announce a new or updated TXT record of a service to all queries
+        for its TXT records. An updated record is preceded by a goodbye
+        (TTL 0) for the old one."""
+        for sdRef in self.txtQueries.get(service['fullname'], []):
+            if oldRdata is not None:
+                self._respondTXTRecord(sdRef, service, oldRdata, 0)
+            self._respondTXTRecord(sdRef, service, rdata, self.TXT_TTL)
+
+
+    def addRecord(self, sdRef, rdata):
+        with self.lock:
+            self._call('DNSServiceAddRecord')
+            recordRef = object()
+            service = self.services.get(sdRef.serviceName)
+            if service is not None:
+                service['records'][recordRef] = str(rdata)
+                self._announceTXTRecord(service, None, str(rdata))
+            return recordRef
+
+
+    def updateRecord(self, sdRef, recordRef, rdata):
+        with self.lock:
+            self._call('DNSServiceUpdateRecord')
+            service = self.services.get(sdRef.serviceName)
+            if service is not None and recordRef in service['records']:
+                oldRdata = service['records'][recordRef]
+                service['records'][recordRef] = str(rdata)
+                self._announceTXTRecord(service, oldRdata, str(rdata))
+
+
+    def removeRecord(self, sdRef, recordRef):
+        with self.lock:
+            self._call('DNSServiceRemoveRecord')
+            service = self.services.get(sdRef.serviceName)
+            if service is not None and recordRef in service['records']:
+                del service['records'][recordRef]
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'services'       : len(self.services),
+                'calls'          : dict(self.calls),
+                'responses sent' : self.responsesSent,
+                'responses lost' : self.responsesLost,
+            }
+
+
+
+
+# The simulated network that the pybonjour API below works on.
+network = Network()
+
+
+def DNSServiceRegister(flags=0, interfaceIndex=0, name=None, regtype=None, domain=None, host=None, port=None, txtRecord='', callBack=None):
+    return network.register(name, regtype, port, txtRecord, callBack)
+
+
+def DNSServiceBrowse(flags=0, interfaceIndex=0, regtype=None, domain=None, callBack=None):
+    return network.browse(regtype, callBack)
+
+
+def DNSServiceResolve(flags, interfaceIndex, name, regtype, domain, callBack=None):
+    return network.resolve(interfaceIndex, name, callBack)
+
+
+def DNSServiceQueryRecord(flags=0, interfaceIndex=0, fullname=None, rrtype=None, rrclass=kDNSServiceClass_IN, callBack=None):
+    return network.queryRecord(interfaceIndex, fullname, rrtype, callBack)
+
+
+def DNSServiceAddRecord(sdRef, flags=0, rrtype=None, rdata='', ttl=0):
+    return network.addRecord(sdRef, rdata)
+
+
+def DNSServiceUpdateRecord(sdRef, RecordRef=None, flags=0, rdata='', ttl=0):
+    network.updateRecord(sdRef, RecordRef, rdata)
+
+
+def DNSServiceRemoveRecord(sdRef, RecordRef, flags=0):
+    network.removeRecord(sdRef, RecordRef)
+
+
+def DNSServiceProcessResult(sdRef):
+    sdRef._process()
@@ -0,0 +1,80 @@
+"""TTLCache is a cache whose entries expire after their time to live (TTL),
+like the DNS records they typically hold.
+"""
+
+
+import time
+
+
+class TTLCache(object):
+
+    def __init__(self):
+        # State.
+        self.entries = {} # Key -> (expiry time, value).
+
+        # Statistics.
+        self.hits   = 0
+        self.misses = 0
+
+
+    def get(self, key, now=None):
+        """Returns the value for a key, or None when it isn't cached or has
+        expired."""
+        if now is None:
+            now = time.time()
+        if key in self.entries:
+            expires, value = self.entries[key]
+            if expires > now:
+                self.hits += 1
+                return value
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+
+    def put(self, key, value, ttl, now=None):
+        """Cache a value for ttl seconds. A TTL of zero removes the value (as
+        in a DNS goodbye packet)."""
+        if ttl <= 0:
+            self.remove(key)
+            return
+        if now is None:
+            now = time.time()
+        self.entries[key] = (now + ttl, value)
+
+
+    def remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+
+
+    def timeToLive(self, key, now=None):
+        """The remaining time to live of a cached value, in seconds."""
+        if now is None:
+            now = time.time()
+        if key not in self.entries:
+            return 0
+        return max(0, self.entries[key][0] - now)
+
+
+    def expire(self, now=None):
+        """Remove all expired values."""
+        if now is None:
+            now = time.time()
+        for key, (expires, value) in self.entries.items():
+            if expires <= now:
+                del self.entries[key]
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries'  : len(self.entries),
+            'hits'     : self.hits,
+            'misses'   : self.misses,
+            'hit rate' : 1.0 * self.hits / lookups if lookups else 0.0,
+        }
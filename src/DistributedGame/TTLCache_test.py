@@ -0,0 +1,35 @@
+from TTLCache import *
+import unittest
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def testExpiry(self):
+        c = TTLCache()
+        c.put('a', 1, 10, now=100)
+        self.assertEqual(c.get('a', now=105), 1)
+        self.assertEqual(c.timeToLive('a', now=105), 5)
+        self.assertEqual(c.get('a', now=110), None)
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.get('b', now=100), None)
+        stats = c.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+
+    def testGoodbye(self):
+        c = TTLCache()
+        c.put('a', 1, 10, now=100)
+        c.put('a', 1, 0, now=101)
+        self.assertEqual(c.get('a', now=101), None)
+
+
+    def testExpire(self):
+        c = TTLCache()
+        c.put('a', 1, 10, now=100)
+        c.put('b', 2, 20, now=100)
+        c.expire(now=115)
+        self.assertEqual(c.entries.keys(), ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
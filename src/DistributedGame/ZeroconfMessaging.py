@@ -3,18 +3,34 @@ queued unordered, reliable messaging simpler than you can imagine. Peer
 discovery happens automatically. Naming conflicts are solved automatically.
 Forget IGMP and special hardware requirements.
 Uses zeroconf networking.
-Message size is limited to 255 bytes.
+Messages are dicts, of which each key-value pair is stored in a TXT record.
+Values are encoded compactly; values that don't fit in a single TXT record
+(255 bytes) are compressed and split into multiple TXT records.
+Each message replaces the previous one (it is the service description), so
+only the newest message in the outbox is sent, at most once per debounce
+window.
+Peers' service descriptions are passed on as deltas: only the keys that were
+updated (with their values, which are immutable and therefor not copied) and
+the keys that were deleted.
 """
 
 
 import copy
+import math
 import select
 import pybonjour
-import cPickle
 import Queue
 import socket
+import struct
 import threading
 import time
+import zlib
+from collections import OrderedDict
+
+from Codec import Codec, CompactCodec, PickleCodec, DecodeError
+from Immutable import freeze
+from LockProfiler import profiler
+from TTLCache import TTLCache
 
 
 # The protocol version is stored automatically in the primary TXT record and
@@ -25,6 +41,7 @@ import time
 class ZeroconfMessagingError(Exception): pass
 class InvalidCallbackError(ZeroconfMessagingError): pass
 class MessageTooLargeError(ZeroconfMessagingError): pass
+class InvalidKeyError(ZeroconfMessagingError): pass
 class ProtocolVersionMismatch(ZeroconfMessagingError): pass
 
 
@@ -37,6 +54,31 @@ def curry(_curried_func, *args, **kwargs):
 
 class ZeroconfMessaging(threading.Thread):
 
+    # The maximum time (in seconds) to wait for responses of the zeroconf
+    # server in each iteration of the thread, after which the outbox is
+    # processed.
+    PROCESS_TIMEOUT = 0.02
+
+    # The minimum time (in seconds) between two messages being sent. Messages
+    # that are put in the outbox in the mean time supersede each other.
+    DEBOUNCE = 0.1
+
+    # Values that don't fit in a single TXT record are split into chunks. The
+    # TXT record with the original key holds the first chunk, the TXT records
+    # with the keys "<key>#1", "<key>#2", ... hold the others. Each chunk
+    # starts with a header: a marker (a byte that isn't a codec ID), flags,
+    # the version of the value (counted per key, so that chunks of different
+    # versions are never combined), the index of the chunk and the number of
+    # chunks. Receivers collect the chunks of at most MAX_CHUNK_VERSIONS
+    # versions of a value at a time.
+    TXT_RECORD_SIZE    = 255
+    CHUNK_SEPARATOR    = '#'
+    CHUNK_MARKER       = '\x00'
+    CHUNK_HEADER       = struct.Struct('!cBBBB')
+    CHUNK_COMPRESSED   = 0x01
+    MAX_NUM_CHUNKS     = 255
+    MAX_CHUNK_VERSIONS = 4
+
     def __init__(self, serviceName, serviceType, port, protocolVersion=1,
                  serviceRegisteredCallback=None,
                  serviceRegistrationFailedCallback=None,
@@ -44,7 +86,8 @@ class ZeroconfMessaging(threading.Thread):
                  peerServiceDiscoveryCallback=None,
                  peerServiceRemovalCallback=None,
                  peerServiceUpdateCallback=None,
-                 peerServiceDescriptionUpdatedCallback=None):
+                 peerServiceDescriptionUpdatedCallback=None,
+                 codec=None, debounce=DEBOUNCE, cacheResolves=True):
         super(ZeroconfMessaging, self).__init__(name='ZeroconfMessaging-Thread')
 
         # Ensure the callbacks are valid.
@@ -83,18 +126,31 @@ class ZeroconfMessaging(threading.Thread):
         self.serviceType     = serviceType
         self.protocolVersion = protocolVersion
         self.port            = port
+        self.codec           = codec if codec is not None else Codec([CompactCodec(), PickleCodec()])
+        self.debounce        = debounce
         # Message relaying.
         self.inbox  = Queue.Queue()
         self.outbox = Queue.Queue()
+        self.pendingMessage = None # The newest message that hasn't been sent yet.
+        self.lastSendTime   = None
         # Mutual exclusion.
-        self.lock = threading.Condition()
+        self.lock = profiler.Condition('ZeroconfMessaging.lock')
         # Metadata for the ZeroconfMessaging implementation.
-        self.txtRecords = {}
+        self.txtRecords    = {} # TXT record key -> data and record reference.
+        self.values        = {} # Message key -> value and the data of its TXT records.
+        self.chunkVersions = {} # Message key -> version of its last chunked value.
         # Metadata about peers.
         self.peers                                   = {}
         self.peersTxtRecords                         = {}
         self.peersTxtRecordsUpdatedSinceLastCallback = {}
         self.peersTxtRecordsDeletedSinceLastCallback = {}
+        self.peersTxtChunks                          = {} # (serviceName, interfaceIndex, key) -> chunks of the versions of a value.
+        # Cache of A records (for their TTL), so that the IP addresses of
+        # peers that are rediscovered (e.g. after they flapped) don't have to
+        # be queried again. The services themselves are always resolved
+        # again: a peer that was removed may have restarted on another port.
+        self.cacheResolves = cacheResolves
+        self.addressCache  = TTLCache() # (interfaceIndex, hosttarget) -> A record.
         # State variables.
         self.serverReady = False
         self.clientReady = False
@@ -105,6 +161,13 @@ class ZeroconfMessaging(threading.Thread):
         self.sdRefBrowse           = None # A single sdRef to discover peers.
         self.sdRefSingleShots      = []   # A list of sdRefs that need to return something just once.
         self.sdRefTXTRecordQueries = []   # A list of sdRefs that are "long-lived", always awaiting new/updated TXT records.
+        self.txtRecordQueries      = {}   # (serviceName, interfaceIndex) -> sdRef of its TXT record query.
+        # Statistics.
+        self.messagesSent       = 0
+        self.messagesSuperseded = 0
+        self.recordsAdded       = 0
+        self.recordsUpdated     = 0
+        self.recordsDeleted     = 0
 
 
     def run(self):
@@ -116,7 +179,8 @@ class ZeroconfMessaging(threading.Thread):
 
         while self.alive:
             # Process responses of the zeroconf server (register, browse,
-            # resolve, query callbacks).
+            # resolve, query callbacks). Blocks for at most PROCESS_TIMEOUT
+            # seconds, so the outbox is processed 50 times per second.
             self._processResponses()
 
             # When registration has been completed:
@@ -130,12 +194,9 @@ class ZeroconfMessaging(threading.Thread):
 
             # Commit suicide when asked to.
             with self.lock:
-                if self.die and self.outbox.qsize() == 0:
+                if self.die and self.outbox.qsize() == 0 and self.pendingMessage is None:
                     self._commitSuicide()
 
-            # Processing the queues 50 times per second is sufficient.
-            time.sleep(0.02)
-
 
     def kill(self):
         # Let the thread know it should commit suicide.
@@ -177,17 +238,37 @@ class ZeroconfMessaging(threading.Thread):
         if serviceName == self.serviceName:
             return
 
-        # Rediscovering an already discovered service (e.g. due to a new or
-        # updated TXT record) on the same interface also doesn't count.
-        if serviceName in self.peers.keys() and interfaceIndex in self.peers[serviceName].keys():
-            return
-
         # If no service is being added, then one is being removed.
         if not (flags & pybonjour.kDNSServiceFlagsAdd):
-            self.peerServiceRemovalCallback(serviceName, interfaceIndex)
+            if serviceName not in self.peers.keys() or interfaceIndex not in self.peers[serviceName].keys():
+                return
+            # Only peers that have been discovered completely (i.e. including
+            # their IP address) have to be reported as removed.
+            if 'ip' in self.peers[serviceName][interfaceIndex]:
+                self.peerServiceRemovalCallback(serviceName, interfaceIndex)
             del self.peers[serviceName][interfaceIndex]
             if len(self.peers[serviceName]) == 0:
                 del self.peers[serviceName]
+            # Forget its TXT records (and the chunks of its values): when it
+            # restarts, it starts over with a new service description.
+            for id in self.peersTxtChunks.keys():
+                if id[:2] == (serviceName, interfaceIndex):
+                    del self.peersTxtChunks[id]
+            if serviceName in self.peersTxtRecords:
+                for records in (self.peersTxtRecords, self.peersTxtRecordsUpdatedSinceLastCallback, self.peersTxtRecordsDeletedSinceLastCallback):
+                    records[serviceName].pop(interfaceIndex, None)
+                    if len(records[serviceName]) == 0:
+                        del records[serviceName]
+            # Stop monitoring this service's TXT records.
+            sdRef = self.txtRecordQueries.pop((serviceName, interfaceIndex), None)
+            if sdRef is not None:
+                self.sdRefTXTRecordQueries.remove(sdRef)
+                sdRef.close()
+            return
+
+        # Rediscovering an already discovered service (e.g. due to a new or
+        # updated TXT record) on the same interface doesn't count.
+        if serviceName in self.peers.keys() and interfaceIndex in self.peers[serviceName].keys():
             return
 
         # Create curried callbacks so we can pass additional data to the
@@ -242,12 +323,18 @@ class ZeroconfMessaging(threading.Thread):
                                     hosttarget = hosttarget,
                                     port = port)
 
-            # Retrieve the IP address by querying the peer's A record.
-            sdRef = pybonjour.DNSServiceQueryRecord(interfaceIndex = interfaceIndex,
-                                                    fullname = hosttarget,
-                                                    rrtype = pybonjour.kDNSServiceType_A,
-                                                    callBack = curriedCallback)
-            self.sdRefSingleShots.append(sdRef)
+            # Retrieve the IP address by querying the peer's A record, unless
+            # it was retrieved recently. The query is answered after the TXT
+            # record query below has been started.
+            cached = None
+            if self.cacheResolves:
+                cached = self.addressCache.get((interfaceIndex, hosttarget))
+            if cached is None:
+                sdRef = pybonjour.DNSServiceQueryRecord(interfaceIndex = interfaceIndex,
+                                                        fullname = hosttarget,
+                                                        rrtype = pybonjour.kDNSServiceType_A,
+                                                        callBack = curriedCallback)
+                self.sdRefSingleShots.append(sdRef)
 
             # Create a curried callback so we can pass additional data to the
             # (long-lived) TXT query record callback.
@@ -263,6 +350,13 @@ class ZeroconfMessaging(threading.Thread):
                                                     rrtype = pybonjour.kDNSServiceType_TXT,
                                                     callBack = curriedCallback)
             self.sdRefTXTRecordQueries.append(sdRef)
+            self.txtRecordQueries[(serviceName, interfaceIndex)] = sdRef
+
+            if cached is not None:
+                ttl = self.addressCache.timeToLive((interfaceIndex, hosttarget))
+                self._queryARecordCallback(None, 0, interfaceIndex, pybonjour.kDNSServiceErr_NoError,
+                                           hosttarget, pybonjour.kDNSServiceType_A, pybonjour.kDNSServiceClass_IN, cached, ttl,
+                                           serviceName=serviceName, hosttarget=hosttarget, port=port)
 
 
         # Secondary resolves: updated service or simply different txtRecords.
@@ -277,11 +371,16 @@ class ZeroconfMessaging(threading.Thread):
             for key in updatedServiceKeys:
                 curMetadata[key] = metadata[key]
                 newMetadata[key] = self.peers[serviceName][interfaceIndex][key]
-            # If the metadata differs: updated service.
+            # If the metadata differs: updated service. Only peers that have
+            # been discovered completely (i.e. including their IP address)
+            # are reported as updated; the others will be reported as
+            # discovered, with the updated metadata.
             if curMetadata != newMetadata:
+                peer = self.peers[serviceName][interfaceIndex]
                 for key in updatedServiceKeys:
-                    self.peers[serviceName][interfaceIndex][key] = metadata[key]
-                self.peerServiceUpdateCallback(serviceName, interfaceIndex, fullname, hosttarget, ip, port, txtRecord)
+                    peer[key] = metadata[key]
+                if 'ip' in peer:
+                    self.peerServiceUpdateCallback(serviceName, interfaceIndex, fullname, hosttarget, peer['ip'], port)
 
 
     def _queryARecordCallback(self, sdRef, flags, interfaceIndex, errorCode, fullname, rrtype, rrclass, rdata, ttl, serviceName, hosttarget, port):
@@ -290,19 +389,26 @@ class ZeroconfMessaging(threading.Thread):
         """
 
         if errorCode == pybonjour.kDNSServiceErr_NoError:
+            if self.cacheResolves and sdRef is not None:
+                self.addressCache.put((interfaceIndex, hosttarget), rdata, ttl)
+
             # We've now got *all* information about the peer with the same
-            # service. Time to call the callback.
+            # service. Time to call the callback. The metadata of the resolve
+            # is kept (fullname is the name of the A record here), including
+            # any updates since the query was started.
             ip = socket.inet_ntoa(rdata)
             if not serviceName in self.peers.keys():
                 self.peers[serviceName] = {}
-            self.peers[serviceName][interfaceIndex] = {
-                'serviceName' : serviceName,
-                'fullname' : fullname,
-                'hosttarget' : hosttarget,
-                'ip' : ip,
-                'port' : port,
-            }
-            self.peerServiceDiscoveryCallback(serviceName, interfaceIndex, fullname, hosttarget, ip, port)
+            if interfaceIndex not in self.peers[serviceName].keys():
+                self.peers[serviceName][interfaceIndex] = {
+                    'serviceName' : serviceName,
+                    'fullname' : fullname,
+                    'hosttarget' : hosttarget,
+                    'port' : port,
+                }
+            peer = self.peers[serviceName][interfaceIndex]
+            peer['ip'] = ip
+            self.peerServiceDiscoveryCallback(serviceName, interfaceIndex, peer['fullname'], peer['hosttarget'], ip, peer['port'])
         else:
             # TODO: add optional error callback?
             pass
@@ -330,6 +436,8 @@ class ZeroconfMessaging(threading.Thread):
                 # Remove this peer since it doesn't have a matching protocol
                 # version anyway.
                 self.sdRefTXTRecordQueries.remove(sdRef)
+                self.txtRecordQueries.pop((serviceName, interfaceIndex), None)
+                sdRef.close()
                 del self.peers[serviceName]
                 raise ProtocolVersionMismatch, "Removed peer '%s' due to protol version mismatch. Own protocol version: %s, other protocol version: %s." % (serviceName, self.protocolVersion, value)
             return
@@ -344,81 +452,163 @@ class ZeroconfMessaging(threading.Thread):
             self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex] = []
             self.peersTxtRecordsDeletedSinceLastCallback[serviceName][interfaceIndex] = []
         # When the value is 'DELETE', delete the corresponding key from the
-        # TXT records. Else, unpickle the value and update our local mirror
+        # TXT records. Else, decode the value and update our local mirror
         # of the peer's TXT records (and remember which records have been
         # updated, so we can send a single callback for multiple changes).
         if value == 'DELETE':
-            if serviceName in self.peersTxtRecords.keys():
-                if interfaceIndex in self.peersTxtRecords[serviceName].keys():
-                    if key in self.peersTxtRecords[serviceName][interfaceIndex].keys():
-                        del self.peersTxtRecords[serviceName][interfaceIndex][key]
-            self.peersTxtRecordsDeletedSinceLastCallback[serviceName][interfaceIndex].append(key)
+            # The TXT records of the other chunks of a value are deleted
+            # when the value (the TXT record of its first chunk) is deleted,
+            # or when the value shrinks.
+            if not self._isChunkKey(key):
+                if serviceName in self.peersTxtRecords.keys():
+                    if interfaceIndex in self.peersTxtRecords[serviceName].keys():
+                        if key in self.peersTxtRecords[serviceName][interfaceIndex].keys():
+                            del self.peersTxtRecords[serviceName][interfaceIndex][key]
+                self.peersTxtRecordsDeletedSinceLastCallback[serviceName][interfaceIndex].append(key)
+                self.peersTxtChunks.pop((serviceName, interfaceIndex, key), None)
+        # A chunk of a value: only once all chunks have been received, the
+        # value is new or updated.
+        elif value[:1] == self.CHUNK_MARKER:
+            key, value = self._addChunk(serviceName, interfaceIndex, key, value)
+            if key is not None:
+                self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex].append(key)
+                self.peersTxtRecords[serviceName][interfaceIndex][key] = value
         # Else, this is either a new or updated key-value pair. Mark the key
-        # as having an update and store the pickled value.
+        # as having an update and store the decoded value. Values that can't
+        # be decoded are ignored.
         else:
-            self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex].append(key)
-            self.peersTxtRecords[serviceName][interfaceIndex][key] = cPickle.loads(value)
+            self.peersTxtChunks.pop((serviceName, interfaceIndex, key), None)
+            try:
+                value = freeze(self.codec.decode(value))
+            except DecodeError:
+                pass
+            else:
+                self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex].append(key)
+                self.peersTxtRecords[serviceName][interfaceIndex][key] = value
 
         # Only put messages in the inbox when no more TXT record changes are
         # coming from this service/interface combo.
         if not (flags & pybonjour.kDNSServiceFlagsMoreComing):
-            # Get the TXT records and the keys of the updated and deleted TXT
-            # records.
+            # Get the updated TXT records and the keys of the deleted TXT
+            # records. A key may have been updated and deleted in the same
+            # burst: its current state wins. The values are immutable, so
+            # they can be passed on without copying them.
             txtRecords = self.peersTxtRecords[serviceName][interfaceIndex]
-            updated    = self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex]
-            deleted    = self.peersTxtRecordsDeletedSinceLastCallback[serviceName][interfaceIndex]
+            updatedKeys = self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex]
+            deletedKeys = self.peersTxtRecordsDeletedSinceLastCallback[serviceName][interfaceIndex]
+            updated = dict((key, txtRecords[key]) for key in updatedKeys if key in txtRecords)
+            deleted = [key for key in set(deletedKeys) if key not in txtRecords]
             # Erase the lists of keys of updated and deleted TXT records for
             # the next time.
             self.peersTxtRecordsUpdatedSinceLastCallback[serviceName][interfaceIndex] = []
             self.peersTxtRecordsDeletedSinceLastCallback[serviceName][interfaceIndex] = []
             # Send the callback, if it is callable.
             if callable(self.peerServiceDescriptionUpdatedCallback):
-                self.peerServiceDescriptionUpdatedCallback(serviceName, interfaceIndex, copy.deepcopy(txtRecords), updated, deleted)
+                self.peerServiceDescriptionUpdatedCallback(serviceName, interfaceIndex, updated, deleted)
             # Update the inbox. Only send the message itself, not the details.
             with self.lock:
-                message = [{header : txtRecords[header]} for header in updated]
+                message = [{header : value} for (header, value) in updated.items()]
                 if len(message):
                     self.inbox.put(message)
                     self.lock.notifyAll()
 
 
-    def _processResponses(self):
-        # Process responses for server (i.e. registration callback, TXT record
-        # updates).
+    def _isChunkKey(self, key):
+        """Whether a TXT record key is the key of a chunk (other than the
+        first) of a value."""
+        base, separator, index = key.rpartition(self.CHUNK_SEPARATOR)
+        return separator != '' and index.isdigit()
+
+
+    def _addChunk(self, serviceName, interfaceIndex, recordKey, data):
+        """Helper method for _queryTXTRecordCallback(). Store a chunk of a
+        value. Returns the key and the decoded value when this chunk
+        completes a new version of the value, (None, None) otherwise.
+        Chunks of multiple versions may be in flight at once, so they are
+        collected per version: the first version that is complete wins, and
+        the versions that were started before it are discarded."""
+        if len(data) < self.CHUNK_HEADER.size:
+            return (None, None)
+        marker, flags, version, index, numChunks = self.CHUNK_HEADER.unpack_from(data)
+        if index >= numChunks:
+            return (None, None)
+        key = recordKey if index == 0 else recordKey.rpartition(self.CHUNK_SEPARATOR)[0]
+
+        id = (serviceName, interfaceIndex, key)
+        value = self.peersTxtChunks.get(id)
+        if value is None:
+            value = {'complete' : None, 'versions' : OrderedDict()}
+            self.peersTxtChunks[id] = value
+        if version == value['complete']:
+            # A chunk of the version that was completed last.
+            return (None, None)
+        chunks = value['versions'].get(version)
+        if chunks is None or numChunks != chunks['numChunks']:
+            chunks = {'numChunks' : numChunks, 'chunks' : {}}
+            value['versions'][version] = chunks
+            while len(value['versions']) > self.MAX_CHUNK_VERSIONS:
+                value['versions'].popitem(last=False)
+        chunks['chunks'][index] = data[self.CHUNK_HEADER.size:]
+        if len(chunks['chunks']) < numChunks:
+            return (None, None)
+
+        value['complete'] = version
+        for v in value['versions'].keys():
+            del value['versions'][v]
+            if v == version:
+                break
+        data = ''.join(chunks['chunks'][i] for i in xrange(numChunks))
+        # A malformed value (or chunks of different values that happen to
+        # have the same version, e.g. after the peer restarted) is discarded.
+        try:
+            if flags & self.CHUNK_COMPRESSED:
+                data = zlib.decompress(data)
+            return (key, freeze(self.codec.decode(data)))
+        except (zlib.error, DecodeError):
+            return (None, None)
+
+
+    def _processResponses(self, timeout=PROCESS_TIMEOUT):
+        """Wait for responses on all service descriptor references at once,
+        with a single select() call, then process the responses of those that
+        are ready. Blocks for at most timeout seconds, regardless of the
+        number of peers."""
+
+        # Server (i.e. registration callback, TXT record updates).
+        sdRefs = []
         if self.sdRefServer is not None:
-            self._processResponsesForService(self.sdRefServer)
-
-        # Process responses for client (i.e. detecting peers with a matching
-        # service type and peers' updated TXT records).
+            sdRefs.append(self.sdRefServer)
+        # Client (i.e. detecting peers with a matching service type and
+        # peers' updated TXT records).
         if self.serverReady and self.clientReady and self.sdRefBrowse is not None:
-            self._processResponsesForService(self.sdRefBrowse)
-
-        # Process responses for one shot service descriptor references (i.e.
-        # resolve and A record query callbacks). These service descriptor
-        # references must be closed as soon as we get input (hence "one shot").
-        for sdRef in self.sdRefSingleShots:
-            if self._processResponsesForService(sdRef):
-                self.sdRefSingleShots.remove(sdRef)
-                sdRef.close()
-
-        # Process responses for "long-lived" service descriptor references
-        # (i.e. TXT record query callbacks).
-        for sdRef in self.sdRefTXTRecordQueries:
-            self._processResponsesForService(sdRef)
-
+            sdRefs.append(self.sdRefBrowse)
+        # One shot (i.e. resolve and A record query callbacks) and
+        # "long-lived" (i.e. TXT record query callbacks) service descriptor
+        # references.
+        sdRefs.extend(self.sdRefSingleShots)
+        sdRefs.extend(self.sdRefTXTRecordQueries)
+
+        if len(sdRefs) == 0:
+            time.sleep(timeout)
+            return
 
-    def _processResponsesForService(self, sdRef):
-        """Helper function for _procesResponses(). Returns True when input was
-        ready, False otherwise."""
+        try:
+            inputReady, outputReady, exceptReady = select.select(sdRefs, [], [], timeout)
+        except select.error:
+            # Interrupted by a signal.
+            return
 
-        # If there's input waiting to be processed, process it. Only wait
-        # for input for 0.05 seconds (avoid blocking).
-        inputReady, outputReady, exceptReady = select.select([sdRef], [], [], 0.05)
-        if sdRef in inputReady:
+        for sdRef in inputReady:
+            # The callback of another sdRef may have closed this one (e.g.
+            # when a peer was removed).
+            if sdRef not in (self.sdRefServer, self.sdRefBrowse) and sdRef not in self.sdRefSingleShots and sdRef not in self.sdRefTXTRecordQueries:
+                continue
             pybonjour.DNSServiceProcessResult(sdRef)
-            return True
-
-        return False
+            # One shot service descriptor references must be closed as soon
+            # as we get input (hence "one shot").
+            if sdRef in self.sdRefSingleShots:
+                self.sdRefSingleShots.remove(sdRef)
+                sdRef.close()
 
 
     def _serviceRegisteredCallback(self, sdRef, flags, errorCode, name, regtype, domain):
@@ -436,41 +626,60 @@ class ZeroconfMessaging(threading.Thread):
 
 
     def _send(self):
-        """Send all messages waiting to be sent in the outbox."""
+        """Send the newest message waiting to be sent in the outbox: it
+        supersedes the older ones. When the debounce window since the
+        previous message hasn't passed yet, the message is kept until it has
+        (unless a newer one supersedes it in the mean time)."""
 
         with self.lock:
             while self.outbox.qsize() > 0:
-                self._sendMessage(self.outbox.get())
+                if self.pendingMessage is not None:
+                    self.messagesSuperseded += 1
+                self.pendingMessage = self.outbox.get()
+            if self.pendingMessage is None:
+                return
+            now = time.time()
+            if self.lastSendTime is not None and now - self.lastSendTime < self.debounce:
+                return
+            message = self.pendingMessage
+            self.pendingMessage = None
+            self.lastSendTime = now
+            self._sendMessage(message)
+            self.messagesSent += 1
 
 
     def _sendMessage(self, message):
         """Helper method for _send()."""
 
+        # Encode the values that changed into the data for their TXT records;
+        # reuse the data of the values that didn't change. A copy of each
+        # value is kept, so that a value that was changed in place and then
+        # sent again is detected as changed.
         newTxtRecords = {}
         for key, value in message.items():
-            serializedValue = cPickle.dumps(value)
-            # Validate TXT record size: it should never exceed 255 bytes.
-            if len(key) + len('=') + len(serializedValue) > 255:
-                raise MessageTooLargeError, "message size is: %d for key '%s'" % (len(key) + len('=') + len(serializedValue), key)
-            txt = pybonjour.TXTRecord({key : serializedValue})
-            newTxtRecords[key] = {'value' : value, 'txtRecord' : txt}
+            if key not in self.values or self.values[key]['value'] != value:
+                self.values[key] = {'value' : copy.deepcopy(value), 'records' : self._encodeValue(key, value)}
+            newTxtRecords.update(self.values[key]['records'])
+        for key in self.values.keys():
+            if key not in message:
+                del self.values[key]
 
         # Make sets out of the keys of the TXT records to make it easier to
         # determine what should happen.
         curKeys = set(self.txtRecords.keys())
         newKeys = set(newTxtRecords.keys())
 
-        # Update: intersection of current and new TXT records, plus a value
-        # comparison to ensure we only update when the value actually changed.
+        # Update: intersection of current and new TXT records, plus a data
+        # comparison to ensure we only update when the data actually changed.
         for key in curKeys.intersection(newKeys):
-            if self.txtRecords[key]['value'] != newTxtRecords[key]['value']:
+            if self.txtRecords[key]['data'] != newTxtRecords[key]:
                 # print "\tUpdating:", key
                 pybonjour.DNSServiceUpdateRecord(sdRef = self.sdRefServer,
                                                  RecordRef = self.txtRecords[key]['recordReference'],
-                                                 rdata = newTxtRecords[key]['txtRecord'])
+                                                 rdata = pybonjour.TXTRecord({key : newTxtRecords[key]}))
                 # Update the stored TXT record.
-                self.txtRecords[key]['txtRecord'] = newTxtRecords[key]['txtRecord']
-                self.txtRecords[key]['value']     = newTxtRecords[key]['value']
+                self.txtRecords[key]['data'] = newTxtRecords[key]
+                self.recordsUpdated += 1
 
         # Remove: difference of current with new TXT records.
         for key in curKeys.difference(newKeys):
@@ -487,17 +696,61 @@ class ZeroconfMessaging(threading.Thread):
             #                                  RecordRef = self.txtRecords[key]['recordReference'])
             # Remove the stored TXT record.
             del self.txtRecords[key]
+            self.recordsDeleted += 1
 
         # Add: difference of new with current TXT records.
         for key in newKeys.difference(curKeys):
             # print "\tAdding:", key
             rRef = pybonjour.DNSServiceAddRecord(sdRef = self.sdRefServer,
                                                  rrtype = pybonjour.kDNSServiceType_TXT,
-                                                 rdata = newTxtRecords[key]['txtRecord'])
-            # Store the new TXT record.
-            self.txtRecords[key] = newTxtRecords[key]
-            # Also store the record reference.
-            self.txtRecords[key]['recordReference'] = rRef
+                                                 rdata = pybonjour.TXTRecord({key : newTxtRecords[key]}))
+            # Store the new TXT record, along with the record reference.
+            self.txtRecords[key] = {'data' : newTxtRecords[key], 'recordReference' : rRef}
+            self.recordsAdded += 1
+
+
+    def _encodeValue(self, key, value):
+        """Helper method for _sendMessage(). Encode a value into the data for
+        one or more TXT records. Returns a dict of TXT record keys and
+        data."""
+        if self.CHUNK_SEPARATOR in key:
+            raise InvalidKeyError, "key '%s' contains '%s'" % (key, self.CHUNK_SEPARATOR)
+        data = self.codec.encode(value)
+        if len(key) + len('=') + len(data) <= self.TXT_RECORD_SIZE:
+            return {key : data}
+
+        # The value doesn't fit in a single TXT record: compress it and split
+        # it into chunks. The chunk size is the same for all chunks, so it
+        # must leave room for the longest chunk key.
+        flags = 0
+        compressed = zlib.compress(data, 9)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= self.CHUNK_COMPRESSED
+        chunkSize = self.TXT_RECORD_SIZE - len(key) - len('%s%d=' % (self.CHUNK_SEPARATOR, self.MAX_NUM_CHUNKS - 1)) - self.CHUNK_HEADER.size
+        numChunks = int(math.ceil(1.0 * len(data) / max(1, chunkSize)))
+        if chunkSize <= 0 or numChunks > self.MAX_NUM_CHUNKS:
+            raise MessageTooLargeError, "%d bytes for key '%s' don't fit in %d TXT records" % (len(data), key, self.MAX_NUM_CHUNKS)
+        version = (self.chunkVersions.get(key, 0) + 1) % 256
+        self.chunkVersions[key] = version
+        records = {}
+        for i in xrange(numChunks):
+            recordKey = key if i == 0 else '%s%s%d' % (key, self.CHUNK_SEPARATOR, i)
+            header = self.CHUNK_HEADER.pack(self.CHUNK_MARKER, flags, version, i, numChunks)
+            records[recordKey] = header + data[i * chunkSize:(i + 1) * chunkSize]
+        return records
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'messages sent'       : self.messagesSent,
+                'messages superseded' : self.messagesSuperseded,
+                'records added'       : self.recordsAdded,
+                'records updated'     : self.recordsUpdated,
+                'records deleted'     : self.recordsDeleted,
+                'address cache'       : self.addressCache.stats(),
+            }
 
 
     def _commitSuicide(self):
@@ -548,11 +801,11 @@ if __name__ == "__main__":
     def peerServiceUpdateCallback(serviceName, interfaceIndex, fullname, hosttarget, ip, port):
         print "SERVICE UPDATE CALLBACK FIRED, params: serviceName=%s, interfaceIndex=%d, fullname=%s, hosttarget=%s, ip=%s, port=%d" % (serviceName, interfaceIndex, fullname, hosttarget, ip, port)
 
-    def peerServiceDescriptionUpdatedCallback(serviceName, interfaceIndex, txtRecords, updated, deleted):
-        print "SERVICE DESCRIPTION UPDATED CALLBACK FIRED", serviceName, interfaceIndex, txtRecords
+    def peerServiceDescriptionUpdatedCallback(serviceName, interfaceIndex, updated, deleted):
+        print "SERVICE DESCRIPTION UPDATED CALLBACK FIRED", serviceName, interfaceIndex
         print "\tupdated:"
-        for key in updated:
-            print "\t\t", key, txtRecords[key]
+        for key, value in updated.items():
+            print "\t\t", key, value
         print "\tdeleted:"
         for key in deleted:
             print "\t\t", key
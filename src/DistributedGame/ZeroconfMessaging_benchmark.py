@@ -0,0 +1,213 @@
+"""Benchmarks for ZeroconfMessaging.
+
+pybonjour is replaced by SimulatedBonjour, so that many peers can be simulated
+in a single process, without real hosts or an mDNS daemon.
+"""
+
+
+import sys
+import time
+from optparse import OptionParser
+
+import SimulatedBonjour
+sys.modules['pybonjour'] = SimulatedBonjour
+from ZeroconfMessaging import ZeroconfMessaging
+
+
+SERVICE_TYPE = '_benchmark._tcp'
+TXT_RECORD   = SimulatedBonjour.TXTRecord({'textvers' : 1})
+
+
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a list of values."""
+    values = sorted(values)
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def waitFor(condition, timeout):
+    """Wait until condition() is true or the timeout expires."""
+    endTime = time.time() + timeout
+    while not condition() and time.time() < endTime:
+        time.sleep(0.001)
+    return condition()
+
+
+def createObserver(discovered, removed, descriptionUpdatedCallback=None, **kwargs):
+    """Create the ZeroconfMessaging instance under test. It records when
+    peers are discovered and removed."""
+    ignore = lambda *args: None
+    return ZeroconfMessaging('observer', SERVICE_TYPE, 1000, 1,
+                             serviceRegisteredCallback=ignore,
+                             serviceRegistrationFailedCallback=ignore,
+                             serviceUnregisteredCallback=ignore,
+                             peerServiceDiscoveryCallback=lambda serviceName, *args: discovered.__setitem__(serviceName, time.time()),
+                             peerServiceRemovalCallback=lambda serviceName, *args: removed.add(serviceName),
+                             peerServiceUpdateCallback=ignore,
+                             peerServiceDescriptionUpdatedCallback=descriptionUpdatedCallback or ignore,
+                             **kwargs)
+
+
+def createHost(i):
+    """Create a simulated host. Its thread isn't started: the benchmark
+    registers its service and publishes its service description directly,
+    so that hundreds of hosts don't need hundreds of threads."""
+    ignore = lambda *args: None
+    return ZeroconfMessaging('host %d' % (i), SERVICE_TYPE, 2000 + i, 1,
+                             serviceRegisteredCallback=ignore,
+                             serviceRegistrationFailedCallback=ignore,
+                             serviceUnregisteredCallback=ignore,
+                             peerServiceDiscoveryCallback=ignore,
+                             peerServiceRemovalCallback=ignore,
+                             peerServiceUpdateCallback=ignore,
+                             peerServiceDescriptionUpdatedCallback=ignore)
+
+
+def describeHost(i, version):
+    """A service description like the one of ManyInARowService: a few games,
+    plus a version number, which is what the benchmark waits for."""
+    return {
+        'version' : version,
+        'games'   : [(i * 10 + j, 'game %d of host %d' % (j, i), 2 + j, 7, 6) for j in xrange(3)],
+    }
+
+
+def benchmarkFlaps(numPeers, numFlaps, latency, cacheResolves, timeout):
+    """Let numPeers peers disappear and reappear numFlaps times (e.g. due to
+    a flaky WiFi connection). Returns the rediscovery latencies, the number
+    of resolve and A record queries and the stats of the observer."""
+    network = SimulatedBonjour.network
+    network.reset(latency)
+    discovered = {}
+    removed    = set()
+    z = createObserver(discovered, removed, cacheResolves=cacheResolves)
+    z.start()
+    latencies = []
+    try:
+        names = [network.addService('peer %d' % (i), SERVICE_TYPE, 2000 + i, TXT_RECORD) for i in xrange(numPeers)]
+        waitFor(lambda: len(discovered) == numPeers, timeout)
+        queriesBefore = network.stats()['calls']
+
+        for flap in xrange(numFlaps):
+            for name in names:
+                network.removeService(name)
+            waitFor(lambda: len(removed) == numPeers, timeout)
+            removed.clear()
+            discovered.clear()
+
+            start = time.time()
+            for i, name in enumerate(names):
+                network.addService(name, SERVICE_TYPE, 2000 + i, TXT_RECORD)
+            waitFor(lambda: len(discovered) == numPeers, timeout)
+            latencies.extend(discoveryTime - start for discoveryTime in discovered.values())
+
+        queries = network.stats()['calls']
+    finally:
+        z.kill()
+        z.join()
+    resolves = queries.get('DNSServiceResolve', 0) - queriesBefore.get('DNSServiceResolve', 0)
+    aQueries = queries.get('DNSServiceQueryRecord', 0) - queriesBefore.get('DNSServiceQueryRecord', 0) - numPeers * numFlaps # Minus the TXT record queries.
+    return latencies, resolves, aQueries, z.stats()
+
+
+def benchmarkDiscovery(numHosts, latency, loss, timeout):
+    """Let numHosts hosts appear at once, each with a service description.
+    Then let each of them update its description. Returns the time it took
+    to fully discover each host (i.e. up to and including its description),
+    the time it took for each updated description to arrive and the stats
+    of the network."""
+    network = SimulatedBonjour.network
+    network.reset(latency, loss)
+    received = {} # (Service name, version) -> arrival time.
+    def descriptionUpdated(serviceName, interfaceIndex, updated, deleted):
+        if 'version' in updated:
+            received[(serviceName, updated['version'])] = time.time()
+    z = createObserver({}, set(), descriptionUpdated)
+    z.start()
+    hosts = [createHost(i) for i in xrange(numHosts)]
+    try:
+        waitFor(lambda: z.serverReady and z.clientReady, timeout)
+
+        start = time.time()
+        for i, host in enumerate(hosts):
+            host._register()
+            host._sendMessage(describeHost(i, 1))
+        waitFor(lambda: len(received) == numHosts, timeout)
+        discoveryTimes = [received[(host.serviceName, 1)] - start for host in hosts if (host.serviceName, 1) in received]
+
+        start = time.time()
+        for i, host in enumerate(hosts):
+            host._sendMessage(describeHost(i, 2))
+        waitFor(lambda: len(received) == 2 * numHosts, timeout)
+        propagationTimes = [received[(host.serviceName, 2)] - start for host in hosts if (host.serviceName, 2) in received]
+    finally:
+        for host in hosts:
+            if host.sdRefServer is not None:
+                host.sdRefServer.close()
+        z.kill()
+        z.join()
+    return discoveryTimes, propagationTimes, network.stats()
+
+
+def runDiscoveryBenchmarks(options):
+    print "%d ms mDNS latency, %.0f%% of the responses lost" % (options.latency * 1000, options.loss * 100)
+    print "%-6s %10s %10s %10s %10s %10s %10s %10s" % ('hosts', 'discovered', 'p50 (ms)', 'p99 (ms)', 'max (ms)',
+                                                      'TXT p50', 'TXT p99', 'TXT max')
+    for numHosts in [int(n) for n in options.hosts.split(',')]:
+        discoveryTimes, propagationTimes, stats = benchmarkDiscovery(numHosts, options.latency, options.loss, options.timeout)
+        if len(discoveryTimes) == 0 or len(propagationTimes) == 0:
+            print "%-6d %10d (timed out)" % (numHosts, len(discoveryTimes))
+            continue
+        print "%-6d %10d %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f" % (numHosts, len(discoveryTimes),
+                                                                       percentile(discoveryTimes, 50) * 1000,
+                                                                       percentile(discoveryTimes, 99) * 1000,
+                                                                       max(discoveryTimes) * 1000,
+                                                                       percentile(propagationTimes, 50) * 1000,
+                                                                       percentile(propagationTimes, 99) * 1000,
+                                                                       max(propagationTimes) * 1000)
+    print "responses sent: %d, lost: %d" % (stats['responses sent'], stats['responses lost'])
+
+
+def runFlapBenchmarks(options):
+    print "%d peers, %d flaps, %d ms mDNS latency" % (options.peers, options.flaps, options.latency * 1000)
+    print "%-8s %12s %12s %10s %10s %10s" % ('cache', 'rediscovered', 'resolves', 'A queries', 'p50 (ms)', 'p99 (ms)')
+    for name, cacheResolves in (('off', False), ('on', True)):
+        latencies, resolves, aQueries, stats = benchmarkFlaps(options.peers, options.flaps, options.latency, cacheResolves, options.timeout)
+        print "%-8s %12d %12d %10d %10.1f %10.1f" % (name, len(latencies), resolves, aQueries,
+                                                     percentile(latencies, 50) * 1000,
+                                                     percentile(latencies, 99) * 1000)
+    print "address cache:", stats['address cache']
+
+
+
+
+BENCHMARKS = {
+    'discovery' : runDiscoveryBenchmarks,
+    'flap'      : runFlapBenchmarks,
+}
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-p", "--peers", type="int", dest="peers", default=20,
+                      help="number of simulated peers")
+    parser.add_option("-f", "--flaps", type="int", dest="flaps", default=5,
+                      help="number of times all peers disappear and reappear")
+    parser.add_option("-n", "--hosts", dest="hosts", default="10,50,100,200",
+                      help="comma-separated numbers of simulated hosts to discover")
+    parser.add_option("-l", "--latency", type="float", dest="latency", default=0.05,
+                      help="latency of the simulated mDNS responses (seconds)")
+    parser.add_option("-L", "--loss", type="float", dest="loss", default=0.0,
+                      help="fraction of the simulated mDNS responses that is lost")
+    parser.add_option("-t", "--timeout", type="float", dest="timeout", default=30,
+                      help="maximum time to wait for peers to be (re)discovered (seconds)")
+    parser.usage = "%%prog [options] [%s]" % '|'.join(sorted(BENCHMARKS.keys()))
+    (options, args) = parser.parse_args()
+
+    for name in args or sorted(BENCHMARKS.keys()):
+        print "== %s ==" % name
+        BENCHMARKS[name](options)
+        print
+    SimulatedBonjour.network.stop()
@@ -0,0 +1,283 @@
+import random
+import select
+import sys
+import unittest
+
+import SimulatedBonjour
+sys.modules['pybonjour'] = SimulatedBonjour
+from ZeroconfMessaging import *
+
+
+SERVICE_TYPE = '_test._tcp'
+
+
+def createZeroconfMessaging(name, port, **kwargs):
+    callbacks = {}
+    for callback in ('serviceRegisteredCallback', 'serviceRegistrationFailedCallback', 'serviceUnregisteredCallback',
+                     'peerServiceDiscoveryCallback', 'peerServiceRemovalCallback', 'peerServiceUpdateCallback',
+                     'peerServiceDescriptionUpdatedCallback'):
+        callbacks[callback] = kwargs.pop(callback, lambda *args: None)
+    callbacks.update(kwargs)
+    return ZeroconfMessaging(name, SERVICE_TYPE, port, 1, **callbacks)
+
+
+def largeValue(seed):
+    """A value that doesn't fit in a single TXT record, even compressed."""
+    r = random.Random(seed)
+    return [r.random() for i in xrange(100)]
+
+
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.z = createZeroconfMessaging('test', 1000)
+
+
+    def addChunks(self, records, recordKeys):
+        """Add the chunks of the given TXT records (in the given order) as a
+        peer's. Returns the values that were completed."""
+        values = []
+        for recordKey in recordKeys:
+            key, value = self.z._addChunk('peer', 1, recordKey, records[recordKey])
+            if key is not None:
+                values.append((key, value))
+        return values
+
+
+    def testChunkedValue(self):
+        records = self.z._encodeValue('moves', largeValue(0))
+        self.assertTrue(len(records) > 2)
+        # Out of order: the first chunk arrives last.
+        recordKeys = sorted(records.keys(), reverse=True)
+        self.assertEqual(recordKeys[-1], 'moves')
+        self.assertEqual(self.addChunks(records, recordKeys), [('moves', tuple(largeValue(0)))])
+        # Chunks of a value that was completed already are ignored.
+        self.assertEqual(self.addChunks(records, recordKeys), [])
+
+
+    def testNewerVersionReplacesIncompleteSet(self):
+        old = self.z._encodeValue('moves', largeValue(0))
+        new = self.z._encodeValue('moves', largeValue(1))
+        oldKeys = sorted(old.keys())
+        self.assertEqual(self.addChunks(old, oldKeys[:2]), [])
+        self.assertEqual(self.addChunks(new, sorted(new.keys())), [('moves', tuple(largeValue(1)))])
+        # The rest of the older version never completes.
+        self.assertEqual(self.addChunks(old, oldKeys[2:]), [])
+
+
+    def testVersionsPerKey(self):
+        """Updates of other keys don't make an update of a key look stale."""
+        records = self.z._encodeValue('a', largeValue(0))
+        self.assertEqual(len(self.addChunks(records, records.keys())), 1)
+        for i in xrange(200):
+            self.z._encodeValue('b', largeValue(i))
+        records = self.z._encodeValue('a', largeValue(1))
+        self.assertEqual(self.addChunks(records, records.keys()), [('a', tuple(largeValue(1)))])
+
+
+    def testMalformedChunks(self):
+        records = self.z._encodeValue('moves', largeValue(0))
+        # Chunks of another value with the same version and number of
+        # chunks (e.g. from before the peer restarted) are mixed in.
+        other = createZeroconfMessaging('other', 1001)._encodeValue('moves', largeValue(1))
+        self.assertEqual(len(records), len(other))
+        recordKeys = sorted(records.keys())
+        records[recordKeys[0]] = other[recordKeys[0]]
+        self.assertEqual(self.addChunks(records, recordKeys), [])
+
+
+
+
+
+class TestDebounce(unittest.TestCase):
+    """Drives the sending side by hand, without its thread."""
+
+    def setUp(self):
+        SimulatedBonjour.network.reset()
+        self.z = createZeroconfMessaging('test', 1000, debounce=60)
+        self.z._register()
+
+
+    def tearDown(self):
+        self.z._commitSuicide()
+
+
+    def send(self, message):
+        self.z.outbox.put(message)
+        self.z._send()
+
+
+    def endDebounceWindow(self):
+        self.z.lastSendTime -= self.z.debounce
+
+
+    def recordUpdates(self):
+        return SimulatedBonjour.network.stats()['calls'].get('DNSServiceUpdateRecord', 0)
+
+
+    def testLatestWins(self):
+        """Several quick updates result in a single record update, which
+        carries the last value."""
+        self.send({'moves' : 0})
+        self.assertEqual(self.z.txtRecords['moves']['data'], self.z.codec.encode(0))
+        for i in xrange(1, 5):
+            self.send({'moves' : i})
+        self.assertEqual(self.recordUpdates(), 0)
+        self.assertEqual(self.z.txtRecords['moves']['data'], self.z.codec.encode(0))
+
+        self.endDebounceWindow()
+        self.z._send()
+        self.assertEqual(self.recordUpdates(), 1)
+        self.assertEqual(self.z.txtRecords['moves']['data'], self.z.codec.encode(4))
+        stats = self.z.stats()
+        self.assertEqual(stats['messages sent'], 2)
+        self.assertEqual(stats['messages superseded'], 3)
+
+        # Nothing is left to be sent.
+        self.endDebounceWindow()
+        self.z._send()
+        self.assertEqual(self.recordUpdates(), 1)
+
+
+    def testValueChangedInPlace(self):
+        moves = [1, 2]
+        self.send({'moves' : moves})
+        moves.append(3)
+        self.endDebounceWindow()
+        self.send({'moves' : moves})
+        self.assertEqual(self.recordUpdates(), 1)
+        self.assertEqual(self.z.txtRecords['moves']['data'], self.z.codec.encode([1, 2, 3]))
+
+
+
+
+
+class TestResponses(unittest.TestCase):
+
+    PEERS = 5
+
+    def setUp(self):
+        SimulatedBonjour.network.reset()
+        self.discovered = []
+        self.removed    = []
+        self.z = createZeroconfMessaging('test', 1000,
+                                         peerServiceDiscoveryCallback=lambda *args: self.discovered.append(args),
+                                         peerServiceRemovalCallback=lambda *args: self.removed.append(args))
+        # Count the select() calls, and how many sdRefs each one found ready.
+        self.readyPerSelect = []
+        self.realSelect = select.select
+        def countingSelect(*args):
+            ready = self.realSelect(*args)
+            self.readyPerSelect.append(len(ready[0]))
+            return ready
+        select.select = countingSelect
+
+
+    def tearDown(self):
+        select.select = self.realSelect
+        self.z._commitSuicide()
+
+
+    def processUntil(self, condition):
+        """Process responses until condition() is true. Returns the number of
+        iterations."""
+        iterations = 0
+        while not condition() and iterations < 100:
+            self.z._processResponses(0.1)
+            iterations += 1
+        return iterations
+
+
+    def testSingleSelectLoop(self):
+        """The browse, resolve and query sdRefs of many peers are served by
+        a single select() call per iteration."""
+        txtRecord = SimulatedBonjour.TXTRecord({'textvers' : 1})
+        for i in xrange(self.PEERS):
+            SimulatedBonjour.network.addService('peer %d' % (i), SERVICE_TYPE, 2000 + i, txtRecord)
+        self.z._register()
+        self.z._browse()
+        iterations = self.processUntil(lambda: len(self.discovered) == self.PEERS)
+
+        self.assertEqual(sorted(args[0] for args in self.discovered), ['peer %d' % (i) for i in xrange(self.PEERS)])
+        self.assertEqual(len(self.readyPerSelect), iterations)
+        # On average, more than two sdRefs were ready per select() call.
+        self.assertTrue(sum(self.readyPerSelect) > 2 * len(self.readyPerSelect))
+        # All resolves and A record queries have been answered and closed;
+        # the TXT record queries remain.
+        self.assertEqual(self.z.sdRefSingleShots, [])
+        self.assertEqual(len(self.z.sdRefTXTRecordQueries), self.PEERS)
+        calls = SimulatedBonjour.network.stats()['calls']
+        self.assertEqual(calls['DNSServiceResolve'], self.PEERS)
+
+
+    def testRestartedPeer(self):
+        """A peer that was removed and added again is resolved again: it may
+        have restarted on another port."""
+        txtRecord = SimulatedBonjour.TXTRecord({'textvers' : 1})
+        SimulatedBonjour.network.addService('peer', SERVICE_TYPE, 2000, txtRecord)
+        self.z._register()
+        self.z._browse()
+        self.processUntil(lambda: len(self.discovered) == 1)
+        SimulatedBonjour.network.removeService('peer')
+        self.processUntil(lambda: len(self.removed) == 1)
+        SimulatedBonjour.network.addService('peer', SERVICE_TYPE, 3000, txtRecord)
+        self.processUntil(lambda: len(self.discovered) == 2)
+
+        self.assertEqual([args[-1] for args in self.discovered], [2000, 3000])
+        calls = SimulatedBonjour.network.stats()['calls']
+        self.assertEqual(calls['DNSServiceResolve'], 2)
+        # The IP address was cached.
+        self.assertEqual(calls['DNSServiceQueryRecord'], 1 + 2) # Plus the TXT record queries.
+
+
+    def testRestartedPeerDescription(self):
+        """The TXT records of a peer are forgotten when it's removed: after
+        it restarted, only its new service description is known."""
+        def startPeer(description):
+            peer = createZeroconfMessaging('peer', 2000)
+            peer._register()
+            peer.outbox.put(description)
+            peer._send()
+            return peer
+        peerTxtRecords = lambda: self.z.peersTxtRecords.get('peer', {}).values()
+        peer = startPeer({'a' : 1, 'b' : 2})
+        self.z._register()
+        self.z._browse()
+        self.processUntil(lambda: peerTxtRecords() == [{'a' : 1, 'b' : 2}])
+        peer._commitSuicide()
+        self.processUntil(lambda: len(self.removed) == 1)
+        self.assertEqual(self.z.peersTxtRecords, {})
+        self.assertEqual(self.z.peersTxtRecordsUpdatedSinceLastCallback, {})
+        self.assertEqual(self.z.peersTxtRecordsDeletedSinceLastCallback, {})
+
+        peer = startPeer({'a' : 3})
+        try:
+            self.processUntil(lambda: [records.get('a') for records in peerTxtRecords()] == [3])
+            self.assertEqual(peerTxtRecords(), [{'a' : 3}])
+        finally:
+            peer._commitSuicide()
+
+
+    def testUpdatedService(self):
+        """A peer that is resolved again with other metadata is reported as
+        updated, with its IP address."""
+        updates = []
+        self.z.peerServiceUpdateCallback = lambda *args: updates.append(args)
+        SimulatedBonjour.network.addService('peer', SERVICE_TYPE, 2000, SimulatedBonjour.TXTRecord({'textvers' : 1}))
+        self.z._register()
+        self.z._browse()
+        self.processUntil(lambda: len(self.discovered) == 1)
+        serviceName, interfaceIndex, fullname, hosttarget, ip, port = self.discovered[0]
+        # Resolved again with the same metadata: not updated.
+        self.z._resolveCallback(None, 0, interfaceIndex, SimulatedBonjour.kDNSServiceErr_NoError, fullname, hosttarget, port, '', serviceName='peer')
+        self.assertEqual(updates, [])
+        self.z._resolveCallback(None, 0, interfaceIndex, SimulatedBonjour.kDNSServiceErr_NoError, fullname, hosttarget, 3000, '', serviceName='peer')
+        self.assertEqual(updates, [('peer', interfaceIndex, fullname, hosttarget, ip, 3000)])
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
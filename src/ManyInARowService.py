@@ -25,8 +25,9 @@ class ManyInARowService(OneToManyService):
         # TRICKY: fix Python screwup.
         self.SERVICE_NAME = self.SERVICE_NAME[0]
 
-        # Call parent constructor with appropriate parameters.
-        super(ManyInARowService, self).__init__(self.SERVICE_NAME, self.SERVICE_TYPE, self.SERVICE_PORT, self.SERVICE_PROT)
+        # Call parent constructor with appropriate parameters. Received moves
+        # are routed directly to the game sessions, without polling.
+        super(ManyInARowService, self).__init__(self.SERVICE_NAME, self.SERVICE_TYPE, self.SERVICE_PORT, self.SERVICE_PROT, directRouting=True)
         # Callbacks.
         if not callable(guiServiceRegisteredCallback):
             raise InvalidCallbackError, "guiServiceRegisteredCallback"
@@ -67,6 +68,7 @@ class ManyInARowService(OneToManyService):
         self.player            = player
         self.otherPlayers      = {}
         self.games             = {}
+        self.pendingGames      = {} # Service name -> games received before its player.
         
         # Broadcast the updated game list.
         self.buildServiceDescription()
@@ -90,11 +92,18 @@ class ManyInARowService(OneToManyService):
 
     def _peerServiceRemovalCallback(self, serviceName, interfaceIndex):
         # Update the player associated with this service, if any.
+        self.pendingGames.pop(serviceName, None)
         if self.otherPlayers.has_key(serviceName):
             player = self.otherPlayers[serviceName]
             del self.otherPlayers[serviceName]
             self.guiPlayerLeftCallback(player)
 
+            # The player no longer participates in any game.
+            changedGames = [gameUUID for gameUUID in self.games.keys() if player.UUID in self.games[gameUUID]['players']]
+            for gameUUID in changedGames:
+                self._removePlayerFromGame(gameUUID, player.UUID)
+            self._updateServiceDescription(changedGames)
+
         self.guiPeerServiceRemovedCallback(serviceName, interfaceIndex)
 
 
@@ -102,45 +111,63 @@ class ManyInARowService(OneToManyService):
         pass
 
 
-    def _peerServiceDescriptionUpdatedCallback(self, serviceName, interfaceIndex, txtRecords, updated, deleted):
-        description = txtRecords
+    def _peerServiceDescriptionUpdatedCallback(self, serviceName, interfaceIndex, updated, deleted):
+        # Only the keys that were updated or deleted are passed, so only the
+        # games that changed are looked at. The values are immutable: they
+        # must be copied before they can be modified.
+
+        # The game keys may arrive before the 'player' key (e.g. when the TXT
+        # records are split over multiple mDNS packets). Keep them until the
+        # player is known, since only deltas are passed.
+        if not self.otherPlayers.has_key(serviceName):
+            pending = self.pendingGames.setdefault(serviceName, {})
+            pending.update(updated)
+            for gameUUID in deleted:
+                pending.pop(gameUUID, None)
+            if not pending.has_key('player'):
+                return
+            updated, deleted = self.pendingGames.pop(serviceName), []
 
         # If the service description update contains player information, sync
         # it with our information.
-        if description.has_key('player'):
+        if updated.has_key('player'):
             # Add or update the player object. guiPlayerLeftCallback is called
             # from self._peerServiceRemovalCallback.
-            player = Player(description['player']['name'], description['player']['UUID'], description['player']['color'])            
+            player = Player(updated['player']['name'], updated['player']['UUID'], updated['player']['color'])
             if not self.otherPlayers.has_key(serviceName):
                 self.otherPlayers[serviceName] = player
                 self.guiPlayerAddedCallback(player)
             elif self.otherPlayers[serviceName] != player:
                 self.otherPlayers[serviceName] = player
                 self.guiPlayerUpdatedCallback(self.otherPlayers[serviceName])
-            del description['player']
 
         # Retrieve the player object for this service description update.
         player = self.otherPlayers[serviceName]
 
         # Now that we've updated the player object, let's look at the games
-        # currently going on.
-        for gameUUID, game in description.items():
+        # that were added or updated.
+        changedGames = set()
+        for gameUUID, game in updated.items():
+            if gameUUID == 'player':
+                continue
             # Add the game to our list of games when it's not yet included.
             if not self.games.has_key(gameUUID):
                 # Only really add it when the broadcaster is participating.
                 if game['participating']:
-                    self.games[gameUUID] = copy.deepcopy(game)
+                    self.games[gameUUID] = dict(game)
                     self.games[gameUUID]['players'] = []
                     del self.games[gameUUID]['participating']
                     self.guiGameAddedCallback(gameUUID, self.games[gameUUID])
+                    changedGames.add(gameUUID)
             else:
                 # Update the metadata for the game: either name or description may
                 # have changed.
                 if game['name'] != self.games[gameUUID]['name'] \
                    or game['description'] != self.games[gameUUID]['description']:
-                   game['name']        = self.games[gameUUID]['name']
-                   game['description'] = self.games[gameUUID]['description']
-                   self.guiGameUpdatedCallback(gameUUID, game)
+                   self.games[gameUUID]['name']        = game['name']
+                   self.games[gameUUID]['description'] = game['description']
+                   self.guiGameUpdatedCallback(gameUUID, self.games[gameUUID])
+                   changedGames.add(gameUUID)
 
             # Only update the list of players when the game has been accepted.
             if self.games.has_key(gameUUID):
@@ -148,26 +175,32 @@ class ManyInARowService(OneToManyService):
                 # OUR LIST of players for the game, ADD him. 
                 if game['participating'] and not player.UUID in self.games[gameUUID]['players']:
                     self.games[gameUUID]['players'].append(player.UUID)
+                    changedGames.add(gameUUID)
                 # If this player IS NOT PARTICIPATING in this game, but is IN OUR
                 # LIST of players for the game, REMOVE him. 
                 elif not game['participating'] and player.UUID in self.games[gameUUID]['players']:
-                    self.games[gameUUID]['players'].remove(player.UUID)
-                    # If there are no more players in this game, then call the
-                    # guiGameEmptyCallback callback, delete it and notify the GUI.
-                    if len(self.games[gameUUID]['players']) == 0:
-                        self.guiGameEmptyCallback(gameUUID, self.games[gameUUID])
-                        del self.games[gameUUID]
-
-        # Detect empty games.
-        for gameUUID in self.games.keys():
-            if gameUUID not in description.keys():
-                self.guiGameEmptyCallback(gameUUID, self.games[gameUUID])
-                del self.games[gameUUID]
+                    self._removePlayerFromGame(gameUUID, player.UUID)
+                    changedGames.add(gameUUID)
 
+        # A game is deleted from a service description when that peer
+        # considers it empty: it certainly doesn't participate anymore.
+        for gameUUID in deleted:
+            if self.games.has_key(gameUUID) and player.UUID in self.games[gameUUID]['players']:
+                self._removePlayerFromGame(gameUUID, player.UUID)
+                changedGames.add(gameUUID)
 
-        # Rebuild the service description now that we've updated our list of
+        # Update the service description now that we've updated our list of
         # games.
-        self.buildServiceDescription()
+        self._updateServiceDescription(changedGames)
+
+
+    def _removePlayerFromGame(self, gameUUID, playerUUID):
+        self.games[gameUUID]['players'].remove(playerUUID)
+        # If there are no more players in this game, then call the
+        # guiGameEmptyCallback callback, delete it and notify the GUI.
+        if len(self.games[gameUUID]['players']) == 0:
+            self.guiGameEmptyCallback(gameUUID, self.games[gameUUID])
+            del self.games[gameUUID]
 
 
     def buildServiceDescription(self):
@@ -186,20 +219,55 @@ class ManyInARowService(OneToManyService):
         # 'player'
         description['player'] = {'UUID' : self.player.UUID, 'name' : self.player.name, 'color' : self.player.color}
         # '<gameUUID>'
-        games = copy.deepcopy(self.games)
-        for gameUUID, game in games.items():
-            description[gameUUID] = game
-            description[gameUUID]['participating'] = (self.player.UUID in self.games[gameUUID]['players'])
-            del description[gameUUID]['players']
+        for gameUUID in self.games.keys():
+            description[gameUUID] = self._describeGame(gameUUID)
 
         # Broadcast the updated description if it's any different.
         if self.ownServiceDescription != description:
-            # Store the new description.
-            self.ownServiceDescription = description
+            self._setServiceDescription(description)
+
+
+    def _updateServiceDescription(self, gameUUIDs):
+        """Update the service description for the given games only (i.e. the
+        games that were added, updated or deleted), instead of rebuilding it
+        for all games."""
+        description = None
+        for gameUUID in gameUUIDs:
+            if self.games.has_key(gameUUID):
+                game = self._describeGame(gameUUID)
+                if self.ownServiceDescription.get(gameUUID) == game:
+                    continue
+            elif not self.ownServiceDescription.has_key(gameUUID):
+                continue
+            # The entries of the service description are never modified
+            # once they've been built, so a shallow copy suffices.
+            if description is None:
+                description = dict(self.ownServiceDescription)
+            if self.games.has_key(gameUUID):
+                description[gameUUID] = game
+            else:
+                del description[gameUUID]
+
+        # Broadcast the updated description if it's any different.
+        if description is not None:
+            self._setServiceDescription(description)
+
+
+    def _describeGame(self, gameUUID):
+        """The entry of a game in the service description."""
+        game = self.games[gameUUID]
+        description = dict((key, value) for (key, value) in game.items() if key != 'players')
+        description['participating'] = (self.player.UUID in game['players'])
+        return description
+
+
+    def _setServiceDescription(self, description):
+        # Store the new description.
+        self.ownServiceDescription = description
 
-            # Set this new description.
-            with self.zeroconf.lock:
-                self.zeroconf.outbox.put(description)
+        # Set this new description.
+        with self.zeroconf.lock:
+            self.zeroconf.outbox.put(description)
 
 
     def hostGame(self, gameUUID, name, description, numRows, numCols, waitTime, startTime):
@@ -215,7 +283,7 @@ class ManyInARowService(OneToManyService):
                 'players'     : [self.player.UUID], # Not sent with the service description.
             }
             # Broadcast the updated game list.
-            self.buildServiceDescription()
+            self._updateServiceDescription([gameUUID])
 
 
     def joinGame(self, gameUUID):
@@ -223,25 +291,21 @@ class ManyInARowService(OneToManyService):
             # Update the game list.
             self.games[gameUUID]['players'].append(self.player.UUID)
             # Broadcast the updated game list.
-            self.buildServiceDescription()
+            self._updateServiceDescription([gameUUID])
 
 
     def leaveGame(self, gameUUID):
         with self.lock:
             # Update the game list.
-            self.games[gameUUID]['players'].remove(self.player.UUID)
-            # If there are no more players in this game, then call the
-            # guiGameEmptyCallback callback, delete it and notify the GUI.
-            if len(self.games[gameUUID]['players']) == 0:
-                self.guiGameEmptyCallback(gameUUID, self.games[gameUUID])
-                del self.games[gameUUID]
+            self._removePlayerFromGame(gameUUID, self.player.UUID)
             # Broadcast the updated game list.
-            self.buildServiceDescription()
+            self._updateServiceDescription([gameUUID])
 
 
     def stats(self):
-        stats = {
+        stats = super(ManyInARowService, self).stats()
+        stats.update({
             'otherPlayers' : copy.deepcopy(self.otherPlayers),
             'games'        : copy.deepcopy(self.games),
-        }
+        })
         return stats
@@ -0,0 +1,155 @@
+import sys
+import threading
+import unittest
+
+from DistributedGame import SimulatedBonjour
+sys.modules['pybonjour'] = SimulatedBonjour
+from DistributedGame.Immutable import freeze
+from DistributedGame.IPMulticastMessaging import IPMulticastMessaging
+from DistributedGame.Player import Player
+from ManyInARowService import ManyInARowService
+
+
+
+
+class OfflineManyInARowService(ManyInARowService):
+    """Doesn't start any threads or zeroconf (its multicast layer isn't
+    started): it records the GUI callbacks and the service descriptions it
+    would broadcast."""
+
+    def __init__(self, player):
+        self.events       = []
+        self.descriptions = []
+        record = lambda name: lambda *args: self.events.append((name,) + args)
+        self.guiPlayerAddedCallback   = record('player added')
+        self.guiPlayerUpdatedCallback = record('player updated')
+        self.guiPlayerLeftCallback    = record('player left')
+        self.guiGameAddedCallback     = record('game added')
+        self.guiGameUpdatedCallback   = record('game updated')
+        self.guiGameEmptyCallback     = record('game empty')
+        self.guiPeerServiceDiscoveredCallback = record('peer discovered')
+        self.guiPeerServiceRemovedCallback    = record('peer removed')
+
+        self.lock                  = threading.Condition()
+        self.ips                   = {}
+        self.multicast             = IPMulticastMessaging(0)
+        self.player                = player
+        self.otherPlayers          = {}
+        self.games                 = {}
+        self.pendingGames          = {}
+        self.ownServiceDescription = {}
+
+
+    def _setServiceDescription(self, description):
+        self.ownServiceDescription = description
+        self.descriptions.append(description)
+
+
+
+
+class ManyInARowServiceTest(unittest.TestCase):
+
+    GAME_UUID = '01234567-89ab-cdef-0123-456789abcdef'
+
+    def setUp(self):
+        self.service = OfflineManyInARowService(Player('me'))
+        self.peer    = Player('peer')
+
+
+    def tearDown(self):
+        self.service.multicast._commitSuicide()
+
+
+    def describePlayer(self, player):
+        return {'UUID' : player.UUID, 'name' : player.name, 'color' : player.color}
+
+
+    def describeGame(self, name='game', participating=True):
+        return {'name' : name, 'description' : 'a game', 'numRows' : 6, 'numCols' : 7,
+                'waitTime' : 2, 'starttime' : 0, 'participating' : participating}
+
+
+    def update(self, updated, deleted=[]):
+        """Pass a delta of the peer's service description, with immutable
+        values, like ZeroconfMessaging does."""
+        self.service._peerServiceDescriptionUpdatedCallback('peer', 1, freeze(updated), deleted)
+
+
+    def events(self, name):
+        return [event for event in self.service.events if event[0] == name]
+
+
+    def testGameBeforePlayer(self):
+        """A game that arrives before the player that participates in it is
+        kept until the player is known."""
+        self.update({self.GAME_UUID : self.describeGame()})
+        self.assertEqual(self.service.games, {})
+        self.update({'player' : self.describePlayer(self.peer)})
+        self.assertEqual(len(self.events('player added')), 1)
+        self.assertEqual(self.service.games[self.GAME_UUID]['players'], [self.peer.UUID])
+        self.assertEqual(self.service.pendingGames, {})
+
+
+    def testGameUpdated(self):
+        self.update({'player' : self.describePlayer(self.peer), self.GAME_UUID : self.describeGame()})
+        self.assertEqual(len(self.events('game added')), 1)
+        self.update({self.GAME_UUID : self.describeGame(name='renamed')})
+        self.assertEqual(self.service.games[self.GAME_UUID]['name'], 'renamed')
+        self.assertEqual(len(self.events('game updated')), 1)
+        # Nothing changed.
+        self.update({self.GAME_UUID : self.describeGame(name='renamed')})
+        self.assertEqual(len(self.events('game updated')), 1)
+
+
+    def testGameLeftAndDeleted(self):
+        self.update({'player' : self.describePlayer(self.peer), self.GAME_UUID : self.describeGame()})
+        self.service.joinGame(self.GAME_UUID)
+        self.assertEqual(self.service.ownServiceDescription[self.GAME_UUID]['participating'], True)
+
+        # The peer deletes the game from its description: it no longer
+        # participates, but we still do.
+        self.update({}, [self.GAME_UUID])
+        self.assertEqual(self.service.games[self.GAME_UUID]['players'], [self.service.player.UUID])
+        self.assertEqual(self.events('game empty'), [])
+
+        # Once we leave as well, the game is empty.
+        self.service.leaveGame(self.GAME_UUID)
+        self.assertEqual(len(self.events('game empty')), 1)
+        self.assertFalse(self.service.ownServiceDescription.has_key(self.GAME_UUID))
+
+
+    def testGameOfOtherHost(self):
+        """A game that the peer doesn't participate in isn't added, and
+        doesn't make a game that we know of empty."""
+        self.update({'player' : self.describePlayer(self.peer), self.GAME_UUID : self.describeGame(participating=False)})
+        self.assertEqual(self.service.games, {})
+        self.assertEqual(self.events('game empty'), [])
+
+
+    def testPeerRemoved(self):
+        self.update({'player' : self.describePlayer(self.peer), self.GAME_UUID : self.describeGame()})
+        self.service._peerServiceRemovalCallback('peer', 1)
+        self.assertEqual(len(self.events('player left')), 1)
+        self.assertEqual(len(self.events('game empty')), 1)
+        self.assertEqual(self.service.games, {})
+
+
+    def testPeerRemovedThroughRouter(self):
+        """The removal of a peer on another host, as passed on by zeroconf,
+        reaches the service: its player leaves its games."""
+        self.service._peerServiceDiscoveryCallbackRouter('peer', 1, 'peer._Many_In_A_Row._tcp.local.', 'peer.local.', '10.1.2.3', 1337)
+        self.update({'player' : self.describePlayer(self.peer), self.GAME_UUID : self.describeGame()})
+        self.service.joinGame(self.GAME_UUID)
+        self.service._peerServiceRemovalCallbackRouter('peer', 1)
+        self.assertEqual(len(self.events('peer discovered')), 1)
+        self.assertEqual(len(self.events('player left')), 1)
+        self.assertEqual(len(self.events('peer removed')), 1)
+        self.assertEqual(self.service.otherPlayers, {})
+        self.assertEqual(self.service.games[self.GAME_UUID]['players'], [self.service.player.UUID])
+        self.assertFalse('10.1.2.3' in self.service.multicast.sources)
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()